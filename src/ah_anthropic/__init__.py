@@ -1 +1,3 @@
 from .mod import *
+from .fanout import *
+from .broadcast import *
@@ -0,0 +1,152 @@
+"""Pre-encoded request bodies.
+
+Each turn sends the whole system prompt and history again, and almost all
+of it is byte-for-byte what was sent last turn. Instead of letting the SDK
+re-serialize the full request, the JSON encoding of each message is cached
+under its fingerprint and cache breakpoints, so a turn only encodes the
+messages that changed (usually the last one or two) and joins the cached
+bytes for the rest. The cache is shared by all sessions and bounded by
+MR_ANTHROPIC_PREENCODE_CACHE_MB. orjson is used when installed. Off unless
+MR_ANTHROPIC_PREENCODE is set; the SDK then encodes requests as usual.
+
+    python -m ah_anthropic.body_encoding --history 10 100 500 1000
+"""
+import os
+import json
+import time
+from collections import OrderedDict
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+PREENCODE_ENABLED = os.environ.get('MR_ANTHROPIC_PREENCODE', '').lower() in ('1', 'true', 'yes')
+PREENCODE_CACHE_BYTES = int(float(os.environ.get('MR_ANTHROPIC_PREENCODE_CACHE_MB', '64')) * 1024 * 1024)
+
+# kwargs that are request options for the SDK rather than part of the body
+REQUEST_OPTIONS = ('extra_headers', 'extra_query', 'extra_body', 'timeout')
+
+
+if orjson is not None:
+    def encode_json(value):
+        return orjson.dumps(value)
+else:
+    def encode_json(value):
+        return json.dumps(value, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def message_keys(normalized_messages, breakpoints, variant=None):
+    """Cache key per message: content fingerprint, cached block indices and a variant
+    (e.g. the API key name when images were swapped for that key's file ids)"""
+    cached_blocks = {}
+    for i, j in breakpoints:
+        cached_blocks.setdefault(i, []).append(j)
+    return [(message.fingerprint, tuple(sorted(cached_blocks.get(i, ()))), variant)
+            for i, message in enumerate(normalized_messages)]
+
+
+class EncodedBodyCache:
+    def __init__(self, max_bytes=PREENCODE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def encoded(self, key, value):
+        data = self._entries.get(key)
+        if data is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+        self.misses += 1
+        data = encode_json(value)
+        if len(data) <= self.max_bytes:
+            self._entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, dropped = self._entries.popitem(last=False)
+                self.size -= len(dropped)
+        return data
+
+    def request_body(self, kwargs, keys):
+        """JSON body for a Messages request, reusing cached encodings of its system prompt and messages.
+
+        keys holds one cache key per entry of kwargs['messages'], or None for
+        a message that must always be encoded.
+        """
+        parts = []
+        for name, value in kwargs.items():
+            if name in REQUEST_OPTIONS or name == 'messages':
+                continue
+            if name == 'system' and isinstance(value, list):
+                # The system text is the same str object every turn, so hashing it is cheap
+                system_key = ('system',) + tuple((block.get('type'), block.get('text'),
+                                                  tuple(sorted((block.get('cache_control') or {}).items())))
+                                                 for block in value)
+                encoded = self.encoded(system_key, value)
+            else:
+                encoded = encode_json(value)
+            parts.append(encode_json(name) + b':' + encoded)
+        messages = [self.encoded(key, message) if key is not None else encode_json(message)
+                    for key, message in zip(keys, kwargs['messages'])]
+        parts.append(b'"messages":[' + b','.join(messages) + b']')
+        return b'{' + b','.join(parts) + b'}'
+
+    def status(self):
+        return {'entries': len(self._entries), 'bytes': self.size, 'hits': self.hits, 'misses': self.misses,
+                'encoder': 'orjson' if orjson is not None else 'json'}
+
+
+body_cache = EncodedBodyCache()
+
+
+def _benchmark(history_lengths, message_chars=600, repeat=5):
+    """Time building the body for the next turn of a conversation of each length"""
+    from .normalized import normalize_messages
+    try:
+        # What messages.create does before httpx encodes the body
+        from anthropic._utils import maybe_transform
+        from anthropic.types.message_create_params import MessageCreateParamsStreaming
+    except ImportError:
+        maybe_transform = None
+    system = [{'type': 'text', 'text': 'You are a helpful agent. ' * 200, 'cache_control': {'type': 'ephemeral'}}]
+    for length in history_lengths:
+        history = [{'role': 'user' if i % 2 == 0 else 'assistant',
+                    'content': [{'type': 'text', 'text': f'{i} ' + 'lorem ipsum dolor sit amet ' * (message_chars // 27)}]}
+                   for i in range(length)]
+        cache = EncodedBodyCache()
+        full_times, sdk_times, cached_times = [], [], []
+        for turn in range(repeat + 1):
+            history.append({'role': 'user', 'content': [{'type': 'text', 'text': f'turn {turn}'}]})
+            normalized = normalize_messages(history)
+            kwargs = {'model': 'claude-3-7-sonnet-latest', 'system': system,
+                      'messages': [message.to_wire() for message in normalized], 'max_tokens': 4000, 'stream': True}
+            started = time.perf_counter()
+            json.dumps(kwargs).encode('utf-8')
+            full_times.append(time.perf_counter() - started)
+            if maybe_transform is not None:
+                started = time.perf_counter()
+                json.dumps(maybe_transform(kwargs, MessageCreateParamsStreaming)).encode('utf-8')
+                sdk_times.append(time.perf_counter() - started)
+            started = time.perf_counter()
+            cache.request_body(kwargs, message_keys(normalized, ()))
+            cached_times.append(time.perf_counter() - started)
+            history.append({'role': 'assistant', 'content': [{'type': 'text', 'text': 'ok'}]})
+        # The first turn fills the cache, later turns show steady state
+        full = sum(full_times[1:]) / repeat * 1000
+        cached = sum(cached_times[1:]) / repeat * 1000
+        sdk = f"{sum(sdk_times[1:]) / repeat * 1000:8.2f} ms" if sdk_times else '     n/a'
+        print(f"{length:6d} messages  sdk {sdk}  json.dumps {full:8.2f} ms  prefix cache {cached:8.2f} ms"
+              f"  first turn {cached_times[0] * 1000:8.2f} ms  ({'orjson' if orjson is not None else 'json'})")
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark request body encoding against history length')
+    parser.add_argument('--history', type=int, nargs='+', default=[10, 100, 500, 1000])
+    parser.add_argument('--message-chars', type=int, default=600)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    _benchmark(args.history, args.message_chars, args.repeat)
@@ -0,0 +1,220 @@
+"""Broadcast one content stream to several consumers.
+
+The UI, a transcript logger and a command parser often all need the output
+of the same stream_chat call. StreamBroadcast reads the upstream stream once
+into a single shared buffer; each consumer keeps its own cursor into it and
+chunks are dropped from the buffer once every consumer has read them.
+
+A consumer more than max_buffer chunks behind is handled by the policy:
+  'block' - stop reading upstream until the slowest consumer catches up
+  'drop'  - skip the slow consumer past its oldest unread chunks
+  'spill' - move the slow consumer's unread chunks to a temp file it reads
+            back from, so upstream keeps going at full speed without losing data
+"""
+import os
+import struct
+import asyncio
+import tempfile
+
+BROADCAST_POLICY = os.environ.get('MR_ANTHROPIC_BROADCAST_POLICY', 'block')
+BROADCAST_MAX_BUFFER = int(os.environ.get('MR_ANTHROPIC_BROADCAST_MAX_BUFFER', '1024'))
+POLICIES = ('block', 'drop', 'spill')
+
+_LENGTH = struct.Struct('<I')
+
+
+class SpillFile:
+    """Append-only queue of text chunks on disk"""
+    __slots__ = ('file', 'read_pos', 'write_pos', 'pending')
+
+    def __init__(self, directory=None):
+        self.file = tempfile.TemporaryFile(dir=directory)
+        self.read_pos = 0
+        self.write_pos = 0
+        self.pending = 0
+
+    def write(self, chunks):
+        data = b''.join(_LENGTH.pack(len(encoded)) + encoded
+                        for encoded in (chunk.encode('utf-8') for chunk in chunks))
+        self.file.seek(self.write_pos)
+        self.file.write(data)
+        self.write_pos += len(data)
+        self.pending += len(chunks)
+
+    def read(self):
+        self.file.seek(self.read_pos)
+        (length,) = _LENGTH.unpack(self.file.read(_LENGTH.size))
+        chunk = self.file.read(length).decode('utf-8')
+        self.read_pos += _LENGTH.size + length
+        self.pending -= 1
+        if not self.pending:
+            # Everything read back, reuse the file from the start
+            self.file.seek(0)
+            self.file.truncate()
+            self.read_pos = self.write_pos = 0
+        return chunk
+
+    def close(self):
+        self.file.close()
+
+
+class Consumer:
+    __slots__ = ('name', 'cursor', 'spill', 'dropped', 'spilled', 'received')
+
+    def __init__(self, name, cursor):
+        self.name = name
+        self.cursor = cursor
+        self.spill = None
+        self.dropped = 0
+        self.spilled = 0
+        self.received = 0
+
+
+class StreamBroadcast:
+    def __init__(self, stream, policy=BROADCAST_POLICY, max_buffer=BROADCAST_MAX_BUFFER, spill_dir=None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown broadcast policy {policy!r}, expected one of {POLICIES}")
+        self.stream = stream
+        self.policy = policy
+        self.max_buffer = max(1, max_buffer)
+        self.spill_dir = spill_dir
+        # buffer[0] is chunk number `base` of the stream
+        self.buffer = []
+        self.base = 0
+        self.consumers = []
+        self.done = False
+        self.error = None
+        self._changed = asyncio.Condition()
+        self._pump_task = None
+
+    @property
+    def head(self):
+        return self.base + len(self.buffer)
+
+    def subscribe(self, name=None):
+        """Async generator over the stream for one consumer.
+
+        Subscribe every consumer before any of them starts iterating to be
+        sure each sees the whole stream.
+        """
+        consumer = Consumer(name or f'consumer{len(self.consumers)}', self.base)
+        self.consumers.append(consumer)
+        return self._consume(consumer)
+
+    def _lag(self):
+        return max((self.head - c.cursor for c in self.consumers), default=0)
+
+    def _trim(self):
+        if not self.consumers:
+            slowest = self.head
+        else:
+            slowest = min(c.cursor for c in self.consumers)
+        if slowest > self.base:
+            del self.buffer[:slowest - self.base]
+            self.base = slowest
+
+    def _relieve(self):
+        for consumer in self.consumers:
+            behind = self.head - consumer.cursor
+            if behind <= self.max_buffer:
+                continue
+            if self.policy == 'drop':
+                skipped = behind - self.max_buffer
+                consumer.cursor += skipped
+                consumer.dropped += skipped
+            else:
+                if consumer.spill is None:
+                    consumer.spill = SpillFile(self.spill_dir)
+                consumer.spill.write(self.buffer[consumer.cursor - self.base:])
+                consumer.spilled += behind
+                consumer.cursor = self.head
+        self._trim()
+
+    async def _pump(self):
+        try:
+            async for chunk in self.stream:
+                async with self._changed:
+                    if self.policy == 'block':
+                        await self._changed.wait_for(lambda: self._lag() < self.max_buffer)
+                    self.buffer.append(chunk)
+                    if self.policy != 'block':
+                        self._relieve()
+                    self._changed.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            async with self._changed:
+                self._changed.notify_all()
+
+    async def _next(self, consumer):
+        async with self._changed:
+            while True:
+                if consumer.spill is not None and consumer.spill.pending:
+                    return consumer.spill.read()
+                if consumer.cursor < self.head:
+                    chunk = self.buffer[consumer.cursor - self.base]
+                    consumer.cursor += 1
+                    if consumer.cursor - 1 == self.base:
+                        self._trim()
+                        self._changed.notify_all()
+                    return chunk
+                if self.done:
+                    return None
+                await self._changed.wait()
+
+    async def _consume(self, consumer):
+        if self._pump_task is None:
+            self._pump_task = asyncio.ensure_future(self._pump())
+        try:
+            while True:
+                chunk = await self._next(consumer)
+                if chunk is None:
+                    break
+                consumer.received += 1
+                yield chunk
+            if self.error is not None:
+                raise self.error
+        finally:
+            await self._unsubscribe(consumer)
+
+    async def _unsubscribe(self, consumer):
+        if consumer in self.consumers:
+            self.consumers.remove(consumer)
+        if consumer.spill is not None:
+            consumer.spill.close()
+            consumer.spill = None
+        async with self._changed:
+            self._trim()
+            self._changed.notify_all()
+        if not self.consumers:
+            await self.close()
+
+    async def close(self):
+        """Stop reading upstream and close it"""
+        if self._pump_task is not None and not self._pump_task.done():
+            self._pump_task.cancel()
+            try:
+                await self._pump_task
+            except asyncio.CancelledError:
+                pass
+        aclose = getattr(self.stream, 'aclose', None)
+        if aclose is not None:
+            await aclose()
+
+    def status(self):
+        return {
+            'policy': self.policy,
+            'buffered': len(self.buffer),
+            'read': self.head,
+            'done': self.done,
+            'consumers': {c.name: {'behind': self.head - c.cursor + (c.spill.pending if c.spill else 0),
+                                   'received': c.received, 'dropped': c.dropped, 'spilled': c.spilled}
+                          for c in self.consumers},
+        }
+
+
+def tee_stream(stream, n=2, policy=BROADCAST_POLICY, max_buffer=BROADCAST_MAX_BUFFER, spill_dir=None):
+    """Split a content stream into n independent consumers that share one buffer"""
+    broadcast = StreamBroadcast(stream, policy, max_buffer, spill_dir)
+    return [broadcast.subscribe() for _ in range(n)]
@@ -0,0 +1,128 @@
+"""Prompt-cache efficiency ledger, per session and model."""
+import os
+import json
+from collections import OrderedDict
+from lib.providers.services import service
+
+MAX_LEDGER_SESSIONS = 10000
+
+# Prompt caching prices relative to the base input token price
+CACHE_WRITE_MULTIPLIER = 1.25
+CACHE_READ_MULTIPLIER = 0.1
+DEFAULT_INPUT_COST = 0.000003  # $3 per million tokens
+
+# Base (input, output) price per token by model family
+MODEL_COSTS = {
+    'opus': (0.000015, 0.000075),
+    'sonnet': (0.000003, 0.000015),
+    'haiku': (0.0000008, 0.000004),
+}
+
+
+def load_cost_overrides(value=None):
+    """MR_ANTHROPIC_MODEL_COSTS: JSON mapping a model to [input, output] price per token"""
+    value = os.environ.get('MR_ANTHROPIC_MODEL_COSTS', '') if value is None else value
+    if not value.strip():
+        return {}
+    try:
+        return {model: (float(costs[0]), float(costs[1])) for model, costs in json.loads(value).items()}
+    except (ValueError, TypeError, IndexError, AttributeError) as e:
+        print(f"Invalid MR_ANTHROPIC_MODEL_COSTS, ignoring: {e}")
+        return {}
+
+
+COST_OVERRIDES = load_cost_overrides()
+
+
+def model_costs(model):
+    """(input, output) price per token for a model"""
+    if model in COST_OVERRIDES:
+        return COST_OVERRIDES[model]
+    for family, costs in MODEL_COSTS.items():
+        if family in (model or ''):
+            return costs
+    return MODEL_COSTS['sonnet']
+
+
+class CacheLedgerEntry:
+    __slots__ = ('requests', 'uncached_input_tokens', 'cache_write_tokens', 'cache_read_tokens')
+
+    def __init__(self):
+        self.requests = 0
+        self.uncached_input_tokens = 0
+        self.cache_write_tokens = 0
+        self.cache_read_tokens = 0
+
+    def add(self, uncached, cache_write, cache_read):
+        self.requests += 1
+        self.uncached_input_tokens += uncached
+        self.cache_write_tokens += cache_write
+        self.cache_read_tokens += cache_read
+
+    def merge(self, other):
+        self.requests += other.requests
+        self.uncached_input_tokens += other.uncached_input_tokens
+        self.cache_write_tokens += other.cache_write_tokens
+        self.cache_read_tokens += other.cache_read_tokens
+
+    def summary(self, input_cost=DEFAULT_INPUT_COST):
+        total = self.uncached_input_tokens + self.cache_write_tokens + self.cache_read_tokens
+        # What the same prompts would have cost without caching, minus what they did cost
+        savings = (self.cache_read_tokens * (1 - CACHE_READ_MULTIPLIER)
+                   - self.cache_write_tokens * (CACHE_WRITE_MULTIPLIER - 1)) * input_cost
+        return {
+            'requests': self.requests,
+            'uncached_input_tokens': self.uncached_input_tokens,
+            'cache_write_tokens': self.cache_write_tokens,
+            'cache_read_tokens': self.cache_read_tokens,
+            'total_input_tokens': total,
+            'hit_ratio': round(self.cache_read_tokens / total, 4) if total else 0.0,
+            'estimated_savings': round(savings, 6),
+        }
+
+
+class CacheLedger:
+    def __init__(self):
+        self._sessions = OrderedDict()
+        self._models = {}
+
+    def record(self, session_id, model, uncached, cache_write, cache_read):
+        models = self._sessions.get(session_id)
+        if models is None:
+            models = self._sessions[session_id] = {}
+        self._sessions.move_to_end(session_id)
+        while len(self._sessions) > MAX_LEDGER_SESSIONS:
+            self._sessions.popitem(last=False)
+        models.setdefault(model, CacheLedgerEntry()).add(uncached, cache_write, cache_read)
+        self._models.setdefault(model, CacheLedgerEntry()).add(uncached, cache_write, cache_read)
+
+    def stats(self, session_id=None, model=None):
+        """Summaries keyed by model, for one session or for the whole process"""
+        source = self._models if session_id is None else self._sessions.get(session_id, {})
+        result = {}
+        total = CacheLedgerEntry()
+        savings = 0.0
+        for entry_model, entry in source.items():
+            if model is not None and entry_model != model:
+                continue
+            result[entry_model] = entry.summary(model_costs(entry_model)[0])
+            savings += result[entry_model]['estimated_savings']
+            total.merge(entry)
+        result['total'] = total.summary()
+        result['total']['estimated_savings'] = round(savings, 6)
+        return result
+
+
+cache_ledger = CacheLedger()
+
+
+@service()
+async def get_cache_stats(session_id=None, model=None, context=None):
+    """Prompt-cache writes, reads, hit ratio and estimated savings.
+
+    With no session_id the stats cover every session in this process; pass
+    session_id='current' to use the session of the calling context.
+    """
+    if session_id == 'current':
+        session_id = getattr(context, 'log_id', None)
+    return cache_ledger.stats(session_id, model)
@@ -0,0 +1,215 @@
+"""Prompt-cache priming and keep-warm scheduler.
+
+Ephemeral prompt cache entries expire after 5 minutes (or 1 hour with the
+extended TTL). When MR_ANTHROPIC_CACHE_WARM is enabled, the prefix of each
+recent session is re-sent shortly before it would expire, so an agent that
+sits idle does not pay a full cache write on its next turn. The refresh is
+streamed and closed as soon as message_start reports cache usage, so no
+output (or thinking) is generated to speak of. Refreshes wait out key
+backoff and open circuits, and stop once MR_ANTHROPIC_CACHE_WARM_MAX_COST
+dollars, priced per model, have been spent in the last hour.
+"""
+import os
+import time
+import asyncio
+from collections import OrderedDict, deque
+from lib.providers.services import service
+from .cache_stats import model_costs, CACHE_WRITE_MULTIPLIER, CACHE_READ_MULTIPLIER
+from .clients import client_pool
+from .circuits import circuit_breaker
+
+CACHE_TTL = os.environ.get('MR_ANTHROPIC_CACHE_TTL', '5m')
+WARM_ENABLED = os.environ.get('MR_ANTHROPIC_CACHE_WARM', '').lower() in ('1', 'true', 'yes')
+WARM_MAX_COST_PER_HOUR = float(os.environ.get('MR_ANTHROPIC_CACHE_WARM_MAX_COST', '1.0'))
+# Sessions not explicitly marked active are kept warm this long after their last turn
+WARM_IDLE_LIMIT = float(os.environ.get('MR_ANTHROPIC_CACHE_WARM_IDLE_LIMIT', '1800'))
+WARM_CHECK_INTERVAL = 30.0
+MAX_WARM_SESSIONS = 1000
+
+TTL_SECONDS = {'5m': 300, '1h': 3600}
+EXTENDED_TTL_BETA = 'extended-cache-ttl-2025-04-11'
+
+
+def cache_control_marker():
+    """cache_control value for breakpoints, honouring MR_ANTHROPIC_CACHE_TTL"""
+    if CACHE_TTL == '1h':
+        return {'type': 'ephemeral', 'ttl': '1h'}
+    return {'type': 'ephemeral'}
+
+
+def beta_headers(*extra_betas):
+    betas = ['prompt-caching-2024-07-31', 'output-128k-2025-02-19']
+    if CACHE_TTL == '1h':
+        betas.append(EXTENDED_TTL_BETA)
+    betas.extend(extra_betas)
+    return {'anthropic-beta': ','.join(betas)}
+
+
+def refresh_interval():
+    """Refresh a minute before the entry would expire"""
+    return TTL_SECONDS.get(CACHE_TTL, 300) - 60
+
+
+def estimate_cost(usage, model):
+    input_cost, output_cost = model_costs(model)
+    cache_write = getattr(usage, 'cache_creation_input_tokens', 0) or 0
+    cache_read = getattr(usage, 'cache_read_input_tokens', 0) or 0
+    # Closing the stream early may still bill a few output tokens
+    output_tokens = max(usage.output_tokens or 0, 1)
+    return (usage.input_tokens * input_cost
+            + cache_write * input_cost * CACHE_WRITE_MULTIPLIER
+            + cache_read * input_cost * CACHE_READ_MULTIPLIER
+            + output_tokens * output_cost)
+
+
+class WarmSession:
+    __slots__ = ('key', 'kwargs', 'last_request', 'last_touch', 'active')
+
+    def __init__(self, key, kwargs):
+        self.key = key
+        self.kwargs = kwargs
+        self.last_request = self.last_touch = time.time()
+        self.active = False
+
+
+class CacheWarmer:
+    def __init__(self):
+        self.sessions = OrderedDict()
+        self.spend = deque()
+        self.refreshes = 0
+        self.skipped_for_cost = 0
+        self.skipped_for_backoff = 0
+        self._task = None
+
+    def spent_last_hour(self):
+        cutoff = time.time() - 3600
+        while self.spend and self.spend[0][0] < cutoff:
+            self.spend.popleft()
+        return sum(cost for _, cost in self.spend)
+
+    def note_request(self, session_id, key, kwargs):
+        """Remember the latest request of a session so its prefix can be refreshed"""
+        if not WARM_ENABLED or session_id is None:
+            return
+        session = self.sessions.get(session_id)
+        if session is None:
+            session = self.sessions[session_id] = WarmSession(key, kwargs)
+        else:
+            session.key, session.kwargs = key, kwargs
+            session.last_request = session.last_touch = time.time()
+        self.sessions.move_to_end(session_id)
+        while len(self.sessions) > MAX_WARM_SESSIONS:
+            self.sessions.popitem(last=False)
+        self.start()
+
+    def mark_active(self, session_id, active=True):
+        session = self.sessions.get(session_id)
+        if session is not None:
+            session.active = active
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_event_loop().create_task(self.run())
+
+    def _unavailable(self, key, model):
+        """Whether the key is backing off or the model's circuit is open"""
+        if key.wait_time(model) > 0 or circuit_breaker.is_open(model):
+            self.skipped_for_backoff += 1
+            return True
+        return False
+
+    async def _send(self, key, kwargs):
+        """Send the prefix, stop at message_start and account for its cost"""
+        model = kwargs['model']
+        kwargs = dict(kwargs, stream=True)
+        thinking = kwargs.get('thinking')
+        # Thinking parameters are part of the cached prefix, so they must stay the same.
+        # The stream is closed at message_start, before any of the budget is spent.
+        kwargs['max_tokens'] = thinking['budget_tokens'] + 1 if thinking else 1
+        try:
+            stream = await client_pool.create_stream(key, kwargs)
+        except Exception as e:
+            key.record_failure(model, e)
+            raise
+        usage = None
+        try:
+            async for event in stream:
+                if event.type == 'message_start':
+                    usage = event.message.usage
+                    break
+        finally:
+            await stream.close()
+        key.record_success(model)
+        if usage is None:
+            return None
+        self.spend.append((time.time(), estimate_cost(usage, model)))
+        return usage
+
+    async def refresh(self, session_id):
+        session = self.sessions.get(session_id)
+        if session is None:
+            return None
+        if self.spent_last_hour() >= WARM_MAX_COST_PER_HOUR:
+            self.skipped_for_cost += 1
+            print(f"[CACHE WARM] Skipping refresh of {session_id}, hourly cost cap reached")
+            return None
+        if self._unavailable(session.key, session.kwargs['model']):
+            # Tried again on the next check
+            return None
+        usage = await self._send(session.key, session.kwargs)
+        if usage is None:
+            return None
+        session.last_touch = time.time()
+        self.refreshes += 1
+        print(f"[CACHE WARM] Refreshed {session_id}: {usage.cache_read_input_tokens} tokens read from cache")
+        return usage
+
+    async def prime(self, key, kwargs):
+        """Write the cache for a system prompt before the first real turn"""
+        if self.spent_last_hour() >= WARM_MAX_COST_PER_HOUR:
+            self.skipped_for_cost += 1
+            return None
+        if self._unavailable(key, kwargs['model']):
+            return None
+        kwargs = dict(kwargs, messages=[{'role': 'user', 'content': [{'type': 'text', 'text': '.'}]}])
+        kwargs.pop('thinking', None)
+        return await self._send(key, kwargs)
+
+    def due_sessions(self):
+        now = time.time()
+        due = []
+        for session_id, session in list(self.sessions.items()):
+            if not session.active and now - session.last_request > WARM_IDLE_LIMIT:
+                # Idle too long, let its cache expire
+                del self.sessions[session_id]
+                continue
+            if now - session.last_touch >= refresh_interval():
+                due.append(session_id)
+        return due
+
+    async def run(self):
+        while self.sessions:
+            await asyncio.sleep(WARM_CHECK_INTERVAL)
+            for session_id in self.due_sessions():
+                try:
+                    await self.refresh(session_id)
+                except Exception as e:
+                    print(f"[CACHE WARM] Error refreshing {session_id}: {e}")
+
+    def status(self):
+        return {'enabled': WARM_ENABLED, 'ttl': CACHE_TTL, 'sessions': len(self.sessions),
+                'active_sessions': sum(1 for s in self.sessions.values() if s.active),
+                'refreshes': self.refreshes, 'skipped_for_cost': self.skipped_for_cost,
+                'skipped_for_backoff': self.skipped_for_backoff,
+                'spent_last_hour': round(self.spent_last_hour(), 6),
+                'max_cost_per_hour': WARM_MAX_COST_PER_HOUR}
+
+
+cache_warmer = CacheWarmer()
+
+
+@service()
+async def set_cache_keep_warm(active=True, context=None):
+    """Keep (or stop keeping) the calling session's prompt cache warm while idle"""
+    cache_warmer.mark_active(getattr(context, 'log_id', None), active)
+    return cache_warmer.status()
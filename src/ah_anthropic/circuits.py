@@ -0,0 +1,180 @@
+"""Per-model circuit breaker with an ordered fallback chain.
+
+After MR_ANTHROPIC_CIRCUIT_FAILURES consecutive outage errors (connection
+errors, timeouts, 5xx/overloaded) a model's circuit opens and requests go
+straight to the first healthy model in its fallback chain. After
+MR_ANTHROPIC_CIRCUIT_OPEN_SECONDS the circuit turns half-open and lets a
+single request through as a probe: success closes it again, failure
+reopens it.
+
+MR_ANTHROPIC_FALLBACK_MODELS is either a comma separated chain used for
+every model, or a JSON object mapping a model to its chain, e.g.
+{"claude-sonnet-4-0": ["claude-3-7-sonnet-latest", "claude-3-5-haiku-latest"]}
+"""
+import os
+import json
+import time
+import asyncio
+import anthropic
+from lib.providers.services import service
+from .shared_state import shared_state
+
+CIRCUIT_FAILURES = int(os.environ.get('MR_ANTHROPIC_CIRCUIT_FAILURES', '5'))
+CIRCUIT_OPEN_SECONDS = float(os.environ.get('MR_ANTHROPIC_CIRCUIT_OPEN_SECONDS', '60'))
+# A probe that has neither succeeded nor failed by then is given up on
+CIRCUIT_PROBE_TIMEOUT = float(os.environ.get('MR_ANTHROPIC_CIRCUIT_PROBE_TIMEOUT', '120'))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+def load_fallback_chains(value=None):
+    value = os.environ.get('MR_ANTHROPIC_FALLBACK_MODELS', '') if value is None else value
+    value = value.strip()
+    if not value:
+        return {}
+    if value.startswith('{'):
+        try:
+            return {model: list(chain) for model, chain in json.loads(value).items()}
+        except (ValueError, AttributeError) as e:
+            print(f"Invalid MR_ANTHROPIC_FALLBACK_MODELS, ignoring: {e}")
+            return {}
+    return {'*': [model.strip() for model in value.split(',') if model.strip()]}
+
+
+def is_outage_error(error):
+    """Errors that say something about the model's availability, not the request"""
+    if isinstance(error, (anthropic.APIConnectionError, anthropic.APITimeoutError)):
+        return True
+    if isinstance(error, anthropic.APIStatusError):
+        return error.status_code >= 500
+    return False
+
+
+def is_request_error(error):
+    """Errors caused by the request itself (bad parameters, auth), which a retry cannot fix"""
+    if isinstance(error, anthropic.APIStatusError):
+        return 400 <= error.status_code < 500 and error.status_code not in (408, 409, 429)
+    return False
+
+
+class ModelCircuit:
+    __slots__ = ('state', 'failures', 'opened_at', 'probe_in_flight', 'probe_started', 'probe_owner')
+
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.probe_started = 0.0
+        self.probe_owner = None
+
+
+def _current_task():
+    try:
+        return asyncio.current_task()
+    except RuntimeError:
+        return None
+
+
+class CircuitBreaker:
+    def __init__(self, fallback_chains=None):
+        self.circuits = {}
+        self.fallback_chains = load_fallback_chains() if fallback_chains is None else fallback_chains
+
+    def _circuit(self, model):
+        circuit = self.circuits.get(model)
+        if circuit is None:
+            circuit = self.circuits[model] = ModelCircuit()
+        if circuit.state == CLOSED and shared_state is not None:
+            # Another worker may already have opened it
+            opened_at = shared_state.get(f'circuit:{model}')
+            if opened_at:
+                circuit.state = OPEN
+                circuit.opened_at = opened_at
+        return circuit
+
+    def allow(self, model):
+        """Whether a request may go to this model now"""
+        circuit = self._circuit(model)
+        if circuit.state == CLOSED:
+            return True
+        if circuit.state == OPEN and time.time() - circuit.opened_at >= CIRCUIT_OPEN_SECONDS:
+            circuit.state = HALF_OPEN
+            circuit.probe_in_flight = False
+        if circuit.state == HALF_OPEN and circuit.probe_in_flight \
+                and time.time() - circuit.probe_started >= CIRCUIT_PROBE_TIMEOUT:
+            print(f"[CIRCUIT] Probe of {model} timed out")
+            circuit.probe_in_flight = False
+        if circuit.state == HALF_OPEN and not circuit.probe_in_flight:
+            circuit.probe_in_flight = True
+            circuit.probe_started = time.time()
+            circuit.probe_owner = _current_task()
+            print(f"[CIRCUIT] Probing {model}")
+            return True
+        return False
+
+    def release_probe(self, model):
+        """Give up the probe held by the current task without an outcome, e.g. when it was cancelled"""
+        circuit = self.circuits.get(model)
+        if circuit is not None and circuit.probe_in_flight and circuit.probe_owner is _current_task():
+            circuit.probe_in_flight = False
+            circuit.probe_owner = None
+
+    def is_open(self, model):
+        """Whether requests to this model are refused right now, without claiming a probe"""
+        circuit = self._circuit(model)
+        if circuit.state == OPEN:
+            return time.time() - circuit.opened_at < CIRCUIT_OPEN_SECONDS
+        return circuit.state == HALF_OPEN and circuit.probe_in_flight
+
+    def chain(self, model):
+        return [model] + self.fallback_chains.get(model, self.fallback_chains.get('*', []))
+
+    def choose_model(self, model):
+        """First model in the chain whose circuit allows a request"""
+        for candidate in self.chain(model):
+            if self.allow(candidate):
+                if candidate != model:
+                    print(f"[CIRCUIT] {model} unavailable, using fallback {candidate}")
+                return candidate
+        return model
+
+    def record_success(self, model):
+        circuit = self._circuit(model)
+        if circuit.state != CLOSED:
+            print(f"[CIRCUIT] {model} recovered, closing circuit")
+            if shared_state is not None:
+                shared_state.delete(f'circuit:{model}')
+        circuit.state = CLOSED
+        circuit.failures = 0
+        circuit.probe_in_flight = False
+
+    def record_failure(self, model, error=None):
+        circuit = self._circuit(model)
+        if error is not None and not is_outage_error(error):
+            # The model answered, the request itself was bad
+            circuit.probe_in_flight = False
+            return
+        circuit.failures += 1
+        circuit.probe_in_flight = False
+        if circuit.state == HALF_OPEN or (circuit.state == CLOSED and circuit.failures >= CIRCUIT_FAILURES):
+            circuit.state = OPEN
+            circuit.opened_at = time.time()
+            print(f"[CIRCUIT] Opening circuit for {model} after {circuit.failures} failures")
+            if shared_state is not None:
+                shared_state.put(f'circuit:{model}', circuit.opened_at, CIRCUIT_OPEN_SECONDS)
+
+    def status(self):
+        return {model: {'state': c.state, 'failures': c.failures, 'opened_at': c.opened_at}
+                for model, c in self.circuits.items()}
+
+
+circuit_breaker = CircuitBreaker()
+
+
+@service()
+async def get_circuit_status(context=None):
+    """Circuit state per model and the configured fallback chains"""
+    return {'circuits': circuit_breaker.status(), 'fallback_chains': circuit_breaker.fallback_chains}
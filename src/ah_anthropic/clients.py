@@ -0,0 +1,220 @@
+"""Pool of Anthropic clients across several API keys / workspaces.
+
+Keys are read from ANTHROPIC_API_KEYS (comma separated) and fall back to the
+single ANTHROPIC_API_KEY. Each key keeps its own backoff, health and
+rate-limit headroom so one throttled workspace does not stall the others.
+Sessions stick to the key they first used so their prompt cache stays warm.
+"""
+import os
+import time
+import inspect
+from collections import OrderedDict
+from datetime import datetime
+import anthropic
+from anthropic import AsyncStream
+from anthropic.types import Message, RawMessageStreamEvent
+from lib.utils.backoff import ExponentialBackoff
+from .recorder import maybe_record
+from .shared_state import shared_state, key_id, READ_CACHE_SECONDS
+
+MAX_STICKY_SESSIONS = 10000
+UNHEALTHY_AFTER_FAILURES = 3
+UNHEALTHY_SECONDS = 60.0
+AUTH_FAILURE_SECONDS = 600.0
+# Makes the SDK return the raw response (with headers), as with_raw_response does
+RAW_RESPONSE_HEADER = 'X-Stainless-Raw-Response'
+
+RATE_LIMIT_HEADERS = {
+    'requests': 'anthropic-ratelimit-requests',
+    'tokens': 'anthropic-ratelimit-tokens',
+    'input_tokens': 'anthropic-ratelimit-input-tokens',
+    'output_tokens': 'anthropic-ratelimit-output-tokens',
+}
+
+
+def load_api_keys():
+    """Return the configured API keys, or [None] to let the SDK use its defaults"""
+    keys = [k.strip() for k in os.environ.get('ANTHROPIC_API_KEYS', '').split(',') if k.strip()]
+    if not keys and os.environ.get('ANTHROPIC_API_KEY'):
+        keys = [os.environ['ANTHROPIC_API_KEY']]
+    return keys or [None]
+
+
+def session_id_for(context):
+    """Identify the chat session a request belongs to, if any"""
+    if context is None:
+        return None
+    return getattr(context, 'log_id', None)
+
+
+def _parse_reset(value):
+    """Rate limit reset headers are RFC 3339 timestamps"""
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+    except (AttributeError, ValueError):
+        return None
+
+
+class ApiKeyState:
+    """Client, backoff, health and rate-limit headroom for one API key"""
+
+    def __init__(self, api_key, index):
+        self.index = index
+        self.id = key_id(api_key)
+        self.name = f'key{index}' if not api_key else f'key{index}...{api_key[-4:]}'
+        self.client = anthropic.AsyncAnthropic(api_key=api_key)
+        self.backoff = ExponentialBackoff(initial_delay=2.0, max_delay=32.0, factor=2, jitter=True)
+        self.limits = {}
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+        self.in_flight = 0
+        self._published = 0.0
+
+    def update_from_headers(self, headers):
+        """Record rate-limit headroom from response headers"""
+        if headers is None:
+            return
+        for kind, prefix in RATE_LIMIT_HEADERS.items():
+            limit = headers.get(f'{prefix}-limit')
+            remaining = headers.get(f'{prefix}-remaining')
+            if limit is None or remaining is None:
+                continue
+            try:
+                self.limits[kind] = {'limit': int(limit), 'remaining': int(remaining),
+                                     'reset': _parse_reset(headers.get(f'{prefix}-reset')),
+                                     'updated': time.time()}
+            except ValueError:
+                continue
+        # Other workers cache reads for READ_CACHE_SECONDS, publishing more often gains nothing
+        now = time.time()
+        if shared_state is not None and self.limits and now - self._published >= READ_CACHE_SECONDS:
+            self._published = now
+            shared_state.put(f'ratelimit:{self.id}', self.limits, 60)
+
+    def headroom(self):
+        """Fraction of the tightest rate limit still available (1.0 if unknown)"""
+        now = time.time()
+        limits = dict(self.limits)
+        if shared_state is not None:
+            # Other workers may have seen more recent headers for this key
+            for kind, entry in (shared_state.get(f'ratelimit:{self.id}') or {}).items():
+                if kind not in limits or entry['updated'] > limits[kind]['updated']:
+                    limits[kind] = entry
+        fractions = []
+        for entry in limits.values():
+            if entry['reset'] is not None and entry['reset'] <= now:
+                continue
+            if entry['limit'] > 0:
+                fractions.append(entry['remaining'] / entry['limit'])
+        headroom = min(fractions) if fractions else 1.0
+        # Requests already in flight have not shown up in the headers yet
+        return headroom - 0.01 * self.in_flight
+
+    def _shared_until(self, model):
+        """Latest backoff/unhealthy deadline published by any worker"""
+        if shared_state is None:
+            return 0.0
+        return max(shared_state.get(f'backoff:{self.id}:{model}') or 0.0,
+                   shared_state.get(f'unhealthy:{self.id}') or 0.0)
+
+    def wait_time(self, model):
+        now = time.time()
+        return max(self.backoff.get_wait_time(model), self.unhealthy_until - now,
+                   self._shared_until(model) - now, 0)
+
+    def is_healthy(self):
+        until = self.unhealthy_until
+        if shared_state is not None:
+            until = max(until, shared_state.get(f'unhealthy:{self.id}') or 0.0)
+        return until <= time.time()
+
+    def record_success(self, model):
+        self.backoff.record_success(model)
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+        if shared_state is not None and self._shared_until(model):
+            shared_state.delete(f'backoff:{self.id}:{model}')
+            shared_state.delete(f'unhealthy:{self.id}')
+
+    def record_failure(self, model, error=None):
+        self.backoff.record_failure(model)
+        self.consecutive_failures += 1
+        response = getattr(error, 'response', None)
+        if response is not None:
+            self.update_from_headers(response.headers)
+        if isinstance(error, (anthropic.AuthenticationError, anthropic.PermissionDeniedError)):
+            self.unhealthy_until = time.time() + AUTH_FAILURE_SECONDS
+        elif self.consecutive_failures >= UNHEALTHY_AFTER_FAILURES:
+            self.unhealthy_until = time.time() + UNHEALTHY_SECONDS
+        if shared_state is not None:
+            wait = self.backoff.get_wait_time(model)
+            if wait > 0:
+                shared_state.put(f'backoff:{self.id}:{model}', time.time() + wait, wait)
+            if self.unhealthy_until > time.time():
+                shared_state.put(f'unhealthy:{self.id}', self.unhealthy_until, self.unhealthy_until - time.time())
+
+    def status(self):
+        return {'name': self.name, 'healthy': self.is_healthy(), 'headroom': round(self.headroom(), 3),
+                'in_flight': self.in_flight, 'consecutive_failures': self.consecutive_failures,
+                'limits': dict(self.limits)}
+
+
+class ClientPool:
+    """Routes requests to the key with the most headroom, keeping sessions sticky"""
+
+    def __init__(self, api_keys):
+        self.keys = [ApiKeyState(api_key, i) for i, api_key in enumerate(api_keys)]
+        self._sessions = OrderedDict()
+        # Replaces the API with a local stand-in, e.g. for replaying recordings
+        self.stream_factory = None
+
+    @property
+    def default(self):
+        return self.keys[0]
+
+    def select(self, model, session_id=None):
+        """Pick the key for a request, preferring the session's sticky key"""
+        if session_id is not None and session_id in self._sessions:
+            key = self._sessions[session_id]
+            self._sessions.move_to_end(session_id)
+            if key.wait_time(model) == 0:
+                return key
+        ready = [key for key in self.keys if key.wait_time(model) == 0]
+        if ready:
+            key = max(ready, key=lambda k: k.headroom())
+        else:
+            key = min(self.keys, key=lambda k: k.wait_time(model))
+        if session_id is not None:
+            previous = self._sessions.get(session_id)
+            if previous is not None and previous is not key:
+                print(f"[POOL] Moving session {session_id} from {previous.name} to {key.name}")
+            self._sessions[session_id] = key
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > MAX_STICKY_SESSIONS:
+                self._sessions.popitem(last=False)
+        return key
+
+    async def create_stream(self, key, kwargs, body=None):
+        """Open a streaming Messages request on the given key, recording its rate-limit headers.
+
+        body, if given, is the already encoded JSON of kwargs and is sent as-is.
+        """
+        if self.stream_factory is not None:
+            return await self.stream_factory(key, kwargs)
+        if body is not None:
+            headers = {**(kwargs.get('extra_headers') or {}), RAW_RESPONSE_HEADER: 'true'}
+            raw = await key.client.post('/v1/messages', cast_to=Message, body=body, options={'headers': headers},
+                                        stream=True, stream_cls=AsyncStream[RawMessageStreamEvent])
+        else:
+            raw = await key.client.messages.with_raw_response.create(**kwargs)
+        key.update_from_headers(raw.headers)
+        stream = raw.parse()
+        if inspect.isawaitable(stream):
+            stream = await stream
+        return maybe_record(stream, kwargs)
+
+    def status(self):
+        return [key.status() for key in self.keys]
+
+
+client_pool = ClientPool(load_api_keys())
@@ -0,0 +1,77 @@
+"""Batch small stream deltas into fewer, larger chunks.
+
+Anthropic sends many tiny content_block_delta events and yielding each one
+means one websocket frame per few characters downstream. coalesce_stream
+buffers chunks and yields them joined once max_latency has passed since the
+first buffered chunk or max_chars have accumulated. The first chunk is
+always passed straight through so time to first token is unchanged. Once
+max_chars are buffered the source is not read again until the consumer
+takes them, so a slow consumer holds back upstream instead of growing the
+buffer.
+"""
+import os
+import asyncio
+
+COALESCE_MS = float(os.environ.get('MR_ANTHROPIC_COALESCE_MS', '0'))
+COALESCE_MAX_CHARS = int(os.environ.get('MR_ANTHROPIC_COALESCE_MAX_CHARS', '4096'))
+
+
+async def coalesce_stream(stream, max_latency, max_chars=COALESCE_MAX_CHARS):
+    buffer = []
+    state = {'size': 0, 'done': False, 'error': None}
+    has_data = asyncio.Event()
+    is_full = asyncio.Event()
+    has_room = asyncio.Event()
+    has_room.set()
+
+    async def pump():
+        try:
+            async for chunk in stream:
+                buffer.append(chunk)
+                state['size'] += len(chunk)
+                has_data.set()
+                if state['size'] >= max_chars:
+                    is_full.set()
+                    has_room.clear()
+                    await has_room.wait()
+        except Exception as e:
+            state['error'] = e
+        finally:
+            state['done'] = True
+            has_data.set()
+            is_full.set()
+
+    pump_task = asyncio.ensure_future(pump())
+    first = True
+    try:
+        while True:
+            await has_data.wait()
+            if not first and not state['done'] and state['size'] < max_chars:
+                try:
+                    await asyncio.wait_for(is_full.wait(), max_latency)
+                except asyncio.TimeoutError:
+                    pass
+            first = False
+            if buffer:
+                text = ''.join(buffer)
+                buffer.clear()
+                state['size'] = 0
+                has_room.set()
+                yield text
+            if state['done'] and not buffer:
+                break
+            if not buffer:
+                has_data.clear()
+            if not state['done'] and state['size'] < max_chars:
+                is_full.clear()
+        if state['error'] is not None:
+            raise state['error']
+    finally:
+        if not pump_task.done():
+            # Cancelling the pump propagates into the source stream, which closes upstream
+            pump_task.cancel()
+            try:
+                await pump_task
+            except asyncio.CancelledError:
+                pass
+        await stream.aclose()
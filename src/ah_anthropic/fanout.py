@@ -0,0 +1,77 @@
+"""Bounded-concurrency fan-out over stream_chat."""
+import asyncio
+from lib.providers.services import service
+from .mod import stream_chat, DEFAULT_MODEL
+from .clients import client_pool, session_id_for
+from .normalized import normalize_message
+
+
+async def _run_one(index, request, semaphore, gate, leader_event, context):
+    request = dict(request)
+    request.setdefault('context', context)
+    parent_session = session_id_for(request['context'])
+    if parent_session is not None:
+        # Each item is its own conversation; sharing the parent's session would overwrite its state
+        request.setdefault('session_id', f'{parent_session}/fanout/{index}')
+    if leader_event is not None:
+        # Followers start once the leader's prompt is processed, not on its first (synthetic) chunk
+        request['on_start'] = leader_event.set
+    model = request.get('model') or DEFAULT_MODEL
+    if gate is not None:
+        # Let the first request with this system prompt write the cache first
+        await gate.wait()
+    async with semaphore:
+        try:
+            # Don't start new work on a model that is backing off
+            wait_time = min(key.wait_time(model) for key in client_pool.keys)
+            if wait_time > 0:
+                await asyncio.sleep(wait_time)
+            stream = await stream_chat(**request)
+            chunks = []
+            async for chunk in stream:
+                chunks.append(chunk)
+            return {'index': index, 'result': ''.join(chunks)}
+        except Exception as e:
+            print(f"Error in stream_chat_many item {index}: {e}")
+            return {'index': index, 'error': e}
+        finally:
+            if leader_event is not None:
+                leader_event.set()
+
+
+@service()
+async def stream_chat_many(requests, concurrency=4, context=None):
+    """Run several stream_chat requests with at most `concurrency` in flight.
+
+    Each request is a dict of stream_chat arguments. Requests sharing a system
+    prompt wait for the first of them to start streaming, so they read its
+    prompt cache instead of each writing their own. Each request gets its own
+    session, '<log_id>/fanout/<index>', so it does not replace the parent
+    session's cache plan, sticky key or keep-warm state.
+
+    Returns an async generator of {'index': i, 'result': text} or
+    {'index': i, 'error': exception} dicts in completion order.
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    leaders = {}
+    tasks = []
+    for index, request in enumerate(requests):
+        messages = request.get('messages') or []
+        gate = leader_event = None
+        if messages:
+            group = normalize_message(messages[0]).fingerprint
+            if group in leaders:
+                gate = leaders[group]
+            else:
+                leader_event = leaders[group] = asyncio.Event()
+        tasks.append(asyncio.ensure_future(_run_one(index, request, semaphore, gate, leader_event, context)))
+
+    async def results():
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    return results()
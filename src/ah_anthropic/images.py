@@ -0,0 +1,200 @@
+"""Content-hashed image interning and Files API references.
+
+Base64 images are hashed once per string object and interned by digest, so
+repeated screenshots share one copy and are fingerprinted by their digest
+rather than by megabytes of base64. With MR_ANTHROPIC_IMAGE_FILES enabled,
+each image is uploaded once per API key through the Files API and later
+requests reference it by file_id instead of carrying the bytes. The
+interned images are bounded by their total base64 size,
+MR_ANTHROPIC_IMAGE_CACHE_MB; an image's uploaded files live as long as it
+stays interned and are deleted when it is evicted. Images nested in
+tool_result content (screenshots) are handled like top-level ones.
+"""
+import os
+import base64
+import hashlib
+import asyncio
+from collections import OrderedDict
+
+IMAGE_FILES_ENABLED = os.environ.get('MR_ANTHROPIC_IMAGE_FILES', '').lower() in ('1', 'true', 'yes')
+FILES_BETA = 'files-api-2025-04-14'
+IMAGE_CACHE_BYTES = int(float(os.environ.get('MR_ANTHROPIC_IMAGE_CACHE_MB', '256')) * 1024 * 1024)
+
+EXTENSIONS = {'image/png': 'png', 'image/jpeg': 'jpg', 'image/gif': 'gif', 'image/webp': 'webp'}
+
+
+def is_base64_image(block):
+    return (isinstance(block, dict) and block.get('type') == 'image'
+            and isinstance(block.get('source'), dict) and block['source'].get('type') == 'base64')
+
+
+def nested_content(block):
+    """The content list inside a block (e.g. a tool_result), or None"""
+    content = block.get('content') if isinstance(block, dict) else None
+    return content if isinstance(content, list) else None
+
+
+def iter_base64_images(blocks):
+    """Base64 image blocks among blocks and inside their nested content"""
+    for block in blocks:
+        if is_base64_image(block):
+            yield block
+        else:
+            content = nested_content(block)
+            if content:
+                yield from iter_base64_images(content)
+
+
+def replace_blocks(blocks, replace):
+    """blocks with replace(block) applied at any depth; returns the same list if nothing changed"""
+    result = None
+    for i, block in enumerate(blocks):
+        new = replace(block)
+        if new is None:
+            content = nested_content(block)
+            new_content = replace_blocks(content, replace) if content else content
+            new = block if new_content is content else dict(block, content=new_content)
+        if new is not block:
+            if result is None:
+                result = list(blocks)
+            result[i] = new
+    return blocks if result is None else result
+
+
+class ImageStore:
+    def __init__(self, max_bytes=IMAGE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        # id(data) -> (data, digest); holding data keeps the id valid
+        self._digests = OrderedDict()
+        self._digests_size = 0
+        # digest -> canonical image block
+        self._interned = OrderedDict()
+        self._interned_size = 0
+        # digest -> {key name: (key, file_id)}, dropped (and the files deleted) with the interned image
+        self._file_ids = {}
+        self._uploads = {}
+
+    def digest(self, data):
+        """Content hash of base64 image data, computed once per string object"""
+        cached = self._digests.get(id(data))
+        if cached is not None and cached[0] is data:
+            self._digests.move_to_end(id(data))
+            return cached[1]
+        digest = hashlib.blake2b(data.encode('ascii'), digest_size=16).hexdigest()
+        if len(data) > self.max_bytes:
+            return digest
+        replaced = self._digests.pop(id(data), None)
+        if replaced is not None:
+            self._digests_size -= len(replaced[0])
+        self._digests[id(data)] = (data, digest)
+        self._digests_size += len(data)
+        while self._digests_size > self.max_bytes:
+            _, (dropped, _) = self._digests.popitem(last=False)
+            self._digests_size -= len(dropped)
+        return digest
+
+    def intern(self, block):
+        """Return (canonical block, digest) for a base64 image block"""
+        data = block['source']['data']
+        digest = self.digest(data)
+        canonical = self._interned.get(digest)
+        if canonical is not None:
+            self._interned.move_to_end(digest)
+            return canonical, digest
+        if len(data) > self.max_bytes:
+            return block, digest
+        self._interned[digest] = block
+        self._interned_size += len(data)
+        while self._interned_size > self.max_bytes:
+            dropped_digest, dropped = self._interned.popitem(last=False)
+            self._interned_size -= len(dropped['source']['data'])
+            self._forget_files(dropped_digest)
+        return block, digest
+
+    def _forget_files(self, digest):
+        files = self._file_ids.pop(digest, None)
+        if not files:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            print(f"[IMAGES] No event loop, not deleting {len(files)} uploaded file(s) of {digest}")
+            return
+        for key, file_id in files.values():
+            loop.create_task(self._delete(key, file_id))
+
+    async def _delete(self, key, file_id):
+        try:
+            await key.client.beta.files.delete(file_id)
+            print(f"[IMAGES] Deleted {file_id} on {key.name}")
+        except Exception as e:
+            print(f"[IMAGES] Error deleting {file_id} on {key.name}: {e}")
+
+    def interned(self, digest):
+        """The canonical block for a digest, if it is still interned"""
+        return self._interned.get(digest)
+
+    async def _upload(self, key, digest, source):
+        media_type = source.get('media_type', 'image/png')
+        name = f"{digest}.{EXTENSIONS.get(media_type, 'bin')}"
+        data = base64.b64decode(source['data'])
+        metadata = await key.client.beta.files.upload(file=(name, data, media_type))
+        print(f"[IMAGES] Uploaded {name} ({len(data)} bytes) as {metadata.id} on {key.name}")
+        return metadata.id
+
+    async def file_id(self, key, block):
+        """file_id of the image on this key, uploading it the first time.
+
+        None for an image too large to intern: its file could never be deleted.
+        """
+        _, digest = self.intern(block)
+        if digest not in self._interned:
+            return None
+        files = self._file_ids.get(digest)
+        if files is not None and key.name in files:
+            return files[key.name][1]
+        cache_key = (key.name, digest)
+        upload = self._uploads.get(cache_key)
+        if upload is None:
+            upload = self._uploads[cache_key] = asyncio.ensure_future(self._upload(key, digest, block['source']))
+        try:
+            file_id = await upload
+        finally:
+            self._uploads.pop(cache_key, None)
+        if digest not in self._interned:
+            # Evicted during the upload; intern again so the file is tracked and deleted later
+            self.intern(block)
+        self._file_ids.setdefault(digest, {})[key.name] = (key, file_id)
+        return file_id
+
+    async def apply_file_refs(self, formatted_messages, key):
+        """Replace base64 images with file references for this key.
+
+        Returns (messages, used_files). Messages without images are reused
+        as-is; if any upload fails the original messages are returned.
+        """
+        if not IMAGE_FILES_ENABLED:
+            return formatted_messages, False
+        images = [block for message in formatted_messages for block in iter_base64_images(message['content'])]
+        if not images:
+            return formatted_messages, False
+        try:
+            file_ids = await asyncio.gather(*[self.file_id(key, block) for block in images])
+        except Exception as e:
+            print(f"[IMAGES] Upload failed, sending images inline: {e}")
+            return formatted_messages, False
+        by_block = {id(block): file_id for block, file_id in zip(images, file_ids) if file_id is not None}
+        if not by_block:
+            return formatted_messages, False
+
+        def to_file_ref(block):
+            file_id = by_block.get(id(block))
+            return dict(block, source={'type': 'file', 'file_id': file_id}) if file_id is not None else None
+        result = []
+        for message in formatted_messages:
+            content = replace_blocks(message['content'], to_file_ref)
+            result.append(message if content is message['content'] else dict(message, content=content))
+        return result, True
+
+
+image_store = ImageStore()
@@ -0,0 +1,189 @@
+"""Concurrency load test for stream_chat against a local fake Messages endpoint.
+
+The fake endpoint runs in a separate process and streams SSE events at a
+configurable token rate. For each concurrency level the driver starts that
+many stream_chat sessions at once and reports memory per active stream,
+event-loop lag, throughput and p50/p99 time to first token.
+
+    python -m ah_anthropic.loadtest --concurrency 10,100,1000 --tokens 200 --rate 50
+"""
+import json
+import time
+import asyncio
+import argparse
+import tracemalloc
+import multiprocessing
+from types import SimpleNamespace
+
+
+def _sse(event):
+    return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode('utf-8')
+
+
+async def _serve_messages(reader, writer, tokens, rate, ttft):
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+        length = 0
+        for line in head.decode('latin-1').split('\r\n'):
+            if line.lower().startswith('content-length:'):
+                length = int(line.split(':', 1)[1])
+        body = json.loads(await reader.readexactly(length)) if length else {}
+        writer.write(b'HTTP/1.1 200 OK\r\ncontent-type: text/event-stream\r\n'
+                     b'cache-control: no-cache\r\nconnection: close\r\n\r\n')
+        await asyncio.sleep(ttft)
+        usage = {'input_tokens': 10, 'output_tokens': 1, 'cache_creation_input_tokens': 0, 'cache_read_input_tokens': 0}
+        writer.write(_sse({'type': 'message_start', 'message': {
+            'id': 'msg_loadtest', 'type': 'message', 'role': 'assistant', 'model': body.get('model', 'fake'),
+            'content': [], 'stop_reason': None, 'stop_sequence': None, 'usage': usage}}))
+        writer.write(_sse({'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}}))
+        for _ in range(tokens):
+            writer.write(_sse({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': ' tok'}}))
+            await writer.drain()
+            if rate:
+                await asyncio.sleep(1.0 / rate)
+        writer.write(_sse({'type': 'content_block_stop', 'index': 0}))
+        writer.write(_sse({'type': 'message_delta', 'delta': {'stop_reason': 'end_turn', 'stop_sequence': None},
+                           'usage': {'output_tokens': tokens}}))
+        writer.write(_sse({'type': 'message_stop'}))
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+def run_fake_endpoint(port_queue, tokens, rate, ttft):
+    """Serve a fake streaming Messages endpoint until the process is killed"""
+    async def main():
+        server = await asyncio.start_server(
+            lambda r, w: _serve_messages(r, w, tokens, rate, ttft), '127.0.0.1', 0, backlog=4096)
+        port_queue.put(server.sockets[0].getsockname()[1])
+        async with server:
+            await server.serve_forever()
+    asyncio.run(main())
+
+
+def _percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+class _NullContext(SimpleNamespace):
+    async def track_usage(self, *args, **kwargs):
+        pass
+
+
+async def _measure_loop_lag(samples, stop, interval=0.01):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - start - interval)
+
+
+async def run_level(concurrency, prompt_chars=2000):
+    from .mod import stream_chat
+
+    ttfts = []
+    active = {'now': 0, 'peak': 0, 'peak_memory': 0}
+    output_chars = [0]
+    errors = [0]
+    prompt = 'x' * prompt_chars
+
+    async def session(i):
+        context = _NullContext(log_id=f'loadtest-{i}', agent={'thinking_level': 'off'})
+        messages = [{'role': 'system', 'content': 'You are a load test.'}, {'role': 'user', 'content': prompt}]
+        start = time.perf_counter()
+        first = True
+        try:
+            stream = await stream_chat(model='loadtest-model', messages=messages, context=context)
+            async for chunk in stream:
+                if first:
+                    ttfts.append(time.perf_counter() - start)
+                    first = False
+                    active['now'] += 1
+                    if active['now'] > active['peak']:
+                        active['peak'] = active['now']
+                        active['peak_memory'] = tracemalloc.get_traced_memory()[0]
+                output_chars[0] += len(chunk)
+        except Exception as e:
+            errors[0] += 1
+            print(f"Load test session {i} failed: {e}")
+        finally:
+            if not first:
+                active['now'] -= 1
+
+    lag_samples = []
+    stop = asyncio.Event()
+    lag_task = asyncio.ensure_future(_measure_loop_lag(lag_samples, stop))
+    baseline_memory = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    await asyncio.gather(*[session(i) for i in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await lag_task
+    per_stream = None
+    if tracemalloc.is_tracing() and active['peak']:
+        per_stream = (active['peak_memory'] - baseline_memory) / active['peak']
+    return {
+        'concurrency': concurrency,
+        'errors': errors[0],
+        'peak_active_streams': active['peak'],
+        'memory_per_stream_bytes': int(per_stream) if per_stream is not None else None,
+        'loop_lag_p50_ms': round(_percentile(lag_samples, 50) * 1000, 2) if lag_samples else None,
+        'loop_lag_p99_ms': round(_percentile(lag_samples, 99) * 1000, 2) if lag_samples else None,
+        'loop_lag_max_ms': round(max(lag_samples) * 1000, 2) if lag_samples else None,
+        'ttft_p50_ms': round(_percentile(ttfts, 50) * 1000, 2) if ttfts else None,
+        'ttft_p99_ms': round(_percentile(ttfts, 99) * 1000, 2) if ttfts else None,
+        'streams_per_second': round(concurrency / elapsed, 2),
+        'output_chars_per_second': round(output_chars[0] / elapsed, 2),
+        'elapsed_seconds': round(elapsed, 3),
+    }
+
+
+async def run_load_test(levels, base_url, prompt_chars=2000, trace_memory=True):
+    import anthropic
+    import httpx
+    from .clients import client_pool
+
+    limits = httpx.Limits(max_connections=max(levels) * 2, max_keepalive_connections=0)
+    for key in client_pool.keys:
+        key.client = anthropic.AsyncAnthropic(
+            api_key='loadtest', base_url=base_url, max_retries=0,
+            http_client=anthropic.DefaultAsyncHttpxClient(limits=limits, timeout=120.0))
+    if trace_memory:
+        # tracemalloc slows allocation-heavy code down noticeably
+        tracemalloc.start()
+    reports = []
+    try:
+        for level in levels:
+            report = await run_level(level, prompt_chars)
+            print(json.dumps(report))
+            reports.append(report)
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+    return reports
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test stream_chat against a local fake endpoint')
+    parser.add_argument('--concurrency', default='10,100,1000', help='comma separated concurrency levels')
+    parser.add_argument('--tokens', type=int, default=200, help='output tokens per response')
+    parser.add_argument('--rate', type=float, default=50.0, help='tokens per second per stream (0 = unthrottled)')
+    parser.add_argument('--ttft', type=float, default=0.2, help='seconds before the first event')
+    parser.add_argument('--prompt-chars', type=int, default=2000)
+    parser.add_argument('--no-memory', action='store_true', help='skip tracemalloc memory measurement')
+    args = parser.parse_args()
+
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=run_fake_endpoint, args=(port_queue, args.tokens, args.rate, args.ttft),
+                                     daemon=True)
+    server.start()
+    try:
+        port = port_queue.get(timeout=10)
+        levels = [int(level) for level in args.concurrency.split(',') if level.strip()]
+        asyncio.run(run_load_test(levels, f'http://127.0.0.1:{port}', args.prompt_chars, not args.no_memory))
+    finally:
+        server.terminate()
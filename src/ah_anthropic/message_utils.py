@@ -78,3 +78,29 @@ def compare_messages(previous_messages, current_messages):
         print(f'\033[94m[CACHE] Changed message indices: {changed_indices}\033[0m')
             
     return changed_indices
+
+def compare_fingerprints(previous_fingerprints, current_fingerprints):
+    """
+    Same as compare_messages, but on message fingerprints instead of
+    deep-comparing message contents.
+
+    Args:
+        previous_fingerprints: Sequence of fingerprints from the previous call
+        current_fingerprints: Sequence of fingerprints for the current call
+
+    Returns:
+        changed_indices: List of indices where messages differ
+    """
+    if not previous_fingerprints:
+        print('\033[94m[CACHE] First run - all messages are new\033[0m')
+        return list(range(len(current_fingerprints)))
+
+    changed_indices = [i for i, fingerprint in enumerate(current_fingerprints)
+                       if i >= len(previous_fingerprints) or previous_fingerprints[i] != fingerprint]
+
+    if not changed_indices:
+        print('\033[92m[CACHE] No changes detected in messages\033[0m')
+    else:
+        print(f'\033[94m[CACHE] Changed message indices: {changed_indices}\033[0m')
+
+    return changed_indices
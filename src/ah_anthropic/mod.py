@@ -6,54 +6,69 @@ import base64
 from io import BytesIO
 import sys
 import json
-from .message_utils import compare_messages
+import time
+import hashlib
+from collections import OrderedDict
+from .message_utils import compare_messages, compare_fingerprints
+from .normalized import normalize_messages
 from .usage_tracking import *
-from lib.utils.backoff import ExponentialBackoff
-client = anthropic.AsyncAnthropic(api_key=os.environ.get('ANTHROPIC_API_KEY'))
-anthropic_backoff_manager = ExponentialBackoff(initial_delay=2.0, max_delay=32.0, factor=2, jitter=True)
+from .clients import client_pool, session_id_for
+from .stream_control import UpstreamHandle, StreamIdleTimeout, iterate_with_idle_timeout, stream_metrics, STREAM_IDLE_RETRIES, get_stream_metrics
+from .stop_conditions import make_stop_condition, stop_sequences_for
+from .images import image_store, FILES_BETA
+from .circuits import circuit_breaker, is_request_error, get_circuit_status
+from .thinking_blocks import thinking_store, TurnCapture, TextDigest, REPLAY_THINKING, strip_thinking, get_thinking_blocks
+from .sink import SinkWriter, drain_to_sink
+from .body_encoding import body_cache, message_keys, PREENCODE_ENABLED
+from .routing import model_router, get_routing_log
+from .output_sizing import output_sizer, model_limits, agent_name_for, continuation_messages, MAX_CONTINUATIONS, get_output_sizing
+from .plan_store import session_plans, get_cache_plan
+from .scheduler import request_scheduler, get_scheduler_status
+from .coalesce import coalesce_stream, COALESCE_MS
+from .cache_warming import cache_warmer, cache_control_marker, beta_headers, set_cache_keep_warm
+# Default client and backoff are those of the first configured key
+client = client_pool.default.client
+anthropic_backoff_manager = client_pool.default.backoff
 
 # need traceback for error stack trace
 from traceback import format_exc
 
 MAX_RETRIES = 8
-_last_messages = []
-
-def prepare_message_content(message):
-    """Convert message content to proper format without modifying original"""
-    msg_copy = dict(message)
-    if isinstance(msg_copy.get('content'), str):
-        msg_copy['content'] = [{'type': 'text', 'text': msg_copy['content']}]
-    return msg_copy
+DEFAULT_MODEL = 'claude-3-7-sonnet-latest'
+# Pixel digest of a PIL image -> digest of its interned PNG encoding
+_encoded_images = OrderedDict()
+MAX_ENCODED_IMAGES = 4096
 
 def prepare_system_message(message):
     """Prepare the system message with cache control"""
     if isinstance(message['content'], str):
-        return [{'type': 'text', 'text': message['content'], 'cache_control': {'type': 'ephemeral'}}]
+        return [{'type': 'text', 'text': message['content'], 'cache_control': cache_control_marker()}]
     else:
         text = message['content'][0]['text']
-        return [{'type': 'text', 'text': text, 'cache_control': {'type': 'ephemeral'}}]
-
-def prepare_formatted_messages(messages):
-    """Format all non-system messages and remove existing cache control"""
-    formatted_messages = [prepare_message_content(msg) for msg in messages]
-    for message in formatted_messages:
-        if isinstance(message['content'], list):
-            for content in message['content']:
-                if 'cache_control' in content:
-                    del content['cache_control']
-    return formatted_messages
+        return [{'type': 'text', 'text': text, 'cache_control': cache_control_marker()}]
 
-def apply_message_caching(formatted_messages, last_messages):
-    """Apply caching strategy to messages and return updated messages"""
-    changed_indices = compare_messages(last_messages, formatted_messages)
-    cache_candidates = [i for i in range(len(formatted_messages)) if i not in changed_indices]
+def plan_message_caching(normalized_messages, last_fingerprints):
+    """Choose cache breakpoints as a set of (message index, block index) pairs"""
+    fingerprints = [message.fingerprint for message in normalized_messages]
+    changed_indices = set(compare_fingerprints(last_fingerprints, fingerprints))
+    cache_candidates = [i for i in range(len(normalized_messages)) if i not in changed_indices]
     messages_to_cache = cache_candidates[-3:] if len(cache_candidates) > 3 else cache_candidates
+    breakpoints = set()
     cached_count = 1
     for i in messages_to_cache:
-        for content in formatted_messages[i]['content']:
-            if cached_count < 3 and content['type'] == 'text':
-                content['cache_control'] = {'type': 'ephemeral'}
+        for j, content in enumerate(normalized_messages[i].blocks):
+            if cached_count < 3 and content.get('type') == 'text':
+                breakpoints.add((i, j))
                 cached_count += 1
+    return breakpoints
+
+def serialize_messages(normalized_messages, breakpoints):
+    """Build the API message list, overlaying cache_control at the breakpoints"""
+    formatted_messages = []
+    marker = cache_control_marker()
+    for i, message in enumerate(normalized_messages):
+        cached_blocks = {j for (m, j) in breakpoints if m == i}
+        formatted_messages.append(message.to_wire(cached_blocks, marker))
     return formatted_messages
 
 def get_thinking_budget(context):
@@ -70,7 +85,7 @@ def get_thinking_budget(context):
     except ValueError:
         return budgets['medium']
 
-async def handle_stream_chunk(chunk, total_output, model, context, in_thinking_block):
+async def handle_stream_chunk(chunk, output_length, model, context, in_thinking_block):
     """Process a single chunk from the stream and yield appropriate content"""
     debug_log_response(chunk)
     if chunk.type == 'message_start':
@@ -91,102 +106,322 @@ async def handle_stream_chunk(chunk, total_output, model, context, in_thinking_b
             return ('', False)
         return ('', in_thinking_block)
     elif chunk.type == 'message_delta':
-        await track_message_delta(chunk, total_output, model, context)
+        await track_message_delta(chunk, output_length, model, context)
         return ('', in_thinking_block)
     else:
         return ('', in_thinking_block)
     return ('', in_thinking_block)
 
+def _in_flight_release(key, release_slot=None):
+    def release():
+        key.in_flight -= 1
+        if release_slot is not None:
+            release_slot()
+    return release
+
 @service()
-async def stream_chat(model=None, messages=[], context=None, num_ctx=200000, temperature=0.0, max_tokens=32000, num_gpu_layers=0):
-    global _last_messages
-    if model is None:
-        model_name = 'claude-3-7-sonnet-latest'
-    else:
+async def stream_chat(model=None, messages=[], context=None, num_ctx=200000, temperature=0.0, max_tokens=32000, num_gpu_layers=0, stop=None, coalesce_ms=COALESCE_MS, sink=None, thinking_budget=None, on_start=None, session_id=None):
+    """Stream a chat completion.
+
+    stop ends generation early: a string or list of strings is sent to the API
+    as stop_sequences, while a callable predicate on the recent text (the
+    last STOP_PREDICATE_WINDOW characters), a StopCondition, or one of 'json_closed' / 'first_command' is checked
+    client-side and closes the upstream stream as soon as it matches.
+
+    coalesce_ms batches small deltas into chunks delivered at most every
+    coalesce_ms milliseconds (0 yields every delta as it arrives).
+
+    With a sink (file, async writer or callable) the output is written there
+    instead, in constant memory, and stream_chat returns the character and
+    byte counts and checksums once generation ends. Truncated responses are
+    not continued and thinking blocks are not kept for replay in this mode.
+
+    thinking_budget overrides the agent's thinking_level / MR_THINKING_LEVEL
+    (0 turns thinking off).
+
+    on_start is called once, when the first upstream event (message_start)
+    arrives; by then the prompt has been processed and its cache written.
+
+    session_id keys the per-session state (cache plan, sticky key, keep-warm
+    and thinking replay); it defaults to the context's log_id.
+    """
+    started = time.time()
+    if session_id is None:
+        session_id = session_id_for(context)
+    system = prepare_system_message(messages[0])
+    normalized_messages = thinking_store.restore(session_id, normalize_messages(messages[1:]))
+    breakpoints = plan_message_caching(normalized_messages, session_plans.fingerprints(session_id))
+    session_plans.put(session_id, [message.fingerprint for message in normalized_messages], breakpoints)
+    formatted_messages = serialize_messages(normalized_messages, breakpoints)
+    stop_condition = make_stop_condition(stop)
+    stop_sequences = stop_sequences_for(stop)
+    agent_name = agent_name_for(context)
+    input_tokens = (sum(len(block.get('text', '')) for block in system) // 4
+                    + sum(message.approx_tokens for message in normalized_messages))
+    requested_budget = get_thinking_budget(context) if thinking_budget is None else thinking_budget
+    routing_decision = None
+    if model is not None:
         model_name = model
+    elif model_router.enabled:
+        model_name, routing_decision = model_router.route(DEFAULT_MODEL, normalized_messages, input_tokens, context,
+                                                          thinking=requested_budget > 0)
+    else:
+        model_name = DEFAULT_MODEL
     for attempt_num in range(MAX_RETRIES + 1):
+        # Goes to a fallback model while the requested model's circuit is open
+        attempt_model = circuit_breaker.choose_model(model_name)
+        key = client_pool.select(attempt_model, session_id)
+        release_slot = None
         try:
-            wait_time = anthropic_backoff_manager.get_wait_time(model_name)
+            wait_time = key.wait_time(attempt_model)
             if wait_time > 0:
                 await asyncio.sleep(wait_time)
-            messages = [dict(message) for message in messages]
+            # Interactive requests get slots ahead of queued background work
+            release_slot = await request_scheduler.acquire(context)
+            # Sizing also applies the attempt model's output limit and thinking support
+            budget = requested_budget
             if max_tokens == 32000:
-                max_tokens = os.environ.get('MR_MAX_TOKENS', 4000)
-                max_tokens = int(max_tokens)
-            thinking_budget = get_thinking_budget(context)
-            thinking_enabled = thinking_budget > 0
-            system = prepare_system_message(messages[0])
-            formatted_messages = prepare_formatted_messages(messages[1:])
-            formatted_messages = apply_message_caching(formatted_messages, _last_messages)
-            _last_messages = formatted_messages.copy()
-            kwargs = {'model': model_name, 'system': system, 'messages': formatted_messages, 'temperature': temperature, 'max_tokens': max_tokens, 'stream': True, 'extra_headers': {'anthropic-beta': 'prompt-caching-2024-07-31,output-128k-2025-02-19'}}
+                # Not set by the caller: size from observed output lengths
+                default_tokens = budget * 2 if budget > 0 else int(os.environ.get('MR_MAX_TOKENS', 4000))
+                request_max_tokens, budget = output_sizer.size(agent_name, attempt_model, default_tokens, budget, input_tokens, num_ctx)
+            else:
+                request_max_tokens, budget = output_sizer.size(agent_name, attempt_model, max_tokens, budget, input_tokens, num_ctx, adaptive=False)
+            print(f"max_tokens {request_max_tokens}, thinking budget {budget}")
+            thinking_enabled = budget > 0
+            request_messages, uses_files = await image_store.apply_file_refs(formatted_messages, key)
+            encoding_variant = key.name if uses_files else None
+            if not model_limits(attempt_model)[1]:
+                # A fallback model without thinking support rejects replayed thinking blocks
+                request_messages = strip_thinking(request_messages)
+                encoding_variant = (encoding_variant, 'no-thinking')
+            extra_headers = beta_headers(FILES_BETA) if uses_files else beta_headers()
+            kwargs = {'model': attempt_model, 'system': system, 'messages': request_messages, 'temperature': temperature, 'max_tokens': request_max_tokens, 'stream': True, 'extra_headers': extra_headers}
             if thinking_enabled:
-                kwargs['thinking'] = {'type': 'enabled', 'budget_tokens': thinking_budget}
+                kwargs['thinking'] = {'type': 'enabled', 'budget_tokens': budget}
                 kwargs['temperature'] = 1
-                max_tokens = thinking_budget * 2
-                print(f"Override max tokens since thinking enabled: {max_tokens}")
-                kwargs['max_tokens'] = max_tokens
-            if 'fable' in model_name or 'opus' in model_name:
+            if 'fable' in attempt_model or 'opus' in attempt_model:
                 kwargs.pop('temperature', None)
-            original_stream = await client.messages.create(**kwargs)
-            anthropic_backoff_manager.record_success(model_name)
+            if stop_sequences:
+                kwargs['stop_sequences'] = stop_sequences
+            # Only messages that changed since earlier turns are JSON-encoded again
+            body = None
+            if PREENCODE_ENABLED:
+                body = body_cache.request_body(kwargs, message_keys(normalized_messages, breakpoints, encoding_variant))
+            original_stream = await client_pool.create_stream(key, kwargs, body)
+            key.record_success(attempt_model)
+            circuit_breaker.record_success(attempt_model)
+            key.in_flight += 1
+            cache_warmer.note_request(session_id, key, kwargs)
+            upstream = UpstreamHandle(original_stream, release=_in_flight_release(key, release_slot))
+            release_slot = None
 
-            async def content_stream():
-                total_output = ''
-                thinking_content = ''
+            async def content_stream(upstream=upstream, key=key, kwargs=kwargs, body=body, attempt_model=attempt_model):
+                # Only lengths are kept so memory does not grow with the output
+                output_length = 0
+                thinking_length = 0
                 in_thinking_block = False
                 thinking_emitted = False
                 need_strip_bracket = False
-                if thinking_enabled:
-                    yield '[{"reasoning": "'
-                    thinking_emitted = True
-                async for chunk in original_stream:
-                    chunk_text, new_thinking_state = await handle_stream_chunk(chunk, total_output, model, context, in_thinking_block)
-                    if new_thinking_state != in_thinking_block:
-                        in_thinking_block = new_thinking_state
-                        if not in_thinking_block and thinking_emitted and (chunk.type == 'content_block_stop'):
-                            # Close reasoning value and object, add comma to continue the array
+                # Whether any upstream output reached the consumer, after which a retry is impossible
+                emitted = False
+                idle_retries = 0
+                stopped_early = False
+                output_tokens = 0
+                continuations = 0
+                # Raw answer text, used as the prefill when continuing a truncated response
+                answer_parts = [] if MAX_CONTINUATIONS > 0 and sink is None else None
+                request_kwargs = kwargs
+                # Original content blocks and a digest of the text the caller receives, to replay thinking later
+                capture = TurnCapture() if thinking_enabled and REPLAY_THINKING and sink is None else None
+                yielded = TextDigest() if capture is not None else None
+                notify_start = on_start
+
+                async def reopen(request_kwargs, body=None):
+                    slot = await request_scheduler.acquire(context)
+                    try:
+                        new_stream = await client_pool.create_stream(key, request_kwargs, body)
+                    except BaseException:
+                        slot()
+                        raise
+                    key.in_flight += 1
+                    return UpstreamHandle(new_stream, release=_in_flight_release(key, slot))
+
+                try:
+                    if thinking_enabled:
+                        if yielded is not None:
+                            yielded.update('[{"reasoning": "')
+                        yield '[{"reasoning": "'
+                        thinking_emitted = True
+                    while True:
+                        stop_reason = None
+                        try:
+                            async for chunk in iterate_with_idle_timeout(upstream.stream):
+                                if capture is not None:
+                                    capture.feed(chunk)
+                                if notify_start is not None and chunk.type == 'message_start':
+                                    notify_start()
+                                    notify_start = None
+                                if chunk.type == 'message_delta':
+                                    stop_reason = chunk.delta.stop_reason
+                                    output_tokens += chunk.usage.output_tokens
+                                chunk_text, new_thinking_state = await handle_stream_chunk(chunk, output_length, attempt_model, context, in_thinking_block)
+                                if new_thinking_state != in_thinking_block:
+                                    in_thinking_block = new_thinking_state
+                                    if not in_thinking_block and thinking_emitted and (chunk.type == 'content_block_stop'):
+                                        # Close reasoning value and object, add comma to continue the array
+                                        emitted = True
+                                        if yielded is not None:
+                                            yielded.update('"}, ')
+                                        yield '"}, '
+                                        need_strip_bracket = True
+                                if chunk_text:
+                                    emitted = True
+                                    if in_thinking_block:
+                                        json_str = json.dumps(chunk_text)
+                                        without_quotes = json_str[1:-1]
+                                        if capture is not None:
+                                            yielded.update(without_quotes)
+                                        yield without_quotes
+                                        thinking_length += len(chunk_text)
+                                    else:
+                                        if answer_parts is not None:
+                                            answer_parts.append(chunk_text)
+                                        if stop_condition is not None:
+                                            cut = stop_condition.feed(chunk_text)
+                                            if cut is not None:
+                                                chunk_text = chunk_text[:cut] + stop_condition.suffix
+                                                stopped_early = True
+                                        # Strip the leading [ from LLM's command array so it merges
+                                        # into the reasoning array
+                                        if need_strip_bracket:
+                                            chunk_text = chunk_text.lstrip()
+                                            if not chunk_text:
+                                                if stopped_early:
+                                                    break
+                                                # Pure whitespace chunk, keep waiting for the bracket
+                                                continue
+                                            elif chunk_text.startswith('['):
+                                                chunk_text = chunk_text[1:]
+                                                need_strip_bracket = False
+                                            else:
+                                                need_strip_bracket = False
+                                        if capture is not None:
+                                            yielded.update(chunk_text)
+                                        yield chunk_text
+                                        output_length += len(chunk_text)
+                                        if stopped_early:
+                                            break
+                        except StreamIdleTimeout as e:
+                            await upstream.close()
+                            if emitted or idle_retries >= STREAM_IDLE_RETRIES:
+                                raise
+                            idle_retries += 1
+                            stream_metrics.idle_retries += 1
+                            print(f"Stream stalled before any output ({e}), retrying")
+                            in_thinking_block = False
+                            if capture is not None:
+                                capture = TurnCapture()
+                            upstream = await reopen(request_kwargs, body if request_kwargs is kwargs else None)
+                            continue
+                        if stop_reason != 'max_tokens' or stopped_early or answer_parts is None or continuations >= MAX_CONTINUATIONS:
+                            break
+                        continuations += 1
+                        print(f"Response hit max_tokens, continuing ({continuations}/{MAX_CONTINUATIONS})")
+                        await upstream.close()
+                        if in_thinking_block:
+                            # Ran out while thinking; close the reasoning entry and answer without it
+                            in_thinking_block = False
                             yield '"}, '
                             need_strip_bracket = True
-                    if chunk_text:
-                        if in_thinking_block:
-                            json_str = json.dumps(chunk_text)
-                            without_quotes = json_str[1:-1]
-                            yield without_quotes
-                            thinking_content += chunk_text
-                        else:
-                            # Strip the leading [ from LLM's command array so it merges
-                            # into the reasoning array
-                            if need_strip_bracket:
-                                chunk_text = chunk_text.lstrip()
-                                if not chunk_text:
-                                    # Pure whitespace chunk, keep waiting for the bracket
-                                    continue
-                                elif chunk_text.startswith('['):
-                                    chunk_text = chunk_text[1:]
-                                    need_strip_bracket = False
-                                else:
-                                    need_strip_bracket = False
-                            yield chunk_text
-                            total_output += chunk_text
+                        # Thinking is dropped for the prefilled continuation, so there is no turn to replay
+                        capture = None
+                        request_kwargs = dict(kwargs, messages=continuation_messages(kwargs['messages'], ''.join(answer_parts)))
+                        request_kwargs.pop('thinking', None)
+                        upstream = await reopen(request_kwargs)
+                    if stopped_early:
+                        stream_metrics.early_stops += 1
+                        await upstream.close()
+                        # No message_delta arrives after closing, so output usage is estimated
+                        await track_early_stop(output_length, thinking_length, attempt_model, context)
+                    else:
+                        output_sizer.record(agent_name, attempt_model, output_tokens)
+                        if routing_decision is not None:
+                            model_router.record_outcome(routing_decision, started, output_tokens, attempt_model)
+                        if capture is not None:
+                            thinking_store.remember(session_id, yielded.digest(), capture)
+                    stream_metrics.completed += 1
+                except (GeneratorExit, asyncio.CancelledError):
+                    stream_metrics.cancelled += 1
+                    raise
+                finally:
+                    await upstream.close()
+            if sink is not None:
+                # Drained outside the retry loop: once written, output must not be retried
+                sink_stream = content_stream()
+                break
+            if coalesce_ms:
+                return coalesce_stream(content_stream(), coalesce_ms / 1000.0)
             return content_stream()
+        except asyncio.CancelledError:
+            if release_slot is not None:
+                release_slot()
+            # If this request was the half-open probe, let the next one probe instead
+            circuit_breaker.release_probe(attempt_model)
+            raise
         except Exception as e:
             trace = format_exc()
             print("Error in anthropic stream_chat",e)
             print(trace)
-            anthropic_backoff_manager.record_failure(model_name)
+            if release_slot is not None:
+                release_slot()
+            circuit_breaker.record_failure(attempt_model, e)
+            if is_request_error(e):
+                # The same request would fail again, and the key is not at fault
+                raise
+            key.record_failure(attempt_model, e)
             if attempt_num < MAX_RETRIES:
-                next_wait = anthropic_backoff_manager.get_wait_time(model_name)
+                next_wait = key.wait_time(attempt_model)
                 continue
             else:
                 raise e
+    return await drain_to_sink(sink_stream, SinkWriter(sink))
+
+@service()
+async def prime_prompt_cache(messages, model=None, context=None):
+    """Write the prompt cache for a session's system prompt ahead of its first turn"""
+    model_name = model or DEFAULT_MODEL
+    key = client_pool.select(model_name, session_id_for(context))
+    kwargs = {'model': model_name, 'system': prepare_system_message(messages[0]), 'extra_headers': beta_headers()}
+    try:
+        return await cache_warmer.prime(key, kwargs)
+    except Exception as e:
+        print(f"Error priming prompt cache: {e}")
+        return None
 
 @service()
 async def format_image_message(pil_image, context=None):
-    buffer = BytesIO()
-    pil_image.save(buffer, format='PNG')
-    image_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-    return {'type': 'image', 'source': {'type': 'base64', 'media_type': 'image/png', 'data': image_base64}}
+    # Keyed by pixel content, which is far cheaper to hash than to PNG-encode;
+    # the image may have been modified since an earlier call
+    pixels = hashlib.blake2b(pil_image.tobytes(), digest_size=16)
+    pixels.update(f'{pil_image.mode}{pil_image.size}'.encode())
+    palette = pil_image.getpalette()
+    if palette:
+        pixels.update(bytes(palette))
+    pixel_digest = pixels.digest()
+    digest = _encoded_images.get(pixel_digest)
+    cached = image_store.interned(digest) if digest is not None else None
+    if cached is None:
+        buffer = BytesIO()
+        pil_image.save(buffer, format='PNG')
+        image_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
+        block = {'type': 'image', 'source': {'type': 'base64', 'media_type': 'image/png', 'data': image_base64}}
+        cached, digest = image_store.intern(block)
+        _encoded_images[pixel_digest] = digest
+        while len(_encoded_images) > MAX_ENCODED_IMAGES:
+            _encoded_images.popitem(last=False)
+    _encoded_images.move_to_end(pixel_digest)
+    # A fresh dict, but the (large) source is shared with earlier encodings
+    return dict(cached)
 
 @service()
 async def get_image_dimensions(context=None):
@@ -0,0 +1,186 @@
+"""Immutable, normalized form of chat messages.
+
+Each caller message is normalized once and reused across turns while the
+caller keeps passing the same (unchanged) message object. Cache breakpoints
+are applied as an overlay when serializing, so neither the caller's dicts
+nor the normalized form are ever copied wholesale or mutated. The cache is
+bounded by the approximate size of the messages it keeps alive,
+MR_ANTHROPIC_MESSAGE_CACHE_MB.
+"""
+import os
+import json
+import hashlib
+from collections import OrderedDict
+from .images import image_store, is_base64_image, nested_content, iter_base64_images, replace_blocks
+
+MESSAGE_CACHE_BYTES = int(float(os.environ.get('MR_ANTHROPIC_MESSAGE_CACHE_MB', '64')) * 1024 * 1024)
+# Rough input token cost of an image, for headroom estimates
+IMAGE_TOKENS = 1600
+
+
+def _strip_cache_control(block):
+    """Return the block without cache_control, reusing it when there is none"""
+    if isinstance(block, dict) and 'cache_control' in block:
+        block = {k: v for k, v in block.items() if k != 'cache_control'}
+    # Identical images, also screenshots inside tool results, share one interned block
+    if is_base64_image(block):
+        return image_store.intern(block)[0]
+    content = nested_content(block)
+    if content:
+        interned = replace_blocks(content, lambda b: image_store.intern(b)[0] if is_base64_image(b) else None)
+        if interned is not content:
+            block = dict(block, content=interned)
+    return block
+
+
+def _fingerprint_view(block):
+    """Images are fingerprinted by content hash instead of their base64 data, at any depth"""
+    if is_base64_image(block):
+        return {'type': 'image', 'media_type': block['source'].get('media_type'),
+                'digest': image_store.digest(block['source']['data'])}
+    content = nested_content(block)
+    if content and any(True for _ in iter_base64_images(content)):
+        return dict(block, content=[_fingerprint_view(b) for b in content])
+    return block
+
+
+# Marks a snapshot node, so it cannot be mistaken for a tuple in the content
+_NODE = object()
+
+
+def _content_snapshot(value):
+    """Identity of every dict and list under the content, with their keys and values.
+
+    Strings and numbers are immutable, so comparing identities down to them
+    tells whether anything was modified in place at any depth.
+    """
+    if isinstance(value, dict):
+        return (_NODE, value, tuple(value), tuple(_content_snapshot(v) for v in value.values()))
+    if isinstance(value, list):
+        return (_NODE, value, None, tuple(_content_snapshot(v) for v in value))
+    return value
+
+
+def _same_snapshot(a, b):
+    if type(a) is not tuple or not a or a[0] is not _NODE:
+        return a is b
+    if type(b) is not tuple or not b or b[0] is not _NODE:
+        return False
+    if a[1] is not b[1] or a[2] != b[2] or len(a[3]) != len(b[3]):
+        return False
+    return all(_same_snapshot(x, y) for x, y in zip(a[3], b[3]))
+
+
+def _approx_block_tokens(block):
+    if is_base64_image(block) or (isinstance(block, dict) and block.get('type') == 'image'):
+        return IMAGE_TOKENS
+    if isinstance(block, dict) and isinstance(block.get('text'), str):
+        return len(block['text']) // 4 + 1
+    content = nested_content(block)
+    if content:
+        return sum(_approx_block_tokens(b) for b in content) + 1
+    return len(json.dumps(block, default=str)) // 4 + 1
+
+
+class NormalizedMessage:
+    """A message as role plus a tuple of content blocks without cache_control"""
+    __slots__ = ('role', 'blocks', '_fingerprint', '_tokens', '_source', '_role_source', '_snapshot')
+
+    def __init__(self, message):
+        content = message.get('content', '')
+        self.role = message.get('role')
+        if isinstance(content, str):
+            self.blocks = ({'type': 'text', 'text': content},)
+        else:
+            self.blocks = tuple(_strip_cache_control(block) for block in content)
+        self._fingerprint = None
+        self._tokens = None
+        self._source = message
+        self._role_source = self.role
+        self._snapshot = _content_snapshot(content)
+
+    def matches(self, message):
+        """True if built from this very message object and it was not modified since"""
+        return (self._source is message and message.get('role') is self._role_source
+                and _same_snapshot(self._snapshot, _content_snapshot(message.get('content', ''))))
+
+    @property
+    def fingerprint(self):
+        """Stable digest of role and content, ignoring cache_control"""
+        if self._fingerprint is None:
+            view = [_fingerprint_view(block) for block in self.blocks]
+            encoded = json.dumps([self.role, view], sort_keys=True, separators=(',', ':'), default=str)
+            self._fingerprint = hashlib.blake2b(encoded.encode('utf-8'), digest_size=16).digest()
+        return self._fingerprint
+
+    @property
+    def approx_tokens(self):
+        """Estimated input tokens (4 characters per token)"""
+        if self._tokens is None:
+            self._tokens = sum(_approx_block_tokens(block) for block in self.blocks)
+        return self._tokens
+
+    @property
+    def approx_bytes(self):
+        """Estimated size of the content, counting images by their base64 data"""
+        return (self.approx_tokens * 4
+                + sum(len(image['source']['data']) - IMAGE_TOKENS * 4 for image in iter_base64_images(self.blocks)))
+
+    def to_wire(self, cached_blocks=(), cache_control=None):
+        """Serialize for the API, adding cache_control to the given block indices"""
+        if not cached_blocks:
+            return {'role': self.role, 'content': list(self.blocks)}
+        cache_control = cache_control or {'type': 'ephemeral'}
+        content = [dict(block, cache_control=cache_control) if i in cached_blocks else block
+                   for i, block in enumerate(self.blocks)]
+        return {'role': self.role, 'content': content}
+
+
+class NormalizedCache:
+    """LRU of normalized messages by caller object id, bounded by approximate bytes"""
+
+    def __init__(self, max_bytes=MESSAGE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        # id(message) -> (normalized, approx bytes)
+        self._entries = OrderedDict()
+
+    def get(self, message):
+        entry = self._entries.get(id(message))
+        if entry is None or not entry[0].matches(message):
+            return None
+        self._entries.move_to_end(id(message))
+        return entry[0]
+
+    def put(self, message, normalized):
+        replaced = self._entries.pop(id(message), None)
+        if replaced is not None:
+            self.size -= replaced[1]
+        size = normalized.approx_bytes
+        if size > self.max_bytes:
+            return
+        self._entries[id(message)] = (normalized, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, dropped) = self._entries.popitem(last=False)
+            self.size -= dropped
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_normalized_cache = NormalizedCache()
+
+
+def normalize_message(message):
+    """Normalize one message, reusing the previous result for the same unchanged object"""
+    cached = _normalized_cache.get(message)
+    if cached is not None:
+        return cached
+    normalized = NormalizedMessage(message)
+    _normalized_cache.put(message, normalized)
+    return normalized
+
+
+def normalize_messages(messages):
+    return tuple(normalize_message(message) for message in messages)
@@ -0,0 +1,149 @@
+"""Adaptive max_tokens sizing and continuation of truncated responses.
+
+max_tokens is reserved against the output-tokens-per-minute limit when a
+request starts, so asking for far more than a response will use limits
+concurrency. For each agent and model the output tokens of recent responses
+are kept, and once there are enough samples requests ask for the
+MR_ANTHROPIC_MAX_TOKENS_PERCENTILE of them plus a margin, never more than
+the configured default and never more than the context window leaves after
+the input. Each model's own output limit and thinking support always apply,
+so a request routed or failed over to a smaller model stays valid. A
+response that still hits max_tokens is continued with an assistant prefill,
+up to MR_ANTHROPIC_MAX_CONTINUATIONS times.
+"""
+import os
+import json
+import math
+from collections import deque
+from lib.providers.services import service
+
+ADAPTIVE_MAX_TOKENS = os.environ.get('MR_ANTHROPIC_ADAPTIVE_MAX_TOKENS', '1').lower() not in ('0', 'false', 'no')
+MAX_TOKENS_PERCENTILE = float(os.environ.get('MR_ANTHROPIC_MAX_TOKENS_PERCENTILE', '0.95'))
+MAX_TOKENS_MARGIN = float(os.environ.get('MR_ANTHROPIC_MAX_TOKENS_MARGIN', '1.25'))
+MAX_CONTINUATIONS = int(os.environ.get('MR_ANTHROPIC_MAX_CONTINUATIONS', '3'))
+MIN_SAMPLES = 20
+SAMPLE_WINDOW = 200
+MIN_MAX_TOKENS = 1024
+MIN_THINKING_BUDGET = 1024
+# Tokens left free in the context window beyond the estimated input
+CONTEXT_MARGIN = 1024
+
+# Model name prefix -> (max output tokens, supports extended thinking); first match wins
+MODEL_LIMITS = [
+    ('claude-3-5-haiku', 8192, False),
+    ('claude-3-5-sonnet', 8192, False),
+    ('claude-3-haiku', 4096, False),
+    ('claude-3-opus', 4096, False),
+    ('claude-3-7-sonnet', 64000, True),
+    ('claude-opus-4', 32000, True),
+    ('claude-sonnet-4', 64000, True),
+    ('claude-haiku-4', 64000, True),
+]
+
+
+def load_model_limits(value=None):
+    """MR_ANTHROPIC_MODEL_LIMITS: JSON mapping a model prefix to {"max_tokens": n, "thinking": bool}"""
+    value = os.environ.get('MR_ANTHROPIC_MODEL_LIMITS', '') if value is None else value
+    if not value.strip():
+        return []
+    try:
+        return [(prefix, limits.get('max_tokens'), limits.get('thinking', True))
+                for prefix, limits in json.loads(value).items()]
+    except (ValueError, AttributeError) as e:
+        print(f"Invalid MR_ANTHROPIC_MODEL_LIMITS, ignoring: {e}")
+        return []
+
+
+LIMIT_OVERRIDES = load_model_limits()
+
+
+def model_limits(model):
+    """(max output tokens or None if unknown, supports thinking) for a model"""
+    for prefix, max_output, thinking in LIMIT_OVERRIDES + MODEL_LIMITS:
+        if (model or '').startswith(prefix):
+            return max_output, thinking
+    return None, True
+
+
+def agent_name_for(context):
+    agent = getattr(context, 'agent', None)
+    return agent.get('name') if isinstance(agent, dict) else None
+
+
+def _round_up(tokens, step=256):
+    return int(math.ceil(tokens / step) * step)
+
+
+class OutputSizer:
+    def __init__(self):
+        # (agent, model) -> recent output token counts
+        self.samples = {}
+
+    def record(self, agent, model, output_tokens):
+        if output_tokens <= 0:
+            return
+        samples = self.samples.get((agent, model))
+        if samples is None:
+            samples = self.samples[(agent, model)] = deque(maxlen=SAMPLE_WINDOW)
+        samples.append(output_tokens)
+
+    def percentile(self, agent, model, q=MAX_TOKENS_PERCENTILE):
+        samples = self.samples.get((agent, model))
+        if not samples or len(samples) < MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def size(self, agent, model, default, thinking_budget=0, input_tokens=0, context_window=200000, adaptive=True):
+        """Return (max_tokens, thinking_budget) for a request.
+
+        default is the most the request may ask for. Thinking budget counts
+        against max_tokens and is shrunk, or turned off, when it does not fit
+        or the model does not support thinking.
+        """
+        model_max, thinking_supported = model_limits(model)
+        if not thinking_supported:
+            thinking_budget = 0
+        max_tokens = default
+        observed = self.percentile(agent, model) if adaptive and ADAPTIVE_MAX_TOKENS else None
+        if observed is not None:
+            # Observed output includes the thinking tokens
+            wanted = max(MIN_MAX_TOKENS, _round_up(observed * MAX_TOKENS_MARGIN))
+            if thinking_budget:
+                wanted = max(wanted, thinking_budget + MIN_MAX_TOKENS)
+            max_tokens = min(default, wanted)
+        headroom = context_window - input_tokens - CONTEXT_MARGIN
+        max_tokens = max(MIN_MAX_TOKENS, min(max_tokens, headroom))
+        if model_max is not None:
+            max_tokens = min(max_tokens, model_max)
+        if thinking_budget and thinking_budget >= max_tokens:
+            thinking_budget = max_tokens - MIN_MAX_TOKENS
+            if thinking_budget < MIN_THINKING_BUDGET:
+                thinking_budget = 0
+        return max_tokens, thinking_budget
+
+    def status(self):
+        return {f'{agent or "-"}/{model}': {'samples': len(samples),
+                                            'p50': self.percentile(agent, model, 0.5),
+                                            'p95': self.percentile(agent, model, 0.95)}
+                for (agent, model), samples in self.samples.items()}
+
+
+output_sizer = OutputSizer()
+
+
+def continuation_messages(request_messages, answer_text):
+    """Messages that let the model pick up a truncated answer where it stopped.
+
+    The prefill must not end in whitespace; the model regenerates it.
+    """
+    prefill = answer_text.rstrip()
+    if not prefill:
+        return request_messages
+    return list(request_messages) + [{'role': 'assistant', 'content': [{'type': 'text', 'text': prefill}]}]
+
+
+@service()
+async def get_output_sizing(context=None):
+    """Observed output token percentiles per agent and model"""
+    return output_sizer.status()
@@ -0,0 +1,139 @@
+"""Per-session cache-planning state, checkpointed to local disk.
+
+plan_message_caching needs the fingerprints of the messages sent last turn.
+Kept only in memory, they are lost on every restart and the first turn of
+each live conversation is planned as if every message were new. When
+MR_ANTHROPIC_SESSION_STATE_DIR is set, each session's fingerprints and
+breakpoint plan are also written to a small binary file there and read back
+the first time the session is seen after a restart.
+
+File layout: b'MRP1', breakpoint count (uint16), fingerprint count (uint32),
+the breakpoints as (message index uint32, block index uint16) pairs, then
+the 16-byte fingerprints back to back.
+"""
+import os
+import time
+import struct
+import hashlib
+from collections import OrderedDict
+from lib.providers.services import service
+
+SESSION_STATE_DIR = os.environ.get('MR_ANTHROPIC_SESSION_STATE_DIR')
+SESSION_STATE_TTL = float(os.environ.get('MR_ANTHROPIC_SESSION_STATE_TTL', str(7 * 24 * 3600)))
+MAX_TRACKED_SESSIONS = 10000
+FINGERPRINT_SIZE = 16
+
+MAGIC = b'MRP1'
+HEADER = struct.Struct('<4sHI')
+BREAKPOINT = struct.Struct('<IH')
+
+
+def encode_plan(fingerprints, breakpoints):
+    parts = [HEADER.pack(MAGIC, len(breakpoints), len(fingerprints))]
+    parts.extend(BREAKPOINT.pack(i, j) for i, j in sorted(breakpoints))
+    parts.extend(fingerprints)
+    return b''.join(parts)
+
+
+def decode_plan(data):
+    magic, breakpoint_count, fingerprint_count = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError('not a session plan file')
+    offset = HEADER.size
+    breakpoints = set()
+    for _ in range(breakpoint_count):
+        breakpoints.add(BREAKPOINT.unpack_from(data, offset))
+        offset += BREAKPOINT.size
+    if len(data) != offset + fingerprint_count * FINGERPRINT_SIZE:
+        raise ValueError('truncated session plan file')
+    fingerprints = tuple(data[offset + n * FINGERPRINT_SIZE:offset + (n + 1) * FINGERPRINT_SIZE]
+                         for n in range(fingerprint_count))
+    return fingerprints, breakpoints
+
+
+class SessionPlanStore:
+    def __init__(self, directory=SESSION_STATE_DIR):
+        self.directory = directory
+        # session -> (fingerprints, breakpoints)
+        self.plans = OrderedDict()
+        self.loaded = 0
+        if directory:
+            try:
+                os.makedirs(directory, exist_ok=True)
+                self.purge_expired()
+            except OSError as e:
+                print(f"Error opening session state dir {directory}, keeping plans in memory: {e}")
+                self.directory = None
+
+    def _path(self, session_id):
+        name = hashlib.blake2b(str(session_id).encode('utf-8'), digest_size=12).hexdigest()
+        return os.path.join(self.directory, name + '.plan')
+
+    def _load(self, session_id):
+        try:
+            with open(self._path(session_id), 'rb') as f:
+                plan = decode_plan(f.read())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, struct.error) as e:
+            print(f"Error loading cache plan for session {session_id}: {e}")
+            return None
+        self.loaded += 1
+        print(f"\033[94m[CACHE] Restored cache plan for session {session_id} ({len(plan[0])} messages)\033[0m")
+        return plan
+
+    def get(self, session_id):
+        """(fingerprints, breakpoints) from the session's last turn, or None"""
+        plan = self.plans.get(session_id)
+        if plan is None and self.directory and session_id is not None:
+            plan = self._load(session_id)
+            if plan is not None:
+                self._remember(session_id, plan)
+        return plan
+
+    def fingerprints(self, session_id):
+        plan = self.get(session_id)
+        return plan[0] if plan is not None else None
+
+    def _remember(self, session_id, plan):
+        self.plans[session_id] = plan
+        self.plans.move_to_end(session_id)
+        while len(self.plans) > MAX_TRACKED_SESSIONS:
+            self.plans.popitem(last=False)
+
+    def put(self, session_id, fingerprints, breakpoints):
+        plan = (tuple(fingerprints), set(breakpoints))
+        self._remember(session_id, plan)
+        if not self.directory or session_id is None:
+            return
+        path = self._path(session_id)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(encode_plan(*plan))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Error saving cache plan for session {session_id}: {e}")
+
+    def purge_expired(self):
+        cutoff = time.time() - SESSION_STATE_TTL
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.name.endswith(('.plan', '.tmp')) and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+
+session_plans = SessionPlanStore()
+
+
+@service()
+async def get_cache_plan(session_id=None, context=None):
+    """Message count and cache breakpoints planned for a session's last turn"""
+    if session_id is None:
+        session_id = getattr(context, 'log_id', None)
+    plan = session_plans.get(session_id)
+    if plan is None:
+        return None
+    return {'messages': len(plan[0]), 'breakpoints': sorted(plan[1])}
@@ -0,0 +1,158 @@
+"""Traffic capture and replay.
+
+When MR_ANTHROPIC_RECORD_DIR is set, each request's prepared kwargs and the
+raw event sequence of its upstream stream, with inter-event timing, are
+written to a gzipped JSON-lines file in that directory. replay_recording()
+feeds a recording back through stream_chat / content_stream using a local
+stand-in for the API, at recorded speed or accelerated.
+
+    python -m ah_anthropic.recorder recording.jsonl.gz --speed 10
+"""
+import os
+import json
+import gzip
+import time
+import uuid
+import asyncio
+from types import SimpleNamespace
+
+RECORD_DIR = os.environ.get('MR_ANTHROPIC_RECORD_DIR')
+
+
+def _event_to_dict(event):
+    if hasattr(event, 'to_dict'):
+        return event.to_dict()
+    if hasattr(event, 'model_dump'):
+        return event.model_dump(mode='json')
+    return event.dict()
+
+
+def _to_namespace(value):
+    """Turn recorded JSON back into attribute-style objects like the SDK events"""
+    if isinstance(value, dict):
+        return SimpleNamespace(**{k: _to_namespace(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return [_to_namespace(v) for v in value]
+    return value
+
+
+class RecordingStream:
+    """Wraps an upstream stream, writing every event to a recording file"""
+
+    def __init__(self, stream, kwargs, record_dir=None):
+        self.stream = stream
+        record_dir = record_dir or RECORD_DIR
+        os.makedirs(record_dir, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}.jsonl.gz"
+        self.path = os.path.join(record_dir, name)
+        self._file = gzip.open(self.path, 'wt', encoding='utf-8')
+        header = {k: v for k, v in kwargs.items() if k != 'extra_headers'}
+        self._write({'kwargs': header, 'recorded_at': time.time()})
+        self._last = time.monotonic()
+
+    def _write(self, record):
+        self._file.write(json.dumps(record, separators=(',', ':'), default=str))
+        self._file.write('\n')
+
+    async def __aiter__(self):
+        async for event in self.stream:
+            now = time.monotonic()
+            self._write([round(now - self._last, 6), _event_to_dict(event)])
+            self._last = now
+            yield event
+
+    async def close(self):
+        if not self._file.closed:
+            self._file.close()
+        await self.stream.close()
+
+
+def maybe_record(stream, kwargs):
+    """Wrap the stream in a recorder if recording is enabled"""
+    if not RECORD_DIR:
+        return stream
+    try:
+        return RecordingStream(stream, kwargs)
+    except OSError as e:
+        print(f"Error starting stream recording: {e}")
+        return stream
+
+
+def load_recording(path):
+    """Return (kwargs, [(delay, event_dict), ...]) from a recording file"""
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        header = json.loads(f.readline())
+        events = [tuple(json.loads(line)) for line in f if line.strip()]
+    return header['kwargs'], events
+
+
+class ReplayStream:
+    """Stand-in for an AsyncStream that replays recorded events"""
+
+    def __init__(self, events, speed=1.0):
+        self.events = events
+        self.speed = speed
+        self.closed = False
+
+    async def __aiter__(self):
+        for delay, event in self.events:
+            if self.closed:
+                return
+            if self.speed:
+                await asyncio.sleep(delay / self.speed)
+            yield _to_namespace(event)
+
+    async def close(self):
+        self.closed = True
+
+
+async def replay_recording(path, speed=1.0, context=None):
+    """Run a recording through stream_chat and report timing.
+
+    speed=1.0 reproduces the recorded inter-event timing, larger values
+    accelerate it and speed=0 replays as fast as possible.
+    """
+    from .mod import stream_chat
+    from .clients import client_pool
+
+    kwargs, events = load_recording(path)
+    messages = [{'role': 'system', 'content': kwargs['system']}] + kwargs['messages']
+
+    async def replay_factory(key, request_kwargs):
+        return ReplayStream(events, speed)
+
+    previous = client_pool.stream_factory
+    client_pool.stream_factory = replay_factory
+    try:
+        start = time.monotonic()
+        first_chunk = None
+        chunks = []
+        # Same output settings as the recorded request, not whatever is configured now
+        thinking = kwargs.get('thinking') or {}
+        stream = await stream_chat(model=kwargs['model'], messages=messages, context=context,
+                                   temperature=kwargs.get('temperature', 0.0), max_tokens=kwargs['max_tokens'],
+                                   stop=kwargs.get('stop_sequences'),
+                                   thinking_budget=thinking.get('budget_tokens', 0) if thinking.get('type') == 'enabled' else 0)
+        async for chunk in stream:
+            if first_chunk is None:
+                first_chunk = time.monotonic() - start
+            chunks.append(chunk)
+        duration = time.monotonic() - start
+    finally:
+        client_pool.stream_factory = previous
+    return {'path': path, 'model': kwargs['model'], 'events': len(events), 'chunks': len(chunks),
+            'output_length': sum(len(c) for c in chunks), 'time_to_first_chunk': first_chunk,
+            'duration': duration, 'recorded_duration': sum(delay for delay, _ in events),
+            'output': ''.join(chunks)}
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Replay recorded Anthropic streams through stream_chat')
+    parser.add_argument('paths', nargs='+')
+    parser.add_argument('--speed', type=float, default=1.0)
+    args = parser.parse_args()
+    for recording in args.paths:
+        report = asyncio.run(replay_recording(recording, args.speed))
+        report.pop('output')
+        print(json.dumps(report))
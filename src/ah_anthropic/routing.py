@@ -0,0 +1,157 @@
+"""Rule-based model routing for requests that do not name a model.
+
+With routing enabled, stream_chat(model=None) picks a model from features
+of the request instead of always using DEFAULT_MODEL. MR_ANTHROPIC_ROUTING_RULES
+is a JSON list of rules checked in order; the first rule whose conditions
+all match and whose model is healthy (circuit closed, no long backoff) wins:
+
+  [{"when": {"max_input_tokens": 4000, "images": false, "tools": false},
+    "model": "claude-3-5-haiku-latest"},
+   {"when": {"policy": "quality"}, "model": "claude-sonnet-4-0"}]
+
+Conditions: min_input_tokens, max_input_tokens, images, tools, thinking
+(whether the request asks for extended thinking), agent (name or list of
+names), policy (the agent's 'model_policy'), priority, and min_queue_depth.
+A rule is also skipped when the request wants thinking and its model cannot
+think. Every decision is logged with its features, and the
+stream's duration and output tokens are added when it finishes, so
+get_routing_log shows what routing actually saved.
+"""
+import os
+import json
+import time
+from collections import deque
+from lib.providers.services import service
+from .clients import client_pool
+from .circuits import circuit_breaker
+from .scheduler import request_scheduler, priority_for
+from .output_sizing import model_limits
+
+ROUTING_ENABLED = os.environ.get('MR_ANTHROPIC_ROUTING', '').lower() in ('1', 'true', 'yes')
+MAX_ROUTE_WAIT = float(os.environ.get('MR_ANTHROPIC_ROUTING_MAX_WAIT', '5'))
+ROUTING_LOG_SIZE = 1000
+
+DEFAULT_RULES = [
+    {'when': {'max_input_tokens': 4000, 'images': False, 'tools': False, 'thinking': False},
+     'model': 'claude-3-5-haiku-latest'},
+]
+
+
+def load_routing_rules(value=None):
+    value = os.environ.get('MR_ANTHROPIC_ROUTING_RULES', '') if value is None else value
+    if not value.strip():
+        return list(DEFAULT_RULES)
+    try:
+        rules = json.loads(value)
+        if not isinstance(rules, list) or not all(isinstance(rule, dict) and 'model' in rule for rule in rules):
+            raise ValueError('expected a list of {"when": {...}, "model": ...} objects')
+        return rules
+    except ValueError as e:
+        print(f"Invalid MR_ANTHROPIC_ROUTING_RULES, using defaults: {e}")
+        return list(DEFAULT_RULES)
+
+
+def request_features(normalized_messages, input_tokens, context=None, thinking=False):
+    agent = getattr(context, 'agent', None)
+    agent = agent if isinstance(agent, dict) else {}
+    block_types = {block.get('type') for message in normalized_messages for block in message.blocks
+                   if isinstance(block, dict)}
+    return {
+        'input_tokens': input_tokens,
+        'images': 'image' in block_types,
+        'tools': bool(block_types & {'tool_use', 'tool_result'}),
+        'thinking': thinking,
+        'agent': agent.get('name'),
+        'policy': agent.get('model_policy'),
+        'priority': priority_for(context),
+        'queue_depth': request_scheduler.queue_depth(),
+    }
+
+
+def rule_matches(conditions, features):
+    for name, expected in conditions.items():
+        if name == 'min_input_tokens':
+            if features['input_tokens'] < expected:
+                return False
+        elif name == 'max_input_tokens':
+            if features['input_tokens'] > expected:
+                return False
+        elif name == 'min_queue_depth':
+            if features['queue_depth'] < expected:
+                return False
+        elif name == 'agent' and isinstance(expected, list):
+            if features['agent'] not in expected:
+                return False
+        elif name in features:
+            if features[name] != expected:
+                return False
+        else:
+            print(f"[ROUTER] Unknown routing condition {name!r}, rule skipped")
+            return False
+    return True
+
+
+class ModelRouter:
+    def __init__(self, rules=None, enabled=ROUTING_ENABLED):
+        self.enabled = enabled
+        self.rules = load_routing_rules() if rules is None else rules
+        self.log = deque(maxlen=ROUTING_LOG_SIZE)
+
+    def skip_reason(self, model, features=None):
+        if features is not None and features['thinking'] and not model_limits(model)[1]:
+            return 'no thinking support'
+        if circuit_breaker.is_open(model):
+            return 'circuit open'
+        wait = min(key.wait_time(model) for key in client_pool.keys)
+        if wait > MAX_ROUTE_WAIT:
+            return f'backing off {wait:.1f}s'
+        return None
+
+    def route(self, default_model, normalized_messages, input_tokens, context=None, thinking=False):
+        """Pick a model; returns (model, decision) where decision is the log entry"""
+        features = request_features(normalized_messages, input_tokens, context, thinking)
+        model, rule_index, skipped = default_model, None, []
+        for index, rule in enumerate(self.rules):
+            if not rule_matches(rule.get('when', {}), features):
+                continue
+            reason = self.skip_reason(rule['model'], features)
+            if reason is not None:
+                skipped.append({'model': rule['model'], 'reason': reason})
+                continue
+            model, rule_index = rule['model'], index
+            break
+        decision = {'time': time.time(), 'session': getattr(context, 'log_id', None), 'model': model,
+                    'rule': rule_index, 'features': features, 'skipped': skipped}
+        self.log.append(decision)
+        print(f"[ROUTER] {model} (rule {rule_index}, {features['input_tokens']} input tokens)")
+        return model, decision
+
+    def record_outcome(self, decision, started, output_tokens, served_by=None):
+        decision['served_by'] = served_by or decision['model']
+        decision['duration'] = time.time() - started
+        decision['output_tokens'] = output_tokens
+
+    def summary(self):
+        per_model = {}
+        for decision in self.log:
+            stats = per_model.setdefault(decision['model'], {'requests': 0, 'completed': 0, 'duration': 0.0,
+                                                             'input_tokens': 0, 'output_tokens': 0})
+            stats['requests'] += 1
+            stats['input_tokens'] += decision['features']['input_tokens']
+            if 'duration' in decision:
+                stats['completed'] += 1
+                stats['duration'] += decision['duration']
+                stats['output_tokens'] += decision['output_tokens']
+        for stats in per_model.values():
+            stats['avg_duration'] = stats.pop('duration') / stats['completed'] if stats['completed'] else None
+        return per_model
+
+
+model_router = ModelRouter()
+
+
+@service()
+async def get_routing_log(limit=100, context=None):
+    """Recent routing decisions and per-model request, duration and token totals"""
+    return {'enabled': model_router.enabled, 'rules': model_router.rules,
+            'summary': model_router.summary(), 'decisions': list(model_router.log)[-limit:]}
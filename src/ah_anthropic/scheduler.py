@@ -0,0 +1,198 @@
+"""Priority-aware admission of upstream streams.
+
+All requests share the same keys and backoff, so a burst of background jobs
+can hold every slot while a user waits on a reply. With
+MR_ANTHROPIC_MAX_CONCURRENT set, at most that many streams are open at once
+per worker (the default 0 disables the scheduler). A slot is held until the
+stream is closed, so size the limit for slow readers too.
+Waiting requests are ordered by priority class first, then by weighted fair
+queuing between tenants (agent and user), so one busy agent cannot starve
+the others in its class. Queued lower-priority work is passed over whenever
+higher-priority work arrives, and MR_ANTHROPIC_RESERVED_INTERACTIVE slots
+are only ever given to interactive requests.
+
+The priority class is read from the context ('priority' in context.data or
+the agent definition): 'interactive', 'normal' (default) or 'background'.
+Requests that have waited MR_ANTHROPIC_QUEUE_AGING seconds move up one class
+so background work is never starved outright.
+"""
+import os
+import json
+import time
+import asyncio
+import itertools
+from lib.providers.services import service
+
+PRIORITIES = {'interactive': 0, 'normal': 1, 'background': 2}
+DEFAULT_PRIORITY = 'normal'
+MAX_CONCURRENT = int(os.environ.get('MR_ANTHROPIC_MAX_CONCURRENT', '0'))
+RESERVED_INTERACTIVE = int(os.environ.get('MR_ANTHROPIC_RESERVED_INTERACTIVE', '2'))
+QUEUE_AGING = float(os.environ.get('MR_ANTHROPIC_QUEUE_AGING', '120'))
+
+
+def load_tenant_weights(value=None):
+    value = os.environ.get('MR_ANTHROPIC_TENANT_WEIGHTS', '') if value is None else value
+    if not value.strip():
+        return {}
+    try:
+        return {tenant: float(weight) for tenant, weight in json.loads(value).items()}
+    except (ValueError, AttributeError) as e:
+        print(f"Invalid MR_ANTHROPIC_TENANT_WEIGHTS, ignoring: {e}")
+        return {}
+
+
+def _context_value(context, name):
+    value = getattr(context, name, None)
+    if value is None:
+        data = getattr(context, 'data', None)
+        if isinstance(data, dict):
+            value = data.get(name)
+    if value is None:
+        agent = getattr(context, 'agent', None)
+        if isinstance(agent, dict):
+            value = agent.get(name)
+    return value
+
+
+def priority_for(context):
+    priority = _context_value(context, 'priority') or DEFAULT_PRIORITY
+    return priority if priority in PRIORITIES else DEFAULT_PRIORITY
+
+
+def tenant_for(context):
+    agent = getattr(context, 'agent', None)
+    agent_name = agent.get('name') if isinstance(agent, dict) else None
+    username = getattr(context, 'username', None)
+    return f"{agent_name or '-'}/{username or '-'}"
+
+
+class Waiter:
+    __slots__ = ('priority', 'tenant', 'finish', 'seq', 'enqueued', 'future')
+
+    def __init__(self, priority, tenant, finish, seq):
+        self.priority = priority
+        self.tenant = tenant
+        self.finish = finish
+        self.seq = seq
+        self.enqueued = time.monotonic()
+        self.future = asyncio.get_event_loop().create_future()
+
+    def sort_key(self, now):
+        level = PRIORITIES[self.priority]
+        if QUEUE_AGING > 0:
+            level -= int((now - self.enqueued) / QUEUE_AGING)
+        return (max(level, 0), self.finish, self.seq)
+
+
+class RequestScheduler:
+    def __init__(self, max_concurrent=MAX_CONCURRENT, reserved_interactive=RESERVED_INTERACTIVE, weights=None):
+        self.max_concurrent = max_concurrent
+        self.reserved_interactive = min(reserved_interactive, max(max_concurrent - 1, 0))
+        self.weights = load_tenant_weights() if weights is None else weights
+        self.active = 0
+        self.queue = []
+        self.virtual_time = 0.0
+        self.last_finish = {}
+        self.preempted = 0
+        self.dispatched = 0
+        self._seq = itertools.count()
+
+    def _has_room(self, priority):
+        if not self.max_concurrent:
+            return True
+        limit = self.max_concurrent
+        if priority != 'interactive':
+            limit -= self.reserved_interactive
+        return self.active < limit
+
+    def _finish_tag(self, tenant):
+        # Each request costs 1/weight of virtual time for its tenant
+        start = max(self.virtual_time, self.last_finish.get(tenant, 0.0))
+        finish = start + 1.0 / self.weights.get(tenant, 1.0)
+        self.last_finish[tenant] = finish
+        if len(self.last_finish) > 10000:
+            self.last_finish = {t: f for t, f in self.last_finish.items() if f > self.virtual_time}
+        return finish
+
+    def _release_callback(self):
+        released = [False]
+
+        def release():
+            if released[0]:
+                return
+            released[0] = True
+            self.active -= 1
+            self._dispatch()
+        return release
+
+    def _dispatch(self):
+        while self.queue:
+            now = time.monotonic()
+            # Waiters that do not fit (e.g. aged background work when only
+            # reserved slots are free) must not block those that do
+            fitting = [w for w in self.queue if self._has_room(w.priority)]
+            if not fitting:
+                return
+            waiter = min(fitting, key=lambda w: w.sort_key(now))
+            self.queue.remove(waiter)
+            if waiter.future.done():
+                continue
+            # Anything enqueued before it in a lower class has just been passed over
+            self.preempted += sum(1 for w in self.queue
+                                  if w.seq < waiter.seq and PRIORITIES[w.priority] > PRIORITIES[waiter.priority])
+            self.virtual_time = max(self.virtual_time, waiter.finish)
+            self.active += 1
+            self.dispatched += 1
+            waiter.future.set_result(self._release_callback())
+
+    async def acquire(self, context=None):
+        """Wait for a stream slot; returns a callable that gives it back"""
+        priority = priority_for(context)
+        tenant = tenant_for(context)
+        finish = self._finish_tag(tenant)
+        if not self.queue and self._has_room(priority):
+            self.virtual_time = max(self.virtual_time, finish)
+            self.active += 1
+            self.dispatched += 1
+            return self._release_callback()
+        waiter = Waiter(priority, tenant, finish, next(self._seq))
+        self.queue.append(waiter)
+        # A reserved interactive slot may be free even though others are queued
+        self._dispatch()
+        if len(self.queue) % 50 == 0:
+            print(f"[SCHED] {len(self.queue)} requests queued, {self.active} active")
+        try:
+            return await waiter.future
+        except asyncio.CancelledError:
+            if waiter in self.queue:
+                self.queue.remove(waiter)
+            elif waiter.future.done() and not waiter.future.cancelled():
+                # Slot was granted as we were cancelled
+                waiter.future.result()()
+            raise
+
+    def queue_depth(self, priority=None):
+        if priority is None:
+            return len(self.queue)
+        return sum(1 for w in self.queue if w.priority == priority)
+
+    def status(self):
+        now = time.monotonic()
+        return {
+            'max_concurrent': self.max_concurrent,
+            'reserved_interactive': self.reserved_interactive,
+            'active': self.active,
+            'queued': {name: self.queue_depth(name) for name in PRIORITIES},
+            'oldest_wait': max((now - w.enqueued for w in self.queue), default=0.0),
+            'dispatched': self.dispatched,
+            'preempted': self.preempted,
+        }
+
+
+request_scheduler = RequestScheduler()
+
+
+@service()
+async def get_scheduler_status(context=None):
+    """Active streams, queue depth per priority class and preemption count"""
+    return request_scheduler.status()
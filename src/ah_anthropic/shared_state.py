@@ -0,0 +1,108 @@
+"""Host-wide shared backoff, rate-limit and circuit state.
+
+Every uvicorn worker keeps its own backoff and rate-limit state in memory,
+so without sharing each worker discovers an outage or a 429 by itself. When
+MR_ANTHROPIC_SHARED_STATE points to a file, that state is also published to
+a small SQLite store (WAL mode) read by all workers on the host. Reads are
+cached briefly so the hot path rarely touches the database. Inside an event
+loop, writes go to one background thread with its own connection, so a
+worker waiting on another worker's write lock never stalls its loop.
+"""
+import os
+import json
+import time
+import asyncio
+import sqlite3
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+SHARED_STATE_PATH = os.environ.get('MR_ANTHROPIC_SHARED_STATE')
+READ_CACHE_SECONDS = 0.5
+
+
+def key_id(api_key):
+    """Stable identifier for an API key that does not reveal it"""
+    if not api_key:
+        return 'default'
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:12]
+
+
+class SharedStateStore:
+    """Key/value store with expiry, shared by processes on one host"""
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path, timeout=1.0, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY, value TEXT, expires REAL)')
+        self._cache = {}
+        # One thread keeps writes in order; it opens its own connection on first use
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='shared-state')
+        self._writer = None
+
+    def _execute(self, conn, sql, params, action):
+        try:
+            conn.execute(sql, params)
+        except sqlite3.Error as e:
+            print(f"Error {action} shared state: {e}")
+
+    def _execute_in_thread(self, sql, params, action):
+        if self._writer is None:
+            self._writer = sqlite3.connect(self.path, timeout=1.0, isolation_level=None)
+        self._execute(self._writer, sql, params, action)
+
+    def _write(self, sql, params, action):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self._execute(self._conn, sql, params, action)
+            return
+        self._executor.submit(self._execute_in_thread, sql, params, action)
+
+    def flush(self):
+        """Wait for queued writes to finish"""
+        self._executor.submit(lambda: None).result()
+
+    def get(self, name):
+        now = time.time()
+        cached = self._cache.get(name)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+        value = None
+        try:
+            row = self._conn.execute('SELECT value, expires FROM state WHERE name = ?', (name,)).fetchone()
+            if row is not None and row[1] > now:
+                value = json.loads(row[0])
+        except sqlite3.Error as e:
+            print(f"Error reading shared state {name}: {e}")
+        self._cache[name] = (now + READ_CACHE_SECONDS, value)
+        return value
+
+    def put(self, name, value, ttl):
+        expires = time.time() + ttl
+        self._cache[name] = (min(expires, time.time() + READ_CACHE_SECONDS), value)
+        self._write('INSERT OR REPLACE INTO state (name, value, expires) VALUES (?, ?, ?)',
+                    (name, json.dumps(value), expires), f'writing {name} to')
+
+    def delete(self, name):
+        self._cache.pop(name, None)
+        self._write('DELETE FROM state WHERE name = ?', (name,), f'deleting {name} from')
+
+    def purge_expired(self):
+        self._write('DELETE FROM state WHERE expires <= ?', (time.time(),), 'purging')
+
+
+def open_shared_state(path=SHARED_STATE_PATH):
+    if not path:
+        return None
+    try:
+        store = SharedStateStore(path)
+        store.purge_expired()
+        return store
+    except sqlite3.Error as e:
+        print(f"Error opening shared state at {path}, using process-local state: {e}")
+        return None
+
+
+shared_state = open_shared_state()
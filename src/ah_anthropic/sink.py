@@ -0,0 +1,76 @@
+"""Write a content stream to a caller-supplied sink in constant memory.
+
+With the output-128k beta a single response can be hundreds of KB. In sink
+mode stream_chat writes each chunk to the sink as it arrives and keeps only
+counters and rolling checksums, so memory per stream does not depend on how
+long the output is. The sink can be a text or binary file, anything with a
+sync or async write() (an asyncio StreamWriter is drained after each
+write), or a callable taking each chunk. Binary files and StreamWriters get
+UTF-8 bytes; everything else gets str.
+"""
+import io
+import zlib
+import hashlib
+import inspect
+
+
+def is_binary_sink(sink):
+    """Whether the sink takes bytes: binary files and StreamWriter-like objects"""
+    if isinstance(sink, io.TextIOBase):
+        return False
+    if isinstance(sink, (io.BufferedIOBase, io.RawIOBase)):
+        return True
+    mode = getattr(sink, 'mode', None)
+    if isinstance(mode, str):
+        return 'b' in mode
+    return callable(getattr(sink, 'drain', None))
+
+
+class SinkWriter:
+    __slots__ = ('sink', 'binary', 'chars', 'bytes', 'chunks', 'crc32', '_sha256', '_drain')
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.binary = is_binary_sink(sink)
+        self.chars = 0
+        self.bytes = 0
+        self.chunks = 0
+        self.crc32 = 0
+        self._sha256 = hashlib.sha256()
+        self._drain = getattr(sink, 'drain', None)
+
+    async def write(self, text):
+        data = text.encode('utf-8')
+        self.chars += len(text)
+        self.bytes += len(data)
+        self.chunks += 1
+        self.crc32 = zlib.crc32(data, self.crc32)
+        self._sha256.update(data)
+        write = getattr(self.sink, 'write', None) or self.sink
+        result = write(data if self.binary else text)
+        if inspect.isawaitable(result):
+            await result
+        if self._drain is not None:
+            await self._drain()
+
+    async def flush(self):
+        flush = getattr(self.sink, 'flush', None)
+        if flush is not None:
+            result = flush()
+            if inspect.isawaitable(result):
+                await result
+
+    def summary(self):
+        return {'chars': self.chars, 'bytes': self.bytes, 'chunks': self.chunks,
+                'crc32': f'{self.crc32:08x}', 'sha256': self._sha256.hexdigest()}
+
+
+async def drain_to_sink(stream, writer):
+    """Copy every chunk of stream to the writer; returns the writer's summary"""
+    try:
+        async for chunk in stream:
+            await writer.write(chunk)
+    finally:
+        await stream.aclose()
+    await writer.flush()
+    return writer.summary()
@@ -0,0 +1,116 @@
+"""Client-side early-stop conditions for the output stream.
+
+A stop condition is fed the model's text output chunk by chunk. When it
+matches, feed() returns the offset in the chunk at which output should end,
+and content_stream closes the upstream stream right away. Conditions keep
+bounded state, so they do not hold a copy of the output.
+"""
+import os
+
+# Characters of recent output a predicate is called with
+STOP_PREDICATE_WINDOW = int(os.environ.get('MR_ANTHROPIC_STOP_PREDICATE_WINDOW', '8192'))
+
+
+class StopCondition:
+    # Appended to the output when the condition matches
+    suffix = ''
+
+    def feed(self, text):
+        """Return the offset in text to stop at, or None to keep going"""
+        return None
+
+
+class PredicateStop(StopCondition):
+    """Stops as soon as predicate(recent_text) is true.
+
+    recent_text is the last `window` characters of the output, so memory and
+    the cost of each call do not grow with the length of the response.
+    """
+
+    def __init__(self, predicate, window=STOP_PREDICATE_WINDOW):
+        self.predicate = predicate
+        self.window = window
+        self.text = ''
+
+    def feed(self, text):
+        self.text = (self.text + text)[-self.window:]
+        if self.predicate(self.text):
+            return len(text)
+        return None
+
+
+class JsonStructureStop(StopCondition):
+    """Tracks bracket depth outside of JSON strings"""
+
+    def __init__(self):
+        self.depth = 0
+        self.started = False
+        self.in_string = False
+        self.escaped = False
+
+    def matched(self, char):
+        return False
+
+    def feed(self, text):
+        for i, char in enumerate(text):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                continue
+            if char == '"':
+                self.in_string = True
+            elif char in '[{':
+                self.depth += 1
+                self.started = True
+            elif char in ']}':
+                self.depth -= 1
+                if self.matched(char):
+                    return i + 1
+        return None
+
+
+class BalancedJsonStop(JsonStructureStop):
+    """Stops when the first top-level JSON array or object is closed"""
+
+    def matched(self, char):
+        return self.started and self.depth == 0
+
+
+class FirstCommandStop(JsonStructureStop):
+    """Stops after the first complete command of a command array, closing the array"""
+    suffix = ']'
+
+    def matched(self, char):
+        return self.started and self.depth == 1 and char == '}'
+
+
+STRUCTURAL_STOPS = {
+    'json_closed': BalancedJsonStop,
+    'first_command': FirstCommandStop,
+}
+
+
+def make_stop_condition(stop):
+    """Build a client-side stop condition, or None if stop is handled by the API"""
+    if stop is None:
+        return None
+    if isinstance(stop, StopCondition):
+        return stop
+    if callable(stop):
+        return PredicateStop(stop)
+    if isinstance(stop, str) and stop in STRUCTURAL_STOPS:
+        return STRUCTURAL_STOPS[stop]()
+    return None
+
+
+def stop_sequences_for(stop):
+    """Literal stop strings are passed to the API as stop_sequences"""
+    if isinstance(stop, str) and stop not in STRUCTURAL_STOPS:
+        return [stop]
+    if isinstance(stop, (list, tuple)) and all(isinstance(s, str) for s in stop):
+        return list(stop)
+    return None
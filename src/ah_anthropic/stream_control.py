@@ -0,0 +1,151 @@
+"""Deterministic cleanup, idle timeouts and metrics for upstream streams."""
+import os
+import asyncio
+import weakref
+from lib.providers.services import service
+
+# Abort a stream when no event arrives for this many seconds
+STREAM_IDLE_TIMEOUT = float(os.environ.get('MR_ANTHROPIC_STREAM_IDLE_TIMEOUT', '60'))
+# How often a stalled stream is re-requested before any output was delivered
+STREAM_IDLE_RETRIES = int(os.environ.get('MR_ANTHROPIC_STREAM_IDLE_RETRIES', '2'))
+
+
+class StreamIdleTimeout(Exception):
+    pass
+
+
+class StreamMetrics:
+    def __init__(self):
+        self.opened = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.idle_timeouts = 0
+        self.idle_retries = 0
+        self.early_stops = 0
+        self.leaked = 0
+        self.open = 0
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+stream_metrics = StreamMetrics()
+
+
+def _close_stream_later(stream):
+    try:
+        loop = asyncio.get_event_loop()
+        if loop.is_running():
+            loop.create_task(stream.close())
+    except Exception as e:
+        print(f"Error closing leaked stream: {e}")
+
+
+def _on_collected(stream, state, release):
+    """Runs when a handle is garbage collected; closes the stream if nobody did"""
+    if state['closed']:
+        return
+    state['closed'] = True
+    stream_metrics.leaked += 1
+    stream_metrics.open -= 1
+    print("\033[91m[STREAM] Upstream stream was never closed, closing it now\033[0m")
+    if release is not None:
+        release()
+    _close_stream_later(stream)
+
+
+class UpstreamHandle:
+    """Owns an upstream AsyncStream and guarantees it is closed exactly once"""
+    __slots__ = ('stream', '_state', '_release', '__weakref__')
+
+    def __init__(self, stream, release=None):
+        self.stream = stream
+        self._state = {'closed': False}
+        self._release = release
+        stream_metrics.opened += 1
+        stream_metrics.open += 1
+        weakref.finalize(self, _on_collected, stream, self._state, release)
+
+    @property
+    def closed(self):
+        return self._state['closed']
+
+    async def close(self):
+        if self._state['closed']:
+            return
+        self._state['closed'] = True
+        stream_metrics.open -= 1
+        if self._release is not None:
+            self._release()
+        try:
+            await self.stream.close()
+        except Exception as e:
+            print(f"Error closing upstream stream: {e}")
+
+
+class _IdleWatchdog:
+    """One timer per stream that cancels the task waiting on it once it stalls.
+
+    Events only record when waiting started; the timer re-arms itself when
+    it finds the stream was not stalled, so there is no per-event timer or task.
+    """
+    __slots__ = ('loop', 'timeout', 'started', 'waiter', 'expired', '_handle')
+
+    def __init__(self, timeout):
+        self.loop = asyncio.get_event_loop()
+        self.timeout = timeout
+        self.started = self.loop.time()
+        self.waiter = None
+        self.expired = False
+        self._handle = self.loop.call_at(self.started + timeout, self._check)
+
+    def _check(self):
+        now = self.loop.time()
+        if self.waiter is not None and now >= self.started + self.timeout:
+            self.expired = True
+            self.waiter.cancel()
+            return
+        # Only time spent waiting on upstream counts, not time the consumer holds a chunk
+        deadline = self.started + self.timeout if self.waiter is not None else now + self.timeout
+        self._handle = self.loop.call_at(deadline, self._check)
+
+    def close(self):
+        self._handle.cancel()
+
+
+async def iterate_with_idle_timeout(stream, timeout=STREAM_IDLE_TIMEOUT):
+    """Iterate a stream, raising StreamIdleTimeout if it stalls between events"""
+    iterator = stream.__aiter__()
+    if not timeout:
+        async for chunk in iterator:
+            yield chunk
+        return
+    watchdog = _IdleWatchdog(timeout)
+    try:
+        while True:
+            watchdog.started = watchdog.loop.time()
+            watchdog.waiter = asyncio.current_task()
+            try:
+                chunk = await iterator.__anext__()
+            except StopAsyncIteration:
+                return
+            except asyncio.CancelledError:
+                if not watchdog.expired:
+                    raise
+                task = asyncio.current_task()
+                # A cancellation from elsewhere that arrived at the same time wins
+                if hasattr(task, 'uncancel') and task.uncancel():
+                    raise
+                stream_metrics.idle_timeouts += 1
+                raise StreamIdleTimeout(f"No stream event for {timeout} seconds")
+            finally:
+                watchdog.waiter = None
+            yield chunk
+    finally:
+        watchdog.close()
+
+
+@service()
+async def get_stream_metrics(context=None):
+    """Counts of opened, completed, cancelled, stalled and leaked upstream streams"""
+    return stream_metrics.as_dict()
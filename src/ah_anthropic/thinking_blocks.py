@@ -0,0 +1,177 @@
+"""Capture thinking blocks with their signatures and replay them in later turns.
+
+content_stream flattens thinking into the reasoning JSON it yields, which
+drops signatures and redacted thinking. The original assistant content is
+captured here while streaming. When the caller sends that assistant turn
+back as history, it is replaced by the captured blocks, so the request
+prefix matches what the model produced and the prompt cache keeps hitting.
+Turns are matched by a digest of the stripped text, computed while
+streaming, so neither the capture nor the match keeps a second copy of the
+output.
+"""
+import os
+import hashlib
+from collections import OrderedDict
+from lib.providers.services import service
+from .normalized import NormalizedMessage
+
+REPLAY_THINKING = os.environ.get('MR_ANTHROPIC_REPLAY_THINKING', '1').lower() not in ('0', 'false', 'no')
+MAX_TURNS_PER_SESSION = 64
+MAX_SESSIONS = 1000
+# Message fingerprint -> text key; entries are two small digests
+MAX_TEXT_KEYS = 16384
+THINKING_TYPES = ('thinking', 'redacted_thinking')
+
+
+class TextDigest:
+    """Digest of text.strip(), fed in chunks.
+
+    Leading whitespace is skipped and a trailing whitespace run is held back
+    until more text follows it, so only that run is ever buffered.
+    """
+    __slots__ = ('_hash', '_started', '_pending')
+
+    def __init__(self):
+        self._hash = hashlib.blake2b(digest_size=16)
+        self._started = False
+        self._pending = ''
+
+    def update(self, text):
+        if not self._started:
+            text = text.lstrip()
+            if not text:
+                return
+            self._started = True
+        body = text.rstrip()
+        if not body:
+            self._pending += text
+            return
+        self._hash.update((self._pending + body).encode('utf-8'))
+        self._pending = text[len(body):]
+
+    def digest(self):
+        return self._hash.digest()
+
+
+def _text_key(text):
+    digest = TextDigest()
+    digest.update(text)
+    return digest.digest()
+
+
+class TurnCapture:
+    """Rebuilds the assistant content blocks from stream events"""
+    __slots__ = ('blocks', 'parts', 'complete')
+
+    # Field of each block type that deltas append to
+    FIELDS = {'thinking_delta': 'thinking', 'signature_delta': 'signature', 'text_delta': 'text'}
+
+    def __init__(self):
+        self.blocks = {}
+        # (index, field) -> list of delta strings, joined once in content()
+        self.parts = {}
+        self.complete = False
+
+    def feed(self, chunk):
+        if chunk.type == 'content_block_start':
+            block = chunk.content_block
+            if block.type == 'thinking':
+                self.blocks[chunk.index] = {'type': 'thinking', 'thinking': '', 'signature': ''}
+            elif block.type == 'redacted_thinking':
+                self.blocks[chunk.index] = {'type': 'redacted_thinking', 'data': block.data}
+            elif block.type == 'text':
+                self.blocks[chunk.index] = {'type': 'text', 'text': ''}
+        elif chunk.type == 'content_block_delta':
+            block = self.blocks.get(chunk.index)
+            if block is None:
+                return
+            field = self.FIELDS.get(chunk.delta.type)
+            if field is None or field not in block:
+                return
+            parts = self.parts.get((chunk.index, field))
+            if parts is None:
+                parts = self.parts[(chunk.index, field)] = []
+            parts.append(getattr(chunk.delta, field))
+        elif chunk.type == 'message_stop':
+            self.complete = True
+
+    def has_thinking(self):
+        return any(block['type'] != 'text' for block in self.blocks.values())
+
+    def content(self):
+        content = []
+        for index in sorted(self.blocks):
+            block = dict(self.blocks[index])
+            for name in ('thinking', 'signature', 'text'):
+                if name in block:
+                    block[name] = ''.join(self.parts.get((index, name), ()))
+            if block['type'] != 'text' or block['text']:
+                content.append(block)
+        return content
+
+
+class ThinkingStore:
+    def __init__(self):
+        # session -> OrderedDict(text key -> NormalizedMessage of the original content)
+        self.sessions = OrderedDict()
+        # fingerprint of a text-only assistant message -> its text key
+        self._text_keys = OrderedDict()
+        self.last_turn = OrderedDict()
+
+    def remember(self, session_id, text_key, capture):
+        """Store a completed turn under the text key (see TextDigest) of the text the caller received"""
+        if not capture.complete or not capture.has_thinking():
+            return
+        content = capture.content()
+        self.last_turn[session_id] = content
+        self.last_turn.move_to_end(session_id)
+        turns = self.sessions.get(session_id)
+        if turns is None:
+            turns = self.sessions[session_id] = OrderedDict()
+        self.sessions.move_to_end(session_id)
+        turns[text_key] = NormalizedMessage({'role': 'assistant', 'content': content})
+        while len(turns) > MAX_TURNS_PER_SESSION:
+            turns.popitem(last=False)
+        while len(self.sessions) > MAX_SESSIONS:
+            dropped, _ = self.sessions.popitem(last=False)
+            self.last_turn.pop(dropped, None)
+
+    def _replacement(self, turns, message):
+        if message.role != 'assistant' or len(message.blocks) != 1 or message.blocks[0].get('type') != 'text':
+            return None
+        # The fingerprint is cached on the message, so history is not re-hashed every turn
+        text_key = self._text_keys.get(message.fingerprint)
+        if text_key is None:
+            text_key = self._text_keys[message.fingerprint] = _text_key(message.blocks[0]['text'])
+            while len(self._text_keys) > MAX_TEXT_KEYS:
+                self._text_keys.popitem(last=False)
+        return turns.get(text_key)
+
+    def restore(self, session_id, normalized_messages):
+        """Swap assistant turns we produced for their original thinking + text blocks"""
+        turns = self.sessions.get(session_id)
+        if not REPLAY_THINKING or not turns:
+            return normalized_messages
+        return tuple(self._replacement(turns, message) or message for message in normalized_messages)
+
+
+thinking_store = ThinkingStore()
+
+
+def strip_thinking(formatted_messages):
+    """Drop thinking blocks for a model without thinking support; unchanged messages are reused"""
+    result = []
+    for message in formatted_messages:
+        content = message['content']
+        if isinstance(content, list) and any(isinstance(block, dict) and block.get('type') in THINKING_TYPES
+                                             for block in content):
+            message = dict(message, content=[block for block in content
+                                             if not (isinstance(block, dict) and block.get('type') in THINKING_TYPES)])
+        result.append(message)
+    return result
+
+
+@service()
+async def get_thinking_blocks(context=None):
+    """Content blocks (thinking with signature, redacted thinking, text) of the session's last turn"""
+    return thinking_store.last_turn.get(getattr(context, 'log_id', None))
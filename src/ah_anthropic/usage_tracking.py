@@ -4,6 +4,7 @@ from datetime import datetime
 from typing import Optional
 from lib.providers.services import service
 from lib.providers.hooks import hook
+from .cache_stats import cache_ledger, get_cache_stats, CACHE_WRITE_MULTIPLIER, CACHE_READ_MULTIPLIER
 
 PLUGIN_ID = 'ah_anthropic'
 
@@ -62,6 +63,21 @@ async def register_cost_types(context=None):
             'tokens'
         )
         print("Successfully registered output tokens cost type")
+
+        print("Registering cache token cost types...")
+        await context.register_cost_type(
+            PLUGIN_ID,
+            'stream_chat.cache_write_tokens',
+            'Claude stream_chat prompt cache write token cost',
+            'tokens'
+        )
+        await context.register_cost_type(
+            PLUGIN_ID,
+            'stream_chat.cache_read_tokens',
+            'Claude stream_chat prompt cache read token cost',
+            'tokens'
+        )
+        print("Successfully registered cache token cost types")
     except Exception as e:
         print(f"Error registering cost types: {str(e)}")
         raise e
@@ -110,13 +126,27 @@ async def set_default_costs(context=None):
             'claude-3-7-sonnet-latest')
          
         print("Successfully set output token cost")
+
+        print("Setting cache token costs...")
+        for model in ['claude-3-5-sonnet-20241022', 'claude-3-7-sonnet-latest']:
+            await context.set_cost(
+                PLUGIN_ID,
+                'stream_chat.cache_write_tokens',
+                0.000003 * CACHE_WRITE_MULTIPLIER,  # $3.75 per million tokens
+                model)
+            await context.set_cost(
+                PLUGIN_ID,
+                'stream_chat.cache_read_tokens',
+                0.000003 * CACHE_READ_MULTIPLIER,  # $0.30 per million tokens
+                model)
+        print("Successfully set cache token costs")
     except Exception as e:
         print(f"Error setting default costs: {str(e)}")
         raise e
 
 async def track_message_start(chunk, model: str, context=None):
     """Track usage from message_start event - input tokens only"""
-    if not context or not hasattr(chunk, 'message') or not hasattr(chunk.message, 'usage'):
+    if not hasattr(chunk, 'message') or not hasattr(chunk.message, 'usage'):
         return
 
     try:
@@ -125,26 +155,30 @@ async def track_message_start(chunk, model: str, context=None):
             'cache_creation_tokens': usage.cache_creation_input_tokens,
             'cache_read_tokens': usage.cache_read_input_tokens
         }
-        cache_create = 0
-        if usage.cache_creation_input_tokens:
-            cache_create = usage.cache_creation_input_tokens
+        cache_create = usage.cache_creation_input_tokens or 0
+        cache_read = usage.cache_read_input_tokens or 0
+        cache_ledger.record(getattr(context, 'log_id', None), model, usage.input_tokens, cache_create, cache_read)
+        if not context:
+            return
 
-        total = usage.input_tokens + cache_create
-        if total > 0:
-            # Track input tokens
-            await context.track_usage(
-                PLUGIN_ID,
-                'stream_chat.input_tokens',
-                total,
-                metadata,
-                context,
-                model
-            )
+        # Uncached input, cache writes and cache reads are billed at different rates
+        for cost_type, tokens in [('stream_chat.input_tokens', usage.input_tokens),
+                                  ('stream_chat.cache_write_tokens', cache_create),
+                                  ('stream_chat.cache_read_tokens', cache_read)]:
+            if tokens > 0:
+                await context.track_usage(
+                    PLUGIN_ID,
+                    cost_type,
+                    tokens,
+                    metadata,
+                    context,
+                    model
+                )
     except Exception as e:
         print(f"Error tracking message start usage: {e}")
         raise e
 
-async def track_message_delta(chunk, total_output: str, model: str, context=None):
+async def track_message_delta(chunk, output_length: int, model: str, context=None):
     """Track usage from message_delta event - output tokens only"""
     print("track_message_delta")
     if not context or not hasattr(chunk, 'usage'):
@@ -152,7 +186,7 @@ async def track_message_delta(chunk, total_output: str, model: str, context=None
 
     print("track_message_delta 2")
     try:
-        metadata = {'total_output_length': len(total_output)}
+        metadata = {'total_output_length': output_length}
         cache_create = 0
         try:
             if chunk.cache_creation_input_tokens:
@@ -174,6 +208,28 @@ async def track_message_delta(chunk, total_output: str, model: str, context=None
         print(f"Error tracking message delta usage: {e}")
         raise e
 
+async def track_early_stop(output_length: int, thinking_length: int, model: str, context=None):
+    """Track estimated output tokens for a stream closed before its message_delta"""
+    if not context:
+        return
+
+    try:
+        # Roughly four characters per token
+        estimated = (output_length + thinking_length) // 4
+        metadata = {'total_output_length': output_length, 'early_stop': True, 'estimated': True}
+        if estimated > 0:
+            await context.track_usage(
+                PLUGIN_ID,
+                'stream_chat.output_tokens',
+                estimated,
+                metadata,
+                context,
+                model
+            )
+    except Exception as e:
+        print(f"Error tracking early stop usage: {e}")
+        raise e
+
 async def track_message_usage(chunk, total_output: str, model: str, context=None):
     """Track usage from a message chunk if it contains usage information."""
     if not context or not hasattr(chunk, 'usage'):
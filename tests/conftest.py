@@ -0,0 +1,129 @@
+"""Make the plugin importable outside a MindRoot install.
+
+The modules import a few MindRoot helpers (service/hook decorators and the
+backoff manager). When MindRoot is not installed, minimal equivalents are
+registered so the plugin's own logic can be tested. The upstream fixture
+stands in for the Messages API with canned stream events.
+"""
+import os
+import sys
+import time
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+os.environ.setdefault('ANTHROPIC_API_KEY', 'test-key')
+
+
+def _decorator_factory(*args, **kwargs):
+    def decorator(func):
+        return func
+    return decorator
+
+
+class _ExponentialBackoff:
+    def __init__(self, initial_delay=2.0, max_delay=32.0, factor=2, jitter=True):
+        self.initial_delay = initial_delay
+        self.until = {}
+
+    def get_wait_time(self, name):
+        return max(0.0, self.until.get(name, 0.0) - time.time())
+
+    def record_success(self, name):
+        self.until.pop(name, None)
+
+    def record_failure(self, name):
+        self.until[name] = time.time() + self.initial_delay
+
+
+try:
+    import lib.providers.services  # noqa: F401
+except ImportError:
+    modules = {name: types.ModuleType(name) for name in
+               ('lib', 'lib.providers', 'lib.providers.services', 'lib.providers.hooks', 'lib.utils', 'lib.utils.backoff')}
+    modules['lib.providers.services'].service = _decorator_factory
+    modules['lib.providers.hooks'].hook = _decorator_factory
+    modules['lib.utils.backoff'].ExponentialBackoff = _ExponentialBackoff
+    sys.modules.update(modules)
+
+
+def stream_events(text='ok', thinking=None, stop_reason='end_turn', output_tokens=1):
+    """Raw Messages stream events for one response, as dicts"""
+    events = [{'type': 'message_start', 'message': {'usage': {
+        'input_tokens': 5, 'output_tokens': 1, 'cache_creation_input_tokens': 0, 'cache_read_input_tokens': 0}}}]
+    index = 0
+    if thinking is not None:
+        events += [{'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'thinking', 'thinking': ''}},
+                   {'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'thinking_delta', 'thinking': thinking}},
+                   {'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'signature_delta', 'signature': 'sig'}},
+                   {'type': 'content_block_stop', 'index': 0}]
+        index = 1
+    if text is not None:
+        events += [{'type': 'content_block_start', 'index': index, 'content_block': {'type': 'text', 'text': ''}},
+                   {'type': 'content_block_delta', 'index': index, 'delta': {'type': 'text_delta', 'text': text}},
+                   {'type': 'content_block_stop', 'index': index}]
+    events += [{'type': 'message_delta', 'delta': {'stop_reason': stop_reason}, 'usage': {'output_tokens': output_tokens}},
+               {'type': 'message_stop'}]
+    return events
+
+
+class FakeStream:
+    def __init__(self, events):
+        self.events = events
+        self.read = 0
+        self.closed = False
+
+    async def __aiter__(self):
+        from ah_anthropic.recorder import _to_namespace
+        for event in self.events:
+            if self.closed:
+                return
+            self.read += 1
+            yield _to_namespace(event)
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeUpstream:
+    """Records each request's kwargs and answers with queued responses (default: 'ok')"""
+
+    def __init__(self):
+        self.requests = []
+        self.streams = []
+        self.responses = []
+
+    def respond(self, *event_lists):
+        self.responses.extend(event_lists)
+
+    async def __call__(self, key, kwargs):
+        self.requests.append(kwargs)
+        events = self.responses.pop(0) if self.responses else stream_events()
+        if isinstance(events, Exception):
+            raise events
+        stream = FakeStream(events)
+        self.streams.append(stream)
+        return stream
+
+
+class Ctx:
+    def __init__(self, log_id='test-session', agent=None):
+        self.log_id = log_id
+        self.agent = agent or {}
+
+    async def track_usage(self, *args, **kwargs):
+        pass
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    from ah_anthropic.clients import client_pool
+    fake = FakeUpstream()
+    monkeypatch.setattr(client_pool, 'stream_factory', fake)
+    return fake
+
+
+@pytest.fixture
+def ctx():
+    return Ctx()
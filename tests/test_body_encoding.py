@@ -0,0 +1,87 @@
+import asyncio
+import base64
+import json
+from types import SimpleNamespace
+
+from ah_anthropic import mod
+from ah_anthropic import images
+from ah_anthropic.body_encoding import EncodedBodyCache, REQUEST_OPTIONS, message_keys
+from ah_anthropic.images import ImageStore
+from ah_anthropic.normalized import normalize_messages
+
+
+def sdk_body(kwargs):
+    return {name: value for name, value in kwargs.items() if name not in REQUEST_OPTIONS}
+
+
+def history(turns):
+    messages = [{'role': 'system', 'content': 'You are a test agent.'}]
+    for i in range(turns):
+        messages.append({'role': 'user', 'content': [{'type': 'text', 'text': f'question {i} ' * 50}]})
+        messages.append({'role': 'assistant', 'content': [{'type': 'text', 'text': f'answer {i}'}]})
+    messages.append({'role': 'user', 'content': [{'type': 'text', 'text': 'last question'}]})
+    return messages
+
+
+def test_body_matches_kwargs_across_turns(upstream, ctx, monkeypatch):
+    cache = EncodedBodyCache()
+    bodies = []
+    request_body = cache.request_body
+
+    def spy(kwargs, keys):
+        body = request_body(kwargs, keys)
+        bodies.append((kwargs, body))
+        return body
+    monkeypatch.setattr(cache, 'request_body', spy)
+    monkeypatch.setattr(mod, 'body_cache', cache)
+    monkeypatch.setattr(mod, 'PREENCODE_ENABLED', True)
+
+    async def run(messages):
+        stream = await mod.stream_chat(messages=messages, context=ctx, thinking_budget=0)
+        return ''.join([chunk async for chunk in stream])
+    asyncio.run(run(history(3)))
+    misses = cache.misses
+    asyncio.run(run(history(4)))
+    assert len(bodies) == 2
+    for kwargs, body in bodies:
+        assert json.loads(body) == sdk_body(kwargs)
+    # The cache breakpoints are in the body wherever they moved to
+    assert any('cache_control' in block for message in json.loads(bodies[1][1])['messages']
+               for block in message['content'])
+    # The second turn reused the system prompt and the earlier history
+    assert cache.hits >= 1 + 6 - 2
+    assert cache.misses - misses <= 4
+
+
+def test_breakpoints_are_part_of_the_key():
+    cache = EncodedBodyCache()
+    normalized = normalize_messages(history(2)[1:])
+    wire = [message.to_wire() for message in normalized]
+    marked = [dict(message, content=[dict(message['content'][0], cache_control={'type': 'ephemeral'})])
+              if i == 1 else message for i, message in enumerate(wire)]
+    plain = {'model': 'm', 'max_tokens': 10, 'stream': True, 'messages': wire, 'extra_headers': {'x': '1'}}
+    cached = dict(plain, messages=marked)
+    assert json.loads(cache.request_body(plain, message_keys(normalized, ()))) == sdk_body(plain)
+    assert json.loads(cache.request_body(cached, message_keys(normalized, [(1, 0)]))) == sdk_body(cached)
+    assert json.loads(cache.request_body(plain, message_keys(normalized, ()))) == sdk_body(plain)
+
+
+def test_file_ref_variant_does_not_leak_into_base64_bodies(monkeypatch):
+    monkeypatch.setattr(images, 'IMAGE_FILES_ENABLED', True)
+
+    async def upload(file):
+        return SimpleNamespace(id='file_1')
+    key = SimpleNamespace(name='k1', client=SimpleNamespace(beta=SimpleNamespace(files=SimpleNamespace(upload=upload))))
+    data = base64.b64encode(b'pixels' * 100).decode('ascii')
+    image = {'type': 'image', 'source': {'type': 'base64', 'media_type': 'image/png', 'data': data}}
+    normalized = normalize_messages([{'role': 'user', 'content': [image]}])
+    wire = [message.to_wire() for message in normalized]
+    store = ImageStore()
+    with_files, uses_files = asyncio.run(store.apply_file_refs(wire, key))
+    assert uses_files
+    cache = EncodedBodyCache()
+    by_file = {'model': 'm', 'max_tokens': 10, 'messages': with_files}
+    inline = dict(by_file, messages=wire)
+    for _ in range(2):
+        assert json.loads(cache.request_body(by_file, message_keys(normalized, (), key.name))) == sdk_body(by_file)
+        assert json.loads(cache.request_body(inline, message_keys(normalized, ()))) == sdk_body(inline)
@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+
+from ah_anthropic.broadcast import StreamBroadcast, tee_stream
+
+CHUNKS = [f'chunk{i} ' for i in range(50)]
+
+
+class Upstream:
+    def __init__(self, chunks=CHUNKS, error=None, forever=False):
+        self.chunks = chunks
+        self.error = error
+        self.forever = forever
+        self.read = 0
+        self.closed = False
+
+    async def __aiter__(self):
+        try:
+            for chunk in self.chunks:
+                await asyncio.sleep(0)
+                self.read += 1
+                yield chunk
+            if self.error is not None:
+                raise self.error
+            while self.forever:
+                await asyncio.sleep(0.001)
+        finally:
+            self.closed = True
+
+
+async def collect(consumer, delay=0.0):
+    received = []
+    async for chunk in consumer:
+        received.append(chunk)
+        if delay:
+            await asyncio.sleep(delay)
+    return received
+
+
+@pytest.mark.parametrize('policy', ['block', 'spill'])
+def test_slow_consumer_gets_the_whole_stream(policy, tmp_path):
+    async def run():
+        upstream = Upstream()
+        broadcast = StreamBroadcast(upstream.__aiter__(), policy=policy, max_buffer=4, spill_dir=tmp_path)
+        fast, slow = broadcast.subscribe('fast'), broadcast.subscribe('slow')
+        consumers = list(broadcast.consumers)
+        results = await asyncio.gather(collect(fast), collect(slow, delay=0.002))
+        return results, consumers, len(broadcast.buffer)
+    (fast, slow), consumers, buffered = asyncio.run(run())
+    assert fast == CHUNKS and slow == CHUNKS
+    assert buffered == 0
+    if policy == 'spill':
+        assert consumers[1].spilled > 0 and consumers[0].spilled == 0
+
+
+def test_drop_reports_dropped_chunks():
+    async def run():
+        broadcast = StreamBroadcast(Upstream().__aiter__(), policy='drop', max_buffer=4)
+        fast, slow = broadcast.subscribe('fast'), broadcast.subscribe('slow')
+        consumers = list(broadcast.consumers)
+        results = await asyncio.gather(collect(fast), collect(slow, delay=0.002))
+        return results, consumers
+    (fast, slow), (fast_state, slow_state) = asyncio.run(run())
+    assert fast == CHUNKS and fast_state.dropped == 0
+    assert slow_state.dropped > 0
+    assert len(slow) + slow_state.dropped == len(CHUNKS)
+    # What the slow consumer does get is in order and ends with the stream
+    assert slow == sorted(slow, key=CHUNKS.index) and slow[-1] == CHUNKS[-1]
+
+
+@pytest.mark.parametrize('policy', ['block', 'drop', 'spill'])
+def test_upstream_error_reaches_every_consumer(policy, tmp_path):
+    async def run():
+        upstream = Upstream(CHUNKS[:3], error=RuntimeError('upstream failed'))
+        consumers = tee_stream(upstream.__aiter__(), n=3, policy=policy, max_buffer=4, spill_dir=tmp_path)
+        return await asyncio.gather(*(collect(c, delay=0.001 * i) for i, c in enumerate(consumers)),
+                                    return_exceptions=True)
+    results = asyncio.run(run())
+    assert len(results) == 3
+    for result in results:
+        assert isinstance(result, RuntimeError) and str(result) == 'upstream failed'
+
+
+def test_upstream_closed_with_the_last_consumer():
+    async def run():
+        upstream = Upstream(CHUNKS[:2], forever=True)
+        first, second = tee_stream(upstream.__aiter__(), n=2)
+        assert await first.__anext__() == CHUNKS[0]
+        assert await second.__anext__() == CHUNKS[0]
+        await first.aclose()
+        assert not upstream.closed
+        assert await second.__anext__() == CHUNKS[1]
+        await second.aclose()
+        return upstream
+    upstream = asyncio.run(run())
+    assert upstream.closed
@@ -0,0 +1,113 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from ah_anthropic.cache_stats import model_costs
+from ah_anthropic import cache_warming as cw
+from ah_anthropic.circuits import CircuitBreaker
+
+
+class FakeKey:
+    def __init__(self, wait=0.0):
+        self.wait = wait
+        self.failures = []
+        self.successes = []
+
+    def wait_time(self, model):
+        return self.wait
+
+    def record_failure(self, model, error=None):
+        self.failures.append(model)
+
+    def record_success(self, model):
+        self.successes.append(model)
+
+
+class FakeStream:
+    def __init__(self, usage):
+        self.usage = usage
+        self.read = 0
+        self.closed = False
+
+    async def __aiter__(self):
+        yield SimpleNamespace(type='message_start', message=SimpleNamespace(usage=self.usage))
+        # Anything after message_start must not be read
+        while True:
+            self.read += 1
+            yield SimpleNamespace(type='content_block_delta')
+
+    async def close(self):
+        self.closed = True
+
+
+def usage(input_tokens=10, cache_read=1000):
+    return SimpleNamespace(input_tokens=input_tokens, output_tokens=0,
+                           cache_creation_input_tokens=0, cache_read_input_tokens=cache_read)
+
+
+class Opened(list):
+    stream = None
+
+
+@pytest.fixture
+def opened(monkeypatch):
+    opened = Opened()
+
+    async def factory(key, kwargs):
+        opened.append(kwargs)
+        opened.stream = FakeStream(usage())
+        return opened.stream
+    monkeypatch.setattr(cw.client_pool, 'stream_factory', factory)
+    monkeypatch.setattr(cw, 'circuit_breaker', CircuitBreaker(fallback_chains={}))
+    return opened
+
+
+def thinking_kwargs(model='claude-opus-4-1'):
+    return {'model': model, 'system': [], 'messages': [{'role': 'user', 'content': 'hi'}],
+            'max_tokens': 64000, 'thinking': {'type': 'enabled', 'budget_tokens': 32000}}
+
+
+def test_refresh_streams_and_stops_at_message_start(opened):
+    warmer = cw.CacheWarmer()
+    key = FakeKey()
+    warmer.sessions['s'] = cw.WarmSession(key, thinking_kwargs())
+    result = asyncio.run(warmer.refresh('s'))
+    assert result.cache_read_input_tokens == 1000
+    assert opened[0]['stream'] is True
+    assert opened[0]['thinking'] == {'type': 'enabled', 'budget_tokens': 32000}
+    assert opened.stream.closed and opened.stream.read == 0
+    assert key.successes == ['claude-opus-4-1']
+    assert warmer.refreshes == 1
+
+
+def test_refresh_is_priced_per_model(opened):
+    warmer = cw.CacheWarmer()
+    warmer.sessions['opus'] = cw.WarmSession(FakeKey(), thinking_kwargs('claude-opus-4-1'))
+    warmer.sessions['haiku'] = cw.WarmSession(FakeKey(), thinking_kwargs('claude-3-5-haiku-latest'))
+    asyncio.run(warmer.refresh('opus'))
+    asyncio.run(warmer.refresh('haiku'))
+    opus_cost, haiku_cost = (cost for _, cost in warmer.spend)
+    assert opus_cost == pytest.approx(cw.estimate_cost(usage(), 'claude-opus-4-1'))
+    assert opus_cost / haiku_cost == pytest.approx(model_costs('claude-opus-4-1')[0] / model_costs('claude-3-5-haiku-latest')[0],
+                                                   rel=0.01)
+
+
+def test_refresh_skipped_while_key_backs_off(opened):
+    warmer = cw.CacheWarmer()
+    warmer.sessions['s'] = cw.WarmSession(FakeKey(wait=5.0), thinking_kwargs())
+    assert asyncio.run(warmer.refresh('s')) is None
+    assert not opened
+    assert warmer.skipped_for_backoff == 1
+
+
+def test_refresh_failure_recorded_on_key(monkeypatch, opened):
+    async def failing(key, kwargs):
+        raise RuntimeError('overloaded')
+    monkeypatch.setattr(cw.client_pool, 'stream_factory', failing)
+    warmer = cw.CacheWarmer()
+    key = FakeKey()
+    warmer.sessions['s'] = cw.WarmSession(key, thinking_kwargs())
+    with pytest.raises(RuntimeError):
+        asyncio.run(warmer.refresh('s'))
+    assert key.failures == ['claude-opus-4-1']
@@ -0,0 +1,124 @@
+import time
+import asyncio
+
+import pytest
+
+from ah_anthropic import mod
+from ah_anthropic import circuits as cb
+from ah_anthropic.circuits import CircuitBreaker, HALF_OPEN, OPEN
+
+MESSAGES = [{'role': 'system', 'content': 'system'}, {'role': 'user', 'content': 'hi'}]
+
+
+def open_circuit(breaker, model):
+    for _ in range(cb.CIRCUIT_FAILURES):
+        breaker.record_failure(model)
+    assert breaker.circuits[model].state == OPEN
+    breaker.circuits[model].opened_at = time.time() - cb.CIRCUIT_OPEN_SECONDS - 1
+
+
+def test_half_open_allows_one_probe():
+    breaker = CircuitBreaker(fallback_chains={})
+    open_circuit(breaker, 'm')
+    assert breaker.allow('m')
+    assert breaker.circuits['m'].state == HALF_OPEN
+    assert not breaker.allow('m')
+    breaker.record_success('m')
+    assert breaker.allow('m')
+
+
+def test_probe_times_out(monkeypatch):
+    breaker = CircuitBreaker(fallback_chains={})
+    open_circuit(breaker, 'm')
+    assert breaker.allow('m')
+    breaker.circuits['m'].probe_started -= cb.CIRCUIT_PROBE_TIMEOUT + 1
+    assert breaker.allow('m')
+
+
+def test_release_probe_only_by_owner():
+    async def run():
+        breaker = CircuitBreaker(fallback_chains={})
+        open_circuit(breaker, 'm')
+
+        async def probe():
+            return breaker.allow('m')
+        assert await asyncio.ensure_future(probe())
+        # Another task cannot release it
+        breaker.release_probe('m')
+        assert breaker.circuits['m'].probe_in_flight
+    asyncio.run(run())
+
+
+@pytest.fixture
+def breaker(monkeypatch):
+    breaker = CircuitBreaker(fallback_chains={'primary': ['fallback']})
+    monkeypatch.setattr(mod, 'circuit_breaker', breaker)
+    return breaker
+
+
+def test_cancelled_probe_is_released(breaker, monkeypatch):
+    async def run():
+        open_circuit(breaker, 'primary')
+        started = asyncio.Event()
+
+        async def hanging_stream(key, kwargs):
+            started.set()
+            await asyncio.sleep(3600)
+        monkeypatch.setattr(mod.client_pool, 'stream_factory', hanging_stream)
+        monkeypatch.setattr(mod, 'get_thinking_budget', lambda context: 0)
+        probe = asyncio.ensure_future(mod.stream_chat('primary', MESSAGES))
+        await started.wait()
+        assert breaker.circuits['primary'].probe_in_flight
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+        circuit = breaker.circuits['primary']
+        assert circuit.state == HALF_OPEN and not circuit.probe_in_flight
+        # The next request probes the primary model instead of going to the fallback
+        assert breaker.choose_model('primary') == 'primary'
+    asyncio.run(run())
+
+
+def test_package_exports_do_not_shadow_modules():
+    import types
+    import pkgutil
+    import ah_anthropic
+    for module in pkgutil.iter_modules(ah_anthropic.__path__):
+        value = getattr(ah_anthropic, module.name, None)
+        assert value is None or isinstance(value, types.ModuleType), module.name
+
+
+def test_fallback_gets_settings_it_supports(monkeypatch, upstream, ctx):
+    breaker = CircuitBreaker(fallback_chains={'claude-sonnet-4-0': ['claude-3-5-haiku-latest']})
+    monkeypatch.setattr(mod, 'circuit_breaker', breaker)
+    open_circuit(breaker, 'claude-sonnet-4-0')
+    breaker.circuits['claude-sonnet-4-0'].opened_at = time.time()
+    history = [{'role': 'system', 'content': 'system'}, {'role': 'user', 'content': 'q'},
+               {'role': 'assistant', 'content': [{'type': 'thinking', 'thinking': 't', 'signature': 's'},
+                                                 {'type': 'text', 'text': 'a'}]},
+               {'role': 'user', 'content': 'next'}]
+
+    async def run():
+        stream = await mod.stream_chat('claude-sonnet-4-0', history, context=ctx, thinking_budget=16000,
+                                       max_tokens=40000, temperature=0.5)
+        return ''.join([chunk async for chunk in stream])
+    assert asyncio.run(run()) == 'ok'
+    sent = upstream.requests[0]
+    assert sent['model'] == 'claude-3-5-haiku-latest'
+    assert 'thinking' not in sent and sent['temperature'] == 0.5
+    assert sent['max_tokens'] <= 8192
+    assert sent['messages'][1]['content'] == [{'type': 'text', 'text': 'a'}]
+
+
+def test_request_errors_are_not_retried(upstream, ctx):
+    import httpx
+    import anthropic
+    request = httpx.Request('POST', 'https://api.anthropic.com/v1/messages')
+    error = anthropic.BadRequestError('bad', response=httpx.Response(400, request=request), body=None)
+    upstream.respond(error, error)
+
+    async def run():
+        await mod.stream_chat('claude-sonnet-4-0', MESSAGES, context=ctx, thinking_budget=0)
+    with pytest.raises(anthropic.BadRequestError):
+        asyncio.run(run())
+    assert len(upstream.requests) == 1
@@ -0,0 +1,36 @@
+import asyncio
+
+from ah_anthropic.coalesce import coalesce_stream
+
+
+def test_slow_consumer_holds_back_source():
+    async def run():
+        pulled = 0
+
+        async def source():
+            nonlocal pulled
+            for _ in range(200):
+                pulled += 1
+                yield 'x' * 10
+                await asyncio.sleep(0)
+        consumed = 0
+        async for text in coalesce_stream(source(), max_latency=0.001, max_chars=50):
+            consumed += len(text)
+            await asyncio.sleep(0.005)
+            # Never more than max_chars plus one chunk read ahead of the consumer
+            assert pulled * 10 - consumed <= 50 + 10
+        assert consumed == 2000
+    asyncio.run(run())
+
+
+def test_batches_and_passes_first_chunk():
+    async def run():
+        async def source():
+            for i in range(5):
+                yield str(i)
+                await asyncio.sleep(0.001)
+        chunks = [text async for text in coalesce_stream(source(), max_latency=0.05)]
+        assert chunks[0] == '0'
+        assert ''.join(chunks) == '01234'
+        assert len(chunks) < 5
+    asyncio.run(run())
@@ -0,0 +1,85 @@
+import asyncio
+
+from ah_anthropic import mod
+from ah_anthropic.fanout import stream_chat_many
+from ah_anthropic.recorder import _to_namespace
+
+EVENTS = [
+    {'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}},
+    {'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': 'ok'}},
+    {'type': 'content_block_stop', 'index': 0},
+    {'type': 'message_delta', 'delta': {'stop_reason': 'end_turn'}, 'usage': {'output_tokens': 1}},
+    {'type': 'message_stop'},
+]
+MESSAGE_START = {'type': 'message_start', 'message': {'usage': {
+    'input_tokens': 5, 'output_tokens': 1, 'cache_creation_input_tokens': 0, 'cache_read_input_tokens': 0}}}
+
+
+class Ctx:
+    agent = {}
+    log_id = 'fanout-test'
+
+    async def track_usage(self, *args, **kwargs):
+        pass
+
+
+class FakeStream:
+    def __init__(self, gate):
+        self.gate = gate
+
+    async def __aiter__(self):
+        await self.gate.wait()
+        for event in [MESSAGE_START] + EVENTS:
+            yield _to_namespace(event)
+
+    async def close(self):
+        pass
+
+
+def test_followers_wait_for_leader_message_start(monkeypatch):
+    async def run():
+        opened = []
+        gate = asyncio.Event()
+
+        async def factory(key, kwargs):
+            opened.append(kwargs)
+            return FakeStream(gate)
+        monkeypatch.setattr(mod.client_pool, 'stream_factory', factory)
+        # With thinking the leader yields a synthetic first chunk before any upstream event
+        monkeypatch.setattr(mod, 'get_thinking_budget', lambda context: 2048)
+        messages = [{'role': 'system', 'content': 'shared'}, {'role': 'user', 'content': 'hi'}]
+        results = await stream_chat_many([{'messages': messages}, {'messages': messages}], context=Ctx())
+        consumer = asyncio.ensure_future(_collect(results))
+        for _ in range(20):
+            await asyncio.sleep(0)
+        assert len(opened) == 1
+        gate.set()
+        done = await consumer
+        assert len(opened) == 2
+        assert all('result' in item for item in done)
+    asyncio.run(run())
+
+
+async def _collect(results):
+    return [item async for item in results]
+
+
+def test_parent_session_state_survives_fanout(upstream, ctx):
+    from ah_anthropic.plan_store import session_plans
+
+    async def run():
+        history = [{'role': 'system', 'content': 'parent'}]
+        for i in range(9):
+            history.append({'role': 'user' if i % 2 == 0 else 'assistant', 'content': f'turn {i}'})
+        stream = await mod.stream_chat(messages=history, context=ctx, thinking_budget=0)
+        [chunk async for chunk in stream]
+        parent_plan = session_plans.fingerprints(ctx.log_id)
+        assert len(parent_plan) == 9
+        items = [{'messages': [{'role': 'system', 'content': 'item'}, {'role': 'user', 'content': str(i)}],
+                  'thinking_budget': 0} for i in range(3)]
+        done = await _collect(await stream_chat_many(items, context=ctx))
+        assert all('result' in item for item in done)
+        assert session_plans.fingerprints(ctx.log_id) == parent_plan
+        for i in range(3):
+            assert len(session_plans.fingerprints(f'{ctx.log_id}/fanout/{i}')) == 1
+    asyncio.run(run())
@@ -0,0 +1,118 @@
+import asyncio
+import base64
+from types import SimpleNamespace
+
+import pytest
+
+from ah_anthropic import mod
+from ah_anthropic import images
+from ah_anthropic.images import ImageStore
+from ah_anthropic.normalized import NormalizedCache, NormalizedMessage, IMAGE_TOKENS
+
+Image = pytest.importorskip('PIL.Image')
+
+
+def image_block(payload):
+    data = base64.b64encode(payload).decode('ascii')
+    return {'type': 'image', 'source': {'type': 'base64', 'media_type': 'image/png', 'data': data}}
+
+
+def test_image_store_bounded_by_bytes():
+    store = ImageStore(max_bytes=3000)
+    blocks = [image_block(bytes([i]) * 900) for i in range(4)]
+    digests = [store.intern(block)[1] for block in blocks]
+    # 1200 base64 chars each, so only the last two fit
+    assert store.interned(digests[0]) is None
+    assert store.interned(digests[3]) is blocks[3]
+    assert store._interned_size <= 3000 and store._digests_size <= 3000
+    # Too large to keep at all, but still hashed
+    big = image_block(b'x' * 3000)
+    assert store.intern(big) == (big, store.digest(big['source']['data']))
+
+
+def test_message_cache_bounded_by_bytes():
+    cache = NormalizedCache(max_bytes=10000)
+    messages = [{'role': 'user', 'content': 'x' * 4000} for _ in range(3)]
+    for message in messages:
+        cache.put(message, NormalizedMessage(message))
+    assert len(cache) == 2 and cache.size <= 10000
+    assert cache.get(messages[0]) is None
+    assert cache.get(messages[2]) is not None
+
+
+def test_format_image_message_follows_mutation():
+    image = Image.new('RGB', (8, 8), 'red')
+    first = asyncio.run(mod.format_image_message(image))
+    again = asyncio.run(mod.format_image_message(image))
+    assert again['source'] is first['source']
+    image.putpixel((0, 0), (0, 0, 255))
+    changed = asyncio.run(mod.format_image_message(image))
+    assert changed['source']['data'] != first['source']['data']
+    # Equal pixels in a different object share the encoding
+    copy = image.copy()
+    assert asyncio.run(mod.format_image_message(copy))['source'] is changed['source']
+
+
+class FakeFiles:
+    def __init__(self):
+        self.uploaded = []
+        self.deleted = []
+
+    async def upload(self, file):
+        self.uploaded.append(file[0])
+        return SimpleNamespace(id=f'file_{len(self.uploaded)}')
+
+    async def delete(self, file_id):
+        self.deleted.append(file_id)
+
+
+def fake_key(name='k1'):
+    files = FakeFiles()
+    return SimpleNamespace(name=name, client=SimpleNamespace(beta=SimpleNamespace(files=files))), files
+
+
+def tool_result_with(image):
+    return {'role': 'user', 'content': [{'type': 'tool_result', 'tool_use_id': 't1',
+                                         'content': [{'type': 'text', 'text': 'screenshot'}, image]}]}
+
+
+def test_files_reused_while_interned_and_deleted_on_eviction(monkeypatch):
+    monkeypatch.setattr(images, 'IMAGE_FILES_ENABLED', True)
+    store = ImageStore(max_bytes=3000)
+    key, files = fake_key()
+
+    async def run():
+        first = image_block(b'a' * 900)
+        message = {'role': 'user', 'content': [first]}
+        for _ in range(3):
+            sent, used = await store.apply_file_refs([message], key)
+            assert used and sent[0]['content'][0]['source'] == {'type': 'file', 'file_id': 'file_1'}
+        assert len(files.uploaded) == 1
+        # Two more images push the first one out of the store
+        for payload in (b'b' * 900, b'c' * 900):
+            await store.apply_file_refs([{'role': 'user', 'content': [image_block(payload)]}], key)
+        await asyncio.sleep(0)
+        assert files.deleted == ['file_1']
+        sent, _ = await store.apply_file_refs([message], key)
+        assert sent[0]['content'][0]['source']['file_id'] == 'file_4'
+    asyncio.run(run())
+
+
+def test_nested_screenshots_are_interned_and_sent_as_files(monkeypatch):
+    monkeypatch.setattr(images, 'IMAGE_FILES_ENABLED', True)
+    key, files = fake_key()
+    screenshot = image_block(b'screen' * 100)
+    first = NormalizedMessage(tool_result_with(screenshot))
+    second = NormalizedMessage(tool_result_with(image_block(b'screen' * 100)))
+    # The second copy is replaced by the interned block of the first
+    assert second.blocks[0]['content'][1] is first.blocks[0]['content'][1]
+    assert first.fingerprint == second.fingerprint
+    assert first.approx_tokens < 100 + IMAGE_TOKENS
+
+    async def run():
+        return await images.image_store.apply_file_refs([second.to_wire()], key)
+    sent, used = asyncio.run(run())
+    assert used and len(files.uploaded) == 1
+    nested = sent[0]['content'][0]['content']
+    assert nested[0] == {'type': 'text', 'text': 'screenshot'}
+    assert nested[1]['source']['type'] == 'file'
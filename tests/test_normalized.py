@@ -0,0 +1,53 @@
+import copy
+import base64
+
+import pytest
+
+from ah_anthropic.normalized import normalize_message, NormalizedMessage
+
+
+def tool_message():
+    return {'role': 'assistant', 'content': [
+        {'type': 'text', 'text': 'Running it'},
+        {'type': 'tool_use', 'id': 't1', 'name': 'run', 'input': {'args': ['ls', '-l'], 'cwd': '/tmp'}},
+    ]}
+
+
+def tool_result_message():
+    data = base64.b64encode(b'png').decode('ascii')
+    return {'role': 'user', 'content': [
+        {'type': 'tool_result', 'tool_use_id': 't1', 'content': [
+            {'type': 'text', 'text': 'done'},
+            {'type': 'image', 'source': {'type': 'base64', 'media_type': 'image/png', 'data': data}},
+        ]},
+    ]}
+
+
+def test_unchanged_message_is_reused():
+    message = tool_message()
+    first = normalize_message(message)
+    assert normalize_message(message) is first
+    string_message = {'role': 'user', 'content': 'hello'}
+    assert normalize_message(string_message) is normalize_message(string_message)
+
+
+@pytest.mark.parametrize('build, mutate', [
+    (tool_message, lambda m: m['content'][0].__setitem__('text', 'Changed')),
+    (tool_message, lambda m: m['content'].append({'type': 'text', 'text': 'more'})),
+    (tool_message, lambda m: m['content'][1]['input'].__setitem__('cwd', '/home')),
+    (tool_message, lambda m: m['content'][1]['input']['args'].append('-a')),
+    (tool_message, lambda m: m['content'][1]['input'].update(args=['ls', '-l'])),
+    (tool_message, lambda m: m['content'][1]['input'].update(extra=1)),
+    (tool_message, lambda m: m.__setitem__('role', 'user')),
+    (tool_result_message, lambda m: m['content'][0]['content'][0].__setitem__('text', 'failed')),
+    (tool_result_message, lambda m: m['content'][0]['content'][1]['source'].__setitem__(
+        'data', base64.b64encode(b'other').decode('ascii'))),
+])
+def test_nested_change_invalidates(build, mutate):
+    message = build()
+    first = normalize_message(message)
+    assert first.fingerprint
+    mutate(message)
+    second = normalize_message(message)
+    assert second is not first
+    assert second.fingerprint == NormalizedMessage(copy.deepcopy(message)).fingerprint
@@ -0,0 +1,87 @@
+import asyncio
+
+from conftest import stream_events
+from ah_anthropic import mod
+from ah_anthropic.output_sizing import OutputSizer, MIN_SAMPLES, CONTEXT_MARGIN, continuation_messages
+
+MODEL = 'claude-sonnet-4-5'
+MESSAGES = [{'role': 'system', 'content': 's'}, {'role': 'user', 'content': 'q'}]
+
+
+def trained_sizer(tokens=1000, samples=MIN_SAMPLES):
+    sizer = OutputSizer()
+    for _ in range(samples):
+        sizer.record('agent', MODEL, tokens)
+    return sizer
+
+
+def test_default_until_enough_samples():
+    sizer = trained_sizer(samples=MIN_SAMPLES - 1)
+    assert sizer.size('agent', MODEL, 32000) == (32000, 0)
+
+
+def test_percentile_with_margin():
+    sizer = trained_sizer()
+    # 1000 * 1.25 rounded up to 256
+    assert sizer.size('agent', MODEL, 32000) == (1280, 0)
+    assert sizer.size('other', MODEL, 32000) == (32000, 0)
+    assert sizer.size('agent', MODEL, 32000, adaptive=False) == (32000, 0)
+    # Never more than the caller's default
+    assert sizer.size('agent', MODEL, 1100) == (1100, 0)
+
+
+def test_percentile_leaves_room_for_thinking():
+    assert trained_sizer().size('agent', MODEL, 32000, thinking_budget=2048) == (3072, 2048)
+
+
+def test_capped_by_context_headroom():
+    sizer = OutputSizer()
+    assert sizer.size('agent', MODEL, 32000, input_tokens=190000) == (10000 - CONTEXT_MARGIN, 0)
+    # Thinking does not fit in what is left, so it is turned off
+    assert sizer.size('agent', MODEL, 32000, thinking_budget=2048, input_tokens=199000) == (1024, 0)
+
+
+def test_thinking_budget_shrunk_or_disabled():
+    sizer = OutputSizer()
+    assert sizer.size('agent', MODEL, 4096, thinking_budget=8000) == (4096, 3072)
+    assert sizer.size('agent', MODEL, 1536, thinking_budget=8000) == (1536, 0)
+    assert sizer.size('agent', 'claude-3-5-haiku-latest', 32000, thinking_budget=2048) == (8192, 0)
+
+
+def test_continuation_prefill():
+    messages = continuation_messages(MESSAGES, '[{"say": "hel \n')
+    assert messages[:-1] == MESSAGES
+    assert messages[-1] == {'role': 'assistant', 'content': [{'type': 'text', 'text': '[{"say": "hel'}]}
+    assert continuation_messages(MESSAGES, ' \n') is MESSAGES
+
+
+def run_chat(ctx, thinking_budget=0, **kwargs):
+    async def run():
+        stream = await mod.stream_chat(model=MODEL, messages=MESSAGES, context=ctx, thinking_budget=thinking_budget, **kwargs)
+        return ''.join([chunk async for chunk in stream])
+    return asyncio.run(run())
+
+
+def test_truncated_answer_continued_with_prefill(upstream, ctx):
+    upstream.respond(stream_events('[{"say": "hel', stop_reason='max_tokens'), stream_events('lo"}]'))
+    assert run_chat(ctx) == '[{"say": "hello"}]'
+    assert len(upstream.requests) == 2
+    assert upstream.requests[1]['messages'][-1] == {'role': 'assistant', 'content': [{'type': 'text', 'text': '[{"say": "hel'}]}
+
+
+def test_out_of_tokens_while_thinking(upstream, ctx):
+    thinking_only = stream_events(text=None, thinking='hmm', stop_reason='max_tokens')
+    # Truncated inside the thinking block, so it never closes
+    thinking_only = [e for e in thinking_only if e['type'] != 'content_block_stop']
+    upstream.respond(thinking_only, stream_events('[{"say": "hi"}]'))
+    assert run_chat(ctx, thinking_budget=2048) == '[{"reasoning": "hmm"}, {"say": "hi"}]'
+    assert 'thinking' in upstream.requests[0]
+    assert 'thinking' not in upstream.requests[1]
+    assert upstream.requests[1]['messages'][-1]['role'] == 'user'
+
+
+def test_stops_at_max_continuations(upstream, ctx, monkeypatch):
+    monkeypatch.setattr(mod, 'MAX_CONTINUATIONS', 2)
+    upstream.respond(*[stream_events(part, stop_reason='max_tokens') for part in ('a', 'b', 'c', 'd')])
+    assert run_chat(ctx) == 'abc'
+    assert len(upstream.requests) == 3
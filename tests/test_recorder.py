@@ -0,0 +1,67 @@
+import gzip
+import json
+import asyncio
+
+from ah_anthropic import mod
+from ah_anthropic.recorder import replay_recording
+
+EVENTS = [
+    {'type': 'message_start', 'message': {'usage': {'input_tokens': 5, 'output_tokens': 1,
+                                                     'cache_creation_input_tokens': 0, 'cache_read_input_tokens': 0}}},
+    {'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}},
+    {'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': 'hello'}},
+    {'type': 'content_block_stop', 'index': 0},
+    {'type': 'message_delta', 'delta': {'stop_reason': 'end_turn'}, 'usage': {'output_tokens': 2}},
+    {'type': 'message_stop'},
+]
+
+
+def write_recording(path, kwargs):
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        f.write(json.dumps({'kwargs': kwargs, 'recorded_at': 0}) + '\n')
+        for event in EVENTS:
+            f.write(json.dumps([0, event]) + '\n')
+
+
+class Ctx:
+    agent = {}
+    log_id = 'replay-test'
+
+    async def track_usage(self, *args, **kwargs):
+        pass
+
+
+def replayed_kwargs(tmp_path, monkeypatch, recorded):
+    path = tmp_path / 'rec.jsonl.gz'
+    write_recording(path, recorded)
+    sent = []
+    create_stream = mod.client_pool.create_stream
+
+    async def capture(key, kwargs, body=None):
+        sent.append(kwargs)
+        return await create_stream(key, kwargs, body)
+    monkeypatch.setattr(mod.client_pool, 'create_stream', capture)
+    # Configured settings that must not leak into the replay
+    monkeypatch.setenv('MR_THINKING_LEVEL', 'high')
+    report = asyncio.run(replay_recording(str(path), speed=0, context=Ctx()))
+    assert 'hello' in report['output']
+    return sent[0]
+
+
+def test_replay_uses_recorded_settings(tmp_path, monkeypatch):
+    kwargs = replayed_kwargs(tmp_path, monkeypatch, {
+        'model': 'claude-sonnet-4-0', 'system': 'sys', 'messages': [{'role': 'user', 'content': 'hi'}],
+        'max_tokens': 6000, 'temperature': 1, 'stop_sequences': ['END'],
+        'thinking': {'type': 'enabled', 'budget_tokens': 2048}})
+    assert kwargs['thinking'] == {'type': 'enabled', 'budget_tokens': 2048}
+    assert kwargs['max_tokens'] == 6000
+    assert kwargs['stop_sequences'] == ['END']
+
+
+def test_replay_without_thinking(tmp_path, monkeypatch):
+    kwargs = replayed_kwargs(tmp_path, monkeypatch, {
+        'model': 'claude-sonnet-4-0', 'system': 'sys', 'messages': [{'role': 'user', 'content': 'hi'}],
+        'max_tokens': 3000, 'temperature': 0.0})
+    assert 'thinking' not in kwargs
+    assert kwargs['max_tokens'] == 3000
+    assert 'stop_sequences' not in kwargs
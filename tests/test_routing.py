@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+
+from ah_anthropic import mod
+from ah_anthropic.routing import ModelRouter, DEFAULT_RULES
+from ah_anthropic.output_sizing import OutputSizer
+
+HAIKU = 'claude-3-5-haiku-latest'
+MESSAGES = [{'role': 'system', 'content': 'short system'}, {'role': 'user', 'content': 'hi'}]
+
+
+@pytest.fixture
+def router(monkeypatch):
+    router = ModelRouter(rules=list(DEFAULT_RULES), enabled=True)
+    monkeypatch.setattr(mod, 'model_router', router)
+    return router
+
+
+def run_chat(ctx, **kwargs):
+    async def run():
+        stream = await mod.stream_chat(messages=MESSAGES, context=ctx, **kwargs)
+        return ''.join([chunk async for chunk in stream])
+    return asyncio.run(run())
+
+
+def test_routed_request_with_thinking_stays_on_thinking_model(router, upstream, ctx, monkeypatch):
+    monkeypatch.setattr(mod, 'get_thinking_budget', lambda context: 8000)
+    run_chat(ctx)
+    sent = upstream.requests[0]
+    assert sent['model'] == mod.DEFAULT_MODEL
+    assert sent['thinking']['budget_tokens'] == 8000
+    assert router.log[-1]['features']['thinking'] is True
+
+
+def test_small_request_without_thinking_goes_to_haiku_within_its_limits(router, upstream, ctx):
+    run_chat(ctx, thinking_budget=0, max_tokens=16000)
+    sent = upstream.requests[0]
+    assert sent['model'] == HAIKU
+    assert 'thinking' not in sent
+    assert sent['max_tokens'] <= 8192
+
+
+def test_rule_for_model_without_thinking_is_skipped(router, upstream, ctx):
+    router.rules = [{'when': {}, 'model': HAIKU}]
+    run_chat(ctx, thinking_budget=4000)
+    assert upstream.requests[0]['model'] == mod.DEFAULT_MODEL
+    assert router.log[-1]['skipped'] == [{'model': HAIKU, 'reason': 'no thinking support'}]
+
+
+def test_size_applies_model_limits():
+    sizer = OutputSizer()
+    assert sizer.size('a', HAIKU, 16000, thinking_budget=8000) == (8192, 0)
+    assert sizer.size('a', 'claude-opus-4-1', 64000, thinking_budget=8000) == (32000, 8000)
+    # Unknown models are not capped
+    assert sizer.size('a', 'some-new-model', 100000, thinking_budget=8000, context_window=1000000) == (100000, 8000)
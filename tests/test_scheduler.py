@@ -0,0 +1,117 @@
+import time
+import asyncio
+from types import SimpleNamespace
+
+from ah_anthropic import scheduler
+from ah_anthropic.scheduler import RequestScheduler
+
+
+def ctx(priority, agent='agent', user='user'):
+    return SimpleNamespace(data={'priority': priority}, agent={'name': agent}, username=user)
+
+
+def test_disabled_by_default_admits_everything():
+    async def run():
+        sched = RequestScheduler(max_concurrent=0)
+        releases = [await sched.acquire(ctx('normal')) for _ in range(50)]
+        assert sched.active == 50 and not sched.queue
+        for release in releases:
+            release()
+        assert sched.active == 0
+    asyncio.run(run())
+
+
+def test_admission_limit_and_release():
+    async def run():
+        sched = RequestScheduler(max_concurrent=3, reserved_interactive=0)
+        releases = [await sched.acquire(ctx('normal')) for _ in range(3)]
+        waiting = asyncio.ensure_future(sched.acquire(ctx('normal')))
+        await asyncio.sleep(0)
+        assert not waiting.done() and sched.queue_depth() == 1
+        releases[0]()
+        release = await asyncio.wait_for(waiting, 1)
+        assert sched.active == 3
+        release()
+        release()  # releasing twice is a no-op
+        assert sched.active == 2
+    asyncio.run(run())
+
+
+def test_reserved_slots_only_for_interactive():
+    async def run():
+        sched = RequestScheduler(max_concurrent=3, reserved_interactive=1)
+        await sched.acquire(ctx('background'))
+        await sched.acquire(ctx('background'))
+        blocked = asyncio.ensure_future(sched.acquire(ctx('background')))
+        await asyncio.sleep(0)
+        assert not blocked.done()
+        interactive = await asyncio.wait_for(sched.acquire(ctx('interactive')), 1)
+        assert sched.active == 3
+        interactive()
+        await asyncio.sleep(0)
+        # The freed reserved slot is not handed to background work
+        assert not blocked.done()
+        blocked.cancel()
+    asyncio.run(run())
+
+
+def test_aged_background_does_not_block_interactive(monkeypatch):
+    async def run():
+        sched = RequestScheduler(max_concurrent=2, reserved_interactive=1)
+        monkeypatch.setattr(scheduler, 'QUEUE_AGING', 10)
+        busy = await sched.acquire(ctx('background'))
+        aged = asyncio.ensure_future(sched.acquire(ctx('background')))
+        await asyncio.sleep(0)
+        # Aged past two classes, it sorts ahead of any interactive waiter
+        sched.queue[0].enqueued -= 25
+        sched.active += 1  # the reserved slot is taken too
+        interactive = asyncio.ensure_future(sched.acquire(ctx('interactive')))
+        await asyncio.sleep(0)
+        assert not interactive.done()
+        sched.active -= 1
+        sched._dispatch()
+        await asyncio.sleep(0)
+        assert interactive.done() and not aged.done()
+        busy()
+        interactive.result()()
+        await asyncio.wait_for(aged, 1)
+    asyncio.run(run())
+
+
+def test_aging_moves_background_ahead_of_normal(monkeypatch):
+    async def run():
+        sched = RequestScheduler(max_concurrent=1, reserved_interactive=0)
+        monkeypatch.setattr(scheduler, 'QUEUE_AGING', 10)
+        release = await sched.acquire(ctx('normal'))
+        background = asyncio.ensure_future(sched.acquire(ctx('background', agent='b')))
+        await asyncio.sleep(0)
+        normal = asyncio.ensure_future(sched.acquire(ctx('normal', agent='n')))
+        await asyncio.sleep(0)
+        sched.queue[0].enqueued = time.monotonic() - 15
+        release()
+        await asyncio.sleep(0)
+        assert background.done() and not normal.done()
+        normal.cancel()
+    asyncio.run(run())
+
+
+def test_priority_and_fair_share_order():
+    async def run():
+        sched = RequestScheduler(max_concurrent=1, reserved_interactive=0)
+        release = await sched.acquire(ctx('background', agent='a'))
+        order = []
+
+        async def request(name, context):
+            done = await sched.acquire(context)
+            order.append(name)
+            done()
+        tasks = [asyncio.ensure_future(request(f'a{i}', ctx('background', agent='a'))) for i in range(3)]
+        tasks += [asyncio.ensure_future(request(f'b{i}', ctx('background', agent='b'))) for i in range(2)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.ensure_future(request('user', ctx('interactive'))))
+        await asyncio.sleep(0)
+        release()
+        await asyncio.gather(*tasks)
+        assert order[0] == 'user'
+        assert order[1:] == ['a0', 'b0', 'a1', 'b1', 'a2']
+    asyncio.run(run())
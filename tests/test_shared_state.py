@@ -0,0 +1,72 @@
+import time
+import asyncio
+
+from ah_anthropic import clients
+from ah_anthropic import shared_state
+from ah_anthropic.clients import ApiKeyState
+from ah_anthropic.shared_state import SharedStateStore
+
+
+def expire_cache(store):
+    store._cache.clear()
+
+
+def test_two_stores_share_backoff(tmp_path, monkeypatch):
+    path = str(tmp_path / 'state.db')
+    first, second = SharedStateStore(path), SharedStateStore(path)
+    worker_a, worker_b = ApiKeyState('sk-shared', 0), ApiKeyState('sk-shared', 0)
+    monkeypatch.setattr(clients, 'shared_state', first)
+    worker_a.record_failure('m')
+    monkeypatch.setattr(clients, 'shared_state', second)
+    assert worker_b.wait_time('m') > 0
+    # Success on one worker clears it for the other
+    monkeypatch.setattr(clients, 'shared_state', first)
+    worker_a.record_success('m')
+    monkeypatch.setattr(clients, 'shared_state', second)
+    expire_cache(second)
+    assert worker_b.wait_time('m') == 0
+
+
+def test_expired_entries_are_ignored(tmp_path):
+    path = str(tmp_path / 'state.db')
+    first, second = SharedStateStore(path), SharedStateStore(path)
+    first.put('short', 1, 0.05)
+    first.put('long', 2, 60)
+    assert second.get('short') == 1
+    time.sleep(0.06)
+    expire_cache(second)
+    assert second.get('short') is None and second.get('long') == 2
+    first.purge_expired()
+    assert first._conn.execute('SELECT name FROM state').fetchall() == [('long',)]
+
+
+def test_writes_inside_a_loop_go_to_a_thread(tmp_path, monkeypatch):
+    path = str(tmp_path / 'state.db')
+    first, second = SharedStateStore(path), SharedStateStore(path)
+    executed = []
+    execute = first._execute_in_thread
+    monkeypatch.setattr(first, '_execute_in_thread', lambda *args: executed.append(args) or execute(*args))
+
+    async def run():
+        first.put('name', 'value', 60)
+        first.flush()
+    asyncio.run(run())
+    assert len(executed) == 1
+    assert second.get('name') == 'value'
+
+
+def test_rate_limit_headers_published_at_most_every_read_interval(monkeypatch):
+    puts = []
+
+    class Store:
+        def put(self, name, value, ttl):
+            puts.append(name)
+    monkeypatch.setattr(clients, 'shared_state', Store())
+    key = ApiKeyState('sk-headers', 0)
+    headers = {'anthropic-ratelimit-requests-limit': '100', 'anthropic-ratelimit-requests-remaining': '50'}
+    for _ in range(10):
+        key.update_from_headers(headers)
+    assert len(puts) == 1
+    key._published -= shared_state.READ_CACHE_SECONDS
+    key.update_from_headers(headers)
+    assert len(puts) == 2
@@ -0,0 +1,48 @@
+import io
+import asyncio
+
+from ah_anthropic.sink import SinkWriter, drain_to_sink, is_binary_sink
+
+
+async def chunks(*parts):
+    for part in parts:
+        yield part
+
+
+class FakeStreamWriter:
+    def __init__(self):
+        self.data = b''
+        self.drains = 0
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        self.drains += 1
+
+
+def test_text_sinks_get_str():
+    written = []
+    assert not is_binary_sink(io.StringIO())
+    assert not is_binary_sink(written.append)
+
+    class Collector:
+        def write(self, text):
+            written.append(text)
+    assert not is_binary_sink(Collector())
+    summary = asyncio.run(drain_to_sink(chunks('hé', 'llo'), SinkWriter(Collector())))
+    assert written == ['hé', 'llo']
+    assert summary['chars'] == 5 and summary['bytes'] == 6
+
+
+def test_binary_sinks_get_bytes(tmp_path):
+    assert is_binary_sink(io.BytesIO())
+    with open(tmp_path / 'out', 'wb') as f:
+        assert is_binary_sink(f)
+        asyncio.run(drain_to_sink(chunks('hé', 'llo'), SinkWriter(f)))
+    assert (tmp_path / 'out').read_bytes() == 'héllo'.encode('utf-8')
+    with open(tmp_path / 'out', 'w') as f:
+        assert not is_binary_sink(f)
+    writer = FakeStreamWriter()
+    asyncio.run(drain_to_sink(chunks('a', 'b'), SinkWriter(writer)))
+    assert writer.data == b'ab' and writer.drains == 2
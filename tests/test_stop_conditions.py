@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+
+from conftest import stream_events
+from ah_anthropic import mod
+from ah_anthropic.stop_conditions import (BalancedJsonStop, FirstCommandStop, PredicateStop, StopCondition,
+                                          make_stop_condition, stop_sequences_for)
+
+
+def feed_all(condition, chunks):
+    """Output up to the stop, or None if the condition never matched"""
+    out = []
+    for chunk in chunks:
+        cut = condition.feed(chunk)
+        if cut is not None:
+            out.append(chunk[:cut] + condition.suffix)
+            return ''.join(out)
+        out.append(chunk)
+    return None
+
+
+def test_make_stop_condition():
+    assert make_stop_condition(None) is None
+    assert make_stop_condition('END') is None
+    assert make_stop_condition(['a', 'b']) is None
+    assert isinstance(make_stop_condition('json_closed'), BalancedJsonStop)
+    assert isinstance(make_stop_condition('first_command'), FirstCommandStop)
+    assert isinstance(make_stop_condition(lambda text: False), PredicateStop)
+    custom = StopCondition()
+    assert make_stop_condition(custom) is custom
+
+
+def test_stop_sequences_for():
+    assert stop_sequences_for('END') == ['END']
+    assert stop_sequences_for(('a', 'b')) == ['a', 'b']
+    assert stop_sequences_for('json_closed') is None
+    assert stop_sequences_for(lambda text: False) is None
+    assert stop_sequences_for(['a', 1]) is None
+    assert stop_sequences_for(None) is None
+
+
+@pytest.mark.parametrize('chunks, expected', [
+    (['{"a": 1}', ' trailing'], '{"a": 1}'),
+    (['[{"a": [1, ', '{"b": 2}]}', ']', ' more'], '[{"a": [1, {"b": 2}]}]'),
+    (['{"s": "}]{["', ', "t": 1} x'], '{"s": "}]{[", "t": 1}'),
+    (['{"s": "a \\"}', '\\" b"}', '}'], '{"s": "a \\"}\\" b"}'),
+    (['{"s": "back\\\\', '"} x'], '{"s": "back\\\\"}'),
+    (['text before ', '[1, 2]', 'after'], 'text before [1, 2]'),
+])
+def test_balanced_json_stop(chunks, expected):
+    assert feed_all(BalancedJsonStop(), chunks) == expected
+
+
+def test_balanced_json_stop_waits_for_structure():
+    assert feed_all(BalancedJsonStop(), ['no json ', '"]}"', ' here']) is None
+
+
+@pytest.mark.parametrize('chunks, expected', [
+    (['[{"say": {"text": "}"}}, ', '{"next": 1}]'], '[{"say": {"text": "}"}}]'),
+    (['[', '{"a": [1]}', ',{"b": 2}]'], '[{"a": [1]}]'),
+])
+def test_first_command_stop(chunks, expected):
+    assert feed_all(FirstCommandStop(), chunks) == expected
+
+
+def test_predicate_sees_a_bounded_window():
+    seen = []
+    condition = PredicateStop(lambda text: seen.append(len(text)) or text.endswith('STOP'), window=16)
+    assert feed_all(condition, ['x' * 100, 'y' * 10, 'ST', 'OP', 'never']) == 'x' * 100 + 'y' * 10 + 'STOP'
+    assert max(seen) == 16 and len(condition.text) <= 16
+
+
+def thinking_then(*texts):
+    events = stream_events(text=None, thinking='t')[:-2]
+    index = 1
+    events.append({'type': 'content_block_start', 'index': index, 'content_block': {'type': 'text', 'text': ''}})
+    for text in texts:
+        events.append({'type': 'content_block_delta', 'index': index, 'delta': {'type': 'text_delta', 'text': text}})
+    events += [{'type': 'content_block_stop', 'index': index},
+               {'type': 'message_delta', 'delta': {'stop_reason': 'end_turn'}, 'usage': {'output_tokens': 3}},
+               {'type': 'message_stop'}]
+    return events
+
+
+def test_stop_on_whitespace_chunk_after_reasoning(upstream, ctx):
+    upstream.respond(thinking_then('\n', ' [{"more": 1}]'))
+
+    async def run():
+        stream = await mod.stream_chat(messages=[{'role': 'system', 'content': 's'}, {'role': 'user', 'content': 'q'}],
+                                       context=ctx, thinking_budget=2048, stop=lambda text: '\n' in text)
+        return ''.join([chunk async for chunk in stream])
+    output = asyncio.run(run())
+    assert output == '[{"reasoning": "t"}, '
+    # Nothing after the matching delta was read
+    events = upstream.streams[0].events
+    assert upstream.streams[0].read == events.index(next(e for e in events if e.get('delta', {}).get('text') == '\n')) + 1
@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+
+from ah_anthropic.stream_control import iterate_with_idle_timeout, StreamIdleTimeout
+
+
+async def events(delays):
+    for i, delay in enumerate(delays):
+        await asyncio.sleep(delay)
+        yield i
+
+
+async def collect(stream, hold=0.0):
+    items = []
+    async for item in stream:
+        items.append(item)
+        await asyncio.sleep(hold)
+    return items
+
+
+def test_stalled_stream_times_out():
+    async def run():
+        stream = iterate_with_idle_timeout(events([0, 0.01, 0.5]), timeout=0.1)
+        with pytest.raises(StreamIdleTimeout):
+            await collect(stream)
+    asyncio.run(run())
+
+
+def test_deadline_resets_on_each_event():
+    async def run():
+        # Longer than the timeout in total, but never idle that long
+        assert await collect(iterate_with_idle_timeout(events([0.04] * 8), timeout=0.1)) == list(range(8))
+    asyncio.run(run())
+
+
+def test_slow_consumer_does_not_count_as_idle():
+    async def run():
+        stream = iterate_with_idle_timeout(events([0] * 3), timeout=0.05)
+        assert await collect(stream, hold=0.12) == [0, 1, 2]
+    asyncio.run(run())
+
+
+def test_outside_cancellation_is_not_a_timeout():
+    async def run():
+        task = asyncio.ensure_future(collect(iterate_with_idle_timeout(events([10]), timeout=5)))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    asyncio.run(run())
@@ -0,0 +1,98 @@
+import asyncio
+import hashlib
+
+import pytest
+
+from conftest import stream_events
+from ah_anthropic import mod
+from ah_anthropic import thinking_blocks
+from ah_anthropic.normalized import normalize_messages
+from ah_anthropic.recorder import _to_namespace
+from ah_anthropic.thinking_blocks import ThinkingStore, TurnCapture, TextDigest, _text_key
+
+SYSTEM = {'role': 'system', 'content': 'system'}
+
+
+def capture_of(events):
+    capture = TurnCapture()
+    for event in events:
+        capture.feed(_to_namespace(event))
+    return capture
+
+
+@pytest.mark.parametrize('chunks', [
+    ['  hello', ' world  ', '\n', ''],
+    ['\n', ' ', 'a', ' ', ' ', 'b', '\t'],
+    ['   '],
+    ['x'],
+])
+def test_text_digest_matches_stripped_text(chunks):
+    digest = TextDigest()
+    for chunk in chunks:
+        digest.update(chunk)
+    expected = hashlib.blake2b(''.join(chunks).strip().encode('utf-8'), digest_size=16).digest()
+    assert digest.digest() == expected == _text_key(''.join(chunks))
+
+
+def test_capture_rebuilds_blocks_from_deltas():
+    events = stream_events(text='answer', thinking='first ')
+    # A second thinking delta for the same block
+    events.insert(3, {'type': 'content_block_delta', 'index': 0,
+                      'delta': {'type': 'thinking_delta', 'thinking': 'second'}})
+    capture = capture_of(events)
+    assert capture.complete and capture.has_thinking()
+    assert capture.content() == [{'type': 'thinking', 'thinking': 'first second', 'signature': 'sig'},
+                                 {'type': 'text', 'text': 'answer'}]
+
+
+def test_incomplete_or_thinking_free_turns_are_not_remembered():
+    store = ThinkingStore()
+    store.remember('s', _text_key('answer'), capture_of(stream_events(text='answer')))
+    incomplete = capture_of(stream_events(text='answer', thinking='t')[:-1])
+    store.remember('s', _text_key('answer'), incomplete)
+    assert not store.sessions
+
+
+def test_restore_replaces_matching_assistant_turn():
+    store = ThinkingStore()
+    capture = capture_of(stream_events(text='answer', thinking='because'))
+    store.remember('s', _text_key('[{"reasoning": "because"}, answer'), capture)
+    history = normalize_messages([{'role': 'user', 'content': 'q'},
+                                  {'role': 'assistant', 'content': '[{"reasoning": "because"}, answer\n'},
+                                  {'role': 'assistant', 'content': 'something else'}])
+    restored = store.restore('s', history)
+    assert restored[0] is history[0] and restored[2] is history[2]
+    assert restored[1].blocks[0] == {'type': 'thinking', 'thinking': 'because', 'signature': 'sig'}
+    # Other sessions are untouched
+    assert store.restore('other', history) is history
+
+
+def run_turn(ctx, messages):
+    async def run():
+        stream = await mod.stream_chat(messages=messages, context=ctx, thinking_budget=2048)
+        return ''.join([chunk async for chunk in stream])
+    return asyncio.run(run())
+
+
+def test_thinking_is_replayed_on_the_next_turn(upstream, ctx):
+    ctx.log_id = 'replay-thinking'
+    upstream.respond(stream_events(text='[{"say": "hi"}]', thinking='plan'))
+    first = [SYSTEM, {'role': 'user', 'content': 'hello'}]
+    output = run_turn(ctx, first)
+    assert output == '[{"reasoning": "plan"}, {"say": "hi"}]'
+    run_turn(ctx, first + [{'role': 'assistant', 'content': output}, {'role': 'user', 'content': 'again'}])
+    replayed = upstream.requests[1]['messages'][1]['content']
+    assert replayed[0] == {'type': 'thinking', 'thinking': 'plan', 'signature': 'sig'}
+    assert replayed[1]['text'] == '[{"say": "hi"}]'
+
+
+def test_replay_disabled(upstream, ctx, monkeypatch):
+    monkeypatch.setattr(mod, 'REPLAY_THINKING', False)
+    monkeypatch.setattr(thinking_blocks, 'REPLAY_THINKING', False)
+    ctx.log_id = 'replay-disabled'
+    upstream.respond(stream_events(text='[{"say": "hi"}]', thinking='plan'))
+    first = [SYSTEM, {'role': 'user', 'content': 'hello'}]
+    output = run_turn(ctx, first)
+    assert 'replay-disabled' not in thinking_blocks.thinking_store.sessions
+    run_turn(ctx, first + [{'role': 'assistant', 'content': output}, {'role': 'user', 'content': 'again'}])
+    assert upstream.requests[1]['messages'][1]['content'][0]['type'] == 'text'